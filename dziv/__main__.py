@@ -2,27 +2,99 @@
 import sys
 import click
 
-import shutil
+import time
 from pathlib import Path
 from dziv.dzi import Pyramid
-from dziv.tile import Tiler
+from dziv.tile import Tiler, write
 from dziv.image import Data as Image
-from dziv.web import osd_header
+from dziv.web import install_osd, write_page, write_index
+from dziv.metrics import log
 
 cmddef = dict(context_settings = dict(help_option_names=['-h', '--help']))
 @click.group(**cmddef)
+@click.option("-l","--log-level", default="info",
+              type=click.Choice(["debug", "info", "warning", "error"]),
+              help="Level of diagnostic messages")
 @click.pass_context
-def cli(ctx):
+def cli(ctx, log_level):
+    import logging
+    logging.basicConfig(level=log_level.upper(),
+                        format="%(levelname)s %(name)s: %(message)s")
     ctx.obj = dict()
 
+def megabytes(mb):
+    'Convert size option in MB to bytes, 0 or None is unbounded'
+    return int(mb * 1024 * 1024) if mb else None
+
 @cli.command("serve")
+@click.option("--level-cache", default=2048.0,
+              help="Per source memory budget in MB for zoomed levels, 0 is unbounded")
+@click.option("--crop-cache", default=64.0,
+              help="Per source memory budget in MB for cropped tiles, 0 is unbounded")
+@click.option("--tile-cache", default=512.0,
+              help="Memory budget in MB for encoded tiles, 0 is unbounded")
+@click.option("--idle", default=600.0,
+              help="Seconds after which an unused source is closed, 0 is never")
+@click.option("--source-budget", default=0.0,
+              help="Memory budget in MB for all open sources, 0 is unbounded")
+@click.option("-w","--workers", default=0,
+              help="Threads cropping and encoding tiles, default is one per CPU")
+@click.option("-t","--threads", default=32, help="Threads handling requests")
+@click.option("-H","--host", default="0.0.0.0", help="Address to listen on")
+@click.option("-p","--port", default=5100, help="Port to listen on")
+@click.option("--regional/--no-regional", default=True,
+              help="Render each tile from its source region instead of a zoomed level")
+@click.option("--dzi-fallback", is_flag=True, default=False,
+              help="Make tiles missing from a DZI directory from an image of the same name")
+@click.option("--disk-cache", default=None,
+              help="Directory keeping encoded tiles across restarts, may be shared")
+@click.option("--disk-cache-size", default=4096.0,
+              help="Disk budget in MB of the --disk-cache, 0 is unbounded")
+@click.option("--pixel-store", default=None,
+              help="Directory (eg under /dev/shm) of decoded levels shared by server processes, disables --regional")
+@click.option("--prewarm", default=0,
+              help="Tiles per image to make ahead of viewers, coarse first, -1 for all")
+@click.option("--debug", is_flag=True, default=False,
+              help="Run single threaded Flask debug server")
 @click.argument('source', nargs=-1)
-def serve(source):
-    print(source)
+def serve(level_cache, crop_cache, tile_cache, idle, source_budget,
+          workers, threads, host, port, regional, dzi_fallback, disk_cache,
+          disk_cache_size, pixel_store, prewarm, debug, source):
+    '''
+    Serve images, packed or DZI pyramids, or directories of them, to OpenSeadragon
+    '''
     import dziv.server
-    app = dziv.server.create(source)
-    app.debug = True
-    app.run(host="0.0.0.0", port=5100, threaded=False)
+    app = dziv.server.create(source, megabytes(level_cache), megabytes(crop_cache),
+                             megabytes(tile_cache), idle or None,
+                             megabytes(source_budget), workers or None, regional,
+                             dzi_fallback, disk_cache, megabytes(disk_cache_size),
+                             prewarm, pixel_store)
+    if debug:
+        app.debug = True
+        app.run(host=host, port=port, threaded=False)
+        return
+    dziv.server.run(app, host, port, threads)
+
+def report(tiler, stats, start):
+    'Print what dedup saved or, with stats, a JSON summary of tiling'
+    ds = tiler.dedup_stats
+    if not stats:
+        if ds["tiles"]:
+            print(f'dedup: {ds["tiles"]} uniform tiles shared, {ds["bytes"]} bytes saved')
+        return
+    import json
+    from dziv.metrics import registry
+    summ = registry.summary()
+    summ["seconds"] = time.perf_counter() - start
+    summ["dedup"] = ds
+    written = summ["counters"].get("written_bytes")
+    writing = summ["timings"].get("write")
+    if written and writing and writing["sum"]:
+        # bytes per second a writer spends writing
+        summ["write_throughput"] = written / writing["sum"]
+    if hasattr(tiler, "cache_stats"):
+        summ["caches"] = tiler.cache_stats
+    print(json.dumps(summ, indent=1))
 
 @cli.command("tile")
 @click.option("-S","--size", default=254, help="Tile size")
@@ -30,46 +102,213 @@ def serve(source):
 @click.option("-f","--format", default=None, help="Output format")
 @click.option("-d","--directory", default=None, help="Output directory")
 @click.option("-o","--output", default=None, help="Output DZI file")
+@click.option("-c","--cascade", is_flag=True, default=False,
+              help="Make each level by 2x reduction of the level above")
+@click.option("--smooth-first", is_flag=True, default=False,
+              help="With --cascade, interpolate the first reduction")
+@click.option("-j","--jobs", default=1, help="Number of tiling processes")
+@click.option("-s","--stream", is_flag=True, default=False,
+              help="Tile out-of-core, reading the image in strips")
+@click.option("--rows", default=None, type=int,
+              help="With --stream, rows per strip (default is tile size)")
+@click.option("-P","--pack", default=None,
+              help="Output a packed pyramid file instead of DZI and directory")
+@click.option("-r","--resume", is_flag=True, default=False,
+              help="Keep a manifest of written tiles and skip those still valid")
+@click.option("--verify", is_flag=True, default=False,
+              help="With --resume, check hashes of existing tiles, not just sizes")
+@click.option("--reduction", default="mean", type=click.Choice(["mean", "max", "min"]),
+              help="How .npy array values are combined in coarser levels")
+@click.option("--dedup/--no-dedup", default=True,
+              help="Write uniform tiles of one value once and link the others")
+@click.option("--cmap", default="plasma", help="Matplotlib colormap for .npy values")
+@click.option("--scale", default="log", type=click.Choice(["log", "linear"]),
+              help="Scale of .npy values before coloring")
+@click.option("--eps", default=10.0,
+              help="With log scale, values below eps are clipped to eps")
+@click.option("--draft/--no-draft", default=True,
+              help="Decode a JPEG at reduced scale for coarse levels")
+@click.option("--writers", default=4,
+              help="Number of background tile writer threads, 0 writes in line")
+@click.option("--queue", default=64,
+              help="Number of encoded tiles that may wait to be written")
+@click.option("--fsync", default=0,
+              help="Sync written tiles in batches of this many, 0 never syncs")
+@click.option("--stats", is_flag=True, default=False,
+              help="Print JSON summary of stage timings and counts when done")
+@click.option("-w","--watch", is_flag=True, default=False,
+              help="Keep running, retiling the parts of the image that change")
+@click.option("--interval", default=2.0,
+              help="With --watch, seconds between checks of the image file")
 @click.argument("filename")
-def tile(size, overlap, format, directory, output, filename):
+def tile(size, overlap, format, directory, output, cascade, smooth_first, jobs,
+         stream, rows, pack, resume, verify, dedup, reduction, cmap, scale, eps,
+         draft, writers, queue, fsync, stats, watch, interval, filename):
     '''
     Fill directory with tree of deep zoom tiles
     '''
-    if not any((directory, output)):
-        print("require either --directory or --output")
+    if not any((directory, output, pack)):
+        print("require either --directory, --output or --pack")
         sys.exit(1)
-    if not output:
-        output = directory + ".dzi"
-    if not directory:
-        directory = output.rsplit('.',1)[0]
-
-    output = Path(output)
-    directory = Path(directory)
+    if pack:
+        directory = Path(".")
+    else:
+        if not output:
+            output = directory + ".dzi"
+        if not directory:
+            directory = output.rsplit('.',1)[0]
+        output = Path(output)
+        directory = Path(directory)
 
     inpath = Path(filename)
     if not inpath.exists():
         print(f'no such file: {filename}')
         sys.exit(1)
-        
+    start = time.perf_counter()
+
     if format is None:
         format = inpath.suffix[1:]
+        if format == "npy":
+            format = "png"
 
-    # for now, just images are assumed
-    d = Image(inpath)
-    p = Pyramid(d.shape, size, overlap, format)
-    t = Tiler(p, d)
+    from dziv.colormap import Colormap
+    colormap = Colormap(cmap, scale, eps)
+
+    if watch:
+        if stream or pack:
+            print("--watch requires tiling to a directory without --stream")
+            sys.exit(1)
+        from dziv.watch import Watcher
+        p = Pyramid((1,1), size, overlap, format)
+        Watcher(inpath, p, directory, cascade=cascade, smooth_first=smooth_first,
+                output=output, colormap=colormap).run(interval)
+        return
+
+    if stream:
+        from dziv.stream import open_source, StreamTiler
+        src = open_source(inpath, colormap)
+        p = Pyramid(src.shape, size, overlap, format)
+        t = StreamTiler(p, src)
+        kwds = dict(rows=rows, dedup=dedup)
+    else:
+        if inpath.suffix == ".npy":
+            from dziv.array import Data as Array
+            d = Array(inpath, reduction, colormap)
+        else:
+            d = Image(inpath, colormap=colormap, draft=draft).load()
+        p = Pyramid(d.shape, size, overlap, format)
+        t = Tiler(p, d, cascade, smooth_first)
+        kwds = dict(jobs=jobs, dedup=dedup)
+
+    if pack:
+        from dziv.pack import PackWriter
+        with PackWriter(pack, p) as writer:
+            t.save(directory, writer=writer, **kwds)
+        report(t, stats, start)
+        return
 
     p.save(output)
-    t.save(directory)
+    options = tile_options(inpath, stream, cascade, smooth_first, colormap, reduction, draft)
+    if writers > 0:
+        from dziv.output import Pipeline
+        with Pipeline(writers, queue, fsync) as writer:
+            save(t, directory, writer, resume, inpath, p, options, verify, **kwds)
+    else:
+        save(t, directory, write, resume, inpath, p, options, verify, **kwds)
+    report(t, stats, start)
+
+def tile_options(inpath, stream, cascade, smooth_first, colormap, reduction, draft):
+    '''
+    Return dict of the options that change the tiles of the file at
+    inpath, as recorded by a resume manifest.
+    '''
+    npy = inpath.suffix == ".npy"
+    # streaming makes the same tiles as cascade, arrays always cascade
+    options = dict(cascade=cascade or stream or npy, smooth_first=smooth_first and not stream)
+    if npy:
+        vrange = colormap.vrange
+        options.update(cmap=colormap.name, scale=colormap.scale, eps=colormap.eps,
+                       vrange=None if vrange is None else list(vrange))
+        if not stream:
+            # streaming colors before reducing
+            options["reduction"] = reduction
+    elif not stream and inpath.suffix.lower() in (".jpg", ".jpeg"):
+        options["draft"] = draft
+    return options
+
+def save(t, directory, writer, resume, inpath, p, options, verify, **kwds):
+    '''
+    Save tiles of tiler t, resuming from and updating a manifest if
+    resume.  The options are as from tile_options().
+    '''
+    if not resume:
+        t.save(directory, writer=writer, **kwds)
+        return
+    from dziv.manifest import Manifest
+    with Manifest(directory, inpath, p, options, verify) as manifest:
+        log.info('resuming with %d tiles done, %d invalid', manifest.kept, manifest.dropped)
+        t.save(directory, writer=writer, manifest=manifest, **kwds)
     
+@cli.command("unpack")
+@click.option("-d","--directory", default=None, help="Output directory")
+@click.option("-o","--output", default=None, help="Output DZI file")
+@click.argument("filename")
+def unpack(directory, output, filename):
+    '''
+    Expand a packed pyramid file to DZI file and directory of tiles
+    '''
+    from dziv.pack import Pack
+    if not any((directory, output)):
+        output = str(Path(filename).with_suffix(".dzi"))
+    if not output:
+        output = directory.removesuffix("_files") + ".dzi"
+    if not directory:
+        directory = output.rsplit('.',1)[0] + "_files"
+    pk = Pack(filename)
+    pk.pyramid.save(output)
+    pk.unpack(directory)
+    pk.close()
+
+@cli.command("bench")
+@click.option("-b","--backend", multiple=True, default=["image"],
+              type=click.Choice(["image", "array", "stream"]),
+              help="Data backend to benchmark, may repeat")
+@click.option("-s","--size", multiple=True, type=int, default=[1024, 4096],
+              help="Linear size of square synthetic source, may repeat")
+@click.option("-S","--tile-size", multiple=True, type=int, default=[254],
+              help="Tile size, may repeat")
+@click.option("-f","--format", multiple=True, default=["jpg", "png"],
+              help="Tile format, may repeat")
+@click.option("-j","--jobs", default=1, help="Number of tiling processes")
+@click.option("-c","--cascade", is_flag=True, default=False,
+              help="Make each level by 2x reduction of the level above")
+@click.option("-w","--workdir", default=None,
+              help="Directory for temporary sources and tiles")
+@click.option("-o","--output", default=None, help="Output JSON file, default is stdout")
+def bench(backend, size, tile_size, format, jobs, cascade, workdir, output):
+    '''
+    Time tiling of synthetic sources, reporting JSON
+    '''
+    from dziv.bench import run, dumps
+    text = dumps(run(backend, size, tile_size, format, jobs, cascade, workdir))
+    if output:
+        Path(output).write_text(text + "\n")
+    else:
+        print(text)
+
 @cli.command("osdweb")
 @click.option("-S","--size", default=254, help="Tile size")
 @click.option("-O","--overlap", default=1, help="Tile overlap")
 @click.option("-f","--format", default=None, help="Output format")
 @click.option("-t","--target", default=None, help="Output directory")
 @click.option("-u","--url", default=None, help="Base URL")
+@click.option("-c","--cascade", is_flag=True, default=False,
+              help="Make each level by 2x reduction of the level above")
+@click.option("--smooth-first", is_flag=True, default=False,
+              help="With --cascade, interpolate the first reduction")
+@click.option("-j","--jobs", default=1, help="Number of tiling processes")
 @click.argument("filename")
-def osdweb(size, overlap, format, target, url, filename):
+def osdweb(size, overlap, format, target, url, cascade, smooth_first, jobs, filename):
     '''
     Populate a static web area.
     '''
@@ -84,22 +323,91 @@ def osdweb(size, overlap, format, target, url, filename):
     # for now, just images are assumed
     d = Image(inpath)
     p = Pyramid(d.shape, size, overlap, format)
-    t = Tiler(p, d)
+    t = Tiler(p, d, cascade, smooth_first)
 
     target = Path(target)
 
     dziname = str(inpath.stem)
     p.save(target / f'{dziname}.dzi')
-    t.save(target / f'{dziname}_files' )
+    t.save(target / f'{dziname}_files', jobs=jobs)
+
+    install_osd(target)
+    write_page(target, dziname, inpath.stem)
+
+@cli.command("batch")
+@click.option("-S","--size", default=254, help="Tile size")
+@click.option("-O","--overlap", default=1, help="Tile overlap")
+@click.option("-f","--format", default=None, help="Output format, default follows each image")
+@click.option("-t","--target", required=True, help="Output directory")
+@click.option("-c","--cascade", is_flag=True, default=False,
+              help="Make each level by 2x reduction of the level above")
+@click.option("--smooth-first", is_flag=True, default=False,
+              help="With --cascade, interpolate the first reduction")
+@click.option("-j","--jobs", default=0, help="Number of tiling processes, default is one per CPU")
+@click.option("--split", default=1024,
+              help="Images with more tiles are tiled in chunks by all processes")
+@click.option("--chunk", default=64, help="Tiles per task of a split image")
+@click.option("--in-flight", default=2,
+              help="Number of split images held decoded in shared memory at once")
+@click.option("--skip-existing", is_flag=True, default=False,
+              help="Leave alone images whose DZI file exists in the target")
+@click.option("--web", is_flag=True, default=False,
+              help="Also write OpenSeadragon pages, their files and an index.html")
+@click.option("--reduction", default="mean", type=click.Choice(["mean", "max", "min"]),
+              help="How .npy array values are combined in coarser levels")
+@click.option("--dedup/--no-dedup", default=True,
+              help="Write uniform tiles of one value once and link the others")
+@click.option("--cmap", default="plasma", help="Matplotlib colormap for .npy values")
+@click.option("--scale", default="log", type=click.Choice(["log", "linear"]),
+              help="Scale of .npy values before coloring")
+@click.option("--eps", default=10.0,
+              help="With log scale, values below eps are clipped to eps")
+@click.option("--draft/--no-draft", default=True,
+              help="Decode a JPEG at reduced scale for coarse levels")
+@click.option("--writers", default=4,
+              help="Number of background tile writer threads per process, 0 writes in line")
+@click.option("--queue", default=64,
+              help="Number of encoded tiles that may wait to be written")
+@click.option("--fsync", default=0,
+              help="Sync written tiles in batches of this many, 0 never syncs")
+@click.option("--stats", is_flag=True, default=False,
+              help="Print JSON summary of stage timings and counts when done")
+@click.argument("inputs", nargs=-1, required=True)
+def batch(size, overlap, format, target, cascade, smooth_first, jobs, split, chunk,
+          in_flight, skip_existing, web, reduction, dedup, cmap, scale, eps, draft,
+          writers, queue, fsync, stats, inputs):
+    '''
+    Tile many image files, globs or directory trees on one pool of processes
+    '''
+    from dziv.batch import Batch, find_images
+    from dziv.colormap import Colormap
+    try:
+        images = find_images(inputs)
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+    start = time.perf_counter()
+    writer = write
+    if writers > 0:
+        from dziv.output import Pipeline
+        writer = Pipeline(writers, queue, fsync)
+    b = Batch(target, size, overlap, format, cascade, smooth_first, jobs or None, writer,
+              dedup, split, chunk, in_flight, skip_existing, reduction,
+              Colormap(cmap, scale, eps), draft)
+    results = b.run(images)
+    failed = sorted([name for name, res in results.items() if "error" in res])
 
-    osd = Path("osd")
-    header = osd_header(f'{dziname}.dzi', osd, inpath.stem)
-    with open(target / f'{inpath.stem}.html', "w") as html:
-        html.write(f'<html>\n{header}\n</html>\n')
+    if web:
+        install_osd(target)
+        names = sorted([name for name in results if name not in failed])
+        for name in names:
+            write_page(target, name)
+        write_index(target, names)
 
-    shutil.copytree("osd/images", target / osd / "images")
-    osdjs = Path("osd/openseadragon.min.js")
-    shutil.copy(osdjs, target / osdjs )
+    report(b, stats, start)
+    if failed:
+        print(f'{len(failed)} of {len(results)} images failed: {" ".join(failed)}')
+        sys.exit(1)
 
 def main():
     cli(obj=None)
@@ -16,58 +16,224 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Adapt numpy arrays to the dzi data model.
 
-import scipy
+Levels are made by block reduction of the array values, each from the
+level above it, and crops are views.  Values are mapped to colors only
+when a tile is saved so a large (memory mapped) array is never held as
+a full resolution image.
+'''
 
+import io
+import copy
+from math import ceil
+from pathlib import Path
 
+import numpy
 
-def Data(object):
+from .image import pil_fmt
+from .metrics import timed, timer
+from .colormap import Colormap
 
-    def __init__(self, array, order = 3):
+reductions = dict(mean=numpy.add, max=numpy.maximum, min=numpy.minimum)
+
+
+def block_reduce(arr, factor=2, how="mean", rows=256):
+    '''
+    Return arr reduced by combining each factor x factor block.
+
+    The how may be "mean", "max" or "min".  Partial blocks at the
+    bottom and right edges combine the values they hold so the new
+    shape is rounded up.  The mean of integer values is float32,
+    otherwise the dtype is kept.
+
+    The arr is read in bands of about rows rows so it may be a
+    memory map larger than memory.
+    '''
+    ufunc = reductions[how]
+    nr, nc = arr.shape[:2]
+    f = factor
+    shape = (ceil(nr / f), ceil(nc / f)) + arr.shape[2:]
+    dtype = arr.dtype
+    accum = None
+    if how == "mean":
+        accum = numpy.float64
+        if dtype.kind != 'f':
+            dtype = numpy.dtype(numpy.float32)
+    out = numpy.empty(shape, dtype)
+
+    cols = numpy.arange(0, nc, f)
+    if how == "mean":
+        ncols = numpy.diff(numpy.append(cols, nc))
+        ncols = ncols.reshape((1, -1) + (1,) * (arr.ndim - 2))
+    step = max(f, rows - rows % f)
+    for r0 in range(0, nr, step):
+        band = arr[r0:r0 + step]
+        nb = band.shape[0]
+        brows = numpy.arange(0, nb, f)
+        got = ufunc.reduceat(band, brows, axis=0, dtype=accum)
+        got = ufunc.reduceat(got, cols, axis=1)
+        if how == "mean":
+            nrows = numpy.diff(numpy.append(brows, nb))
+            got /= nrows.reshape((-1,) + (1,) * (arr.ndim - 1)) * ncols
+        out[r0 // f:r0 // f + len(brows)] = got
+    return out
+
+
+def load(array, mmap=True):
+    '''
+    Return a numpy array from an array or an .npy file name or path.
+
+    With mmap, a file is memory mapped read only.
+    '''
+    if isinstance(array, numpy.ndarray):
+        return array
+    return numpy.load(array, mmap_mode='r' if mmap else None)
+
+
+class Data(object):
+    '''
+    Adapt numpy array to dzi data model.
+    '''
+    # Tiler makes each level from the one above rather than re-reading
+    # the full (memory mapped) array for each
+    cascade = True
+
+    def __init__(self, array, reduction="mean", colormap=None):
         '''
-        Create a Data from an array.
+        Create a Data from an array or .npy file.
 
-        The order gives the zoom interpolation order.
+        The reduction ("mean", "max" or "min") combines blocks of
+        values when zooming out.  Max or min keep sparse features
+        visible at coarse levels.
+
+        The colormap.Colormap colors values when saved.  If it lacks
+        a value range, a copy is fit to the array.  The colormap is
+        kept by all Data derived from this one so that tiles agree.
         '''
-        self._array = array
-        self._order = order
+        if reduction not in reductions:
+            raise ValueError(f'unknown reduction: {reduction}')
+        if isinstance(array, numpy.ndarray):
+            self._array = array
+        else:
+            with timer("decode"):
+                self._array = load(array)
+        self._reduction = reduction
+        if colormap is None:
+            colormap = Colormap()
+        if colormap.vrange is None:
+            with timer("decode"):
+                colormap = copy.copy(colormap).fit(self._array)
+        self._colormap = colormap
+
+    def _derive(self, array):
+        return Data(array, self._reduction, self._colormap)
 
     @property
     def shape(self):
         return self._array.shape[:2]
 
+    @property
+    def colormap(self):
+        'The colormap.Colormap used when saving'
+        return self._colormap
+
+    def recolor(self, colormap):
+        '''
+        Return a new Data of the same array with another colormap.
+        '''
+        return Data(self._array, self._reduction, colormap)
+
+    @property
+    def nbytes(self):
+        'Size in bytes of the array'
+        return self._array.nbytes
+
+    def load(self):
+        'Nothing to decode, return self'
+        return self
+
+    def asarray(self):
+        'Return the array'
+        return self._array
+
+    @timed("dedup")
+    def uniform(self):
+        '''
+        Return a key of the shape, value and colormap if all values
+        are equal, else None.
+        '''
+        arr = self._array
+        if not arr.size:
+            return None
+        first = arr.flat[0]
+        if not (arr == first).all():
+            return None
+        c = self._colormap
+        return (arr.dtype.str, arr.shape, first.tobytes(),
+                c.name, c.scale, c.eps, tuple(c.vrange))
+
+    @timed("zoom")
+    def reduce(self, factor=2):
+        '''
+        Return a new Data reduced by an integer factor.
+        '''
+        return self._derive(block_reduce(self._array, factor, self._reduction))
+
     def zoom(self, shape):
         '''
         Return a new Data scaled to fit shape.
+
+        A shape that is a pyramid level (the array shape divided by a
+        power of two and rounded up) is made by block reduction.  Any
+        other shape samples the nearest values.
         '''
-        s = self.shape
-        zf = [1.0]*len(s)
-        zf[0] = shape[0] / s[0]
-        zf[1] = shape[1] / s[1]
-        new = scipy.ndimage.zoom(self._array, zf, self._order)
-        return Data(new, self._order)
+        shape = tuple(shape)
+        if shape == self.shape:
+            return self
+        nr, nc = self.shape
+        factor = 1
+        while max(nr, nc) > factor:
+            factor *= 2
+            if shape == (ceil(nr / factor), ceil(nc / factor)):
+                return self.reduce(factor)
+        with timer("zoom"):
+            rows = (numpy.arange(shape[0]) * nr) // shape[0]
+            cols = (numpy.arange(shape[1]) * nc) // shape[1]
+            return self._derive(self._array[rows][:, cols])
 
+    @timed("crop")
     def crop(self, slices):
         '''
-        Return a new Data in slices 
+        Return a new Data in slices as a view of this one.
+        '''
+        sr, sc = slices
+        return self._derive(self._array[sr, sc])
+
+    def colorize(self):
+        '''
+        Return uint8 RGBA array of colors of the values.
         '''
-        sls = [slice(0, n) for n in self._array.shape]
-        sls[0] = slices[0]
-        sls[1] = slices[1]
-        sls = tuple(sls)
-        return Data(self._array[sls], self._order)
+        arr = self._array
+        if arr.ndim == 3:
+            arr = arr[:, :, 0]
+        return self._colormap(arr)
 
     def save(self, tgt, fmt=None):
         '''
         Save self to target.
 
         Target may be file name as string or pathlib.Path or a file object.
+
+        A fmt of "npy" or "npz" saves the values, any other is an
+        image format of the colorized values.
         '''
         if isinstance(tgt, str):
             tgt = Path(tgt)
         if isinstance(tgt, Path):
             if not tgt.parent.exists():
-                tgt.parent.mkdir(parents=True)
+                tgt.parent.mkdir(parents=True, exist_ok=True)
             if fmt is None:
                 fmt = tgt.suffix[1:]
         if fmt is None:
@@ -76,8 +242,17 @@ def Data(object):
             numpy.save(tgt, self._array)
             return
         if fmt == "npz":
-            numpy.savez_compressed(tgt, {path.stem, self._array})
+            numpy.savez_compressed(tgt, array=self._array)
             return
-        # o.w. we assume image
-        scipy.misc.imsave(tgt, self._array, format=fmt);
 
+        from PIL import Image
+        fmt = pil_fmt(fmt)
+        with timer("encode"):
+            img = Image.fromarray(self.colorize())
+            if fmt == "jpeg":
+                img = img.convert("RGB")
+            fp = tgt if not isinstance(tgt, Path) else io.BytesIO()
+            img.save(fp, format=fmt)
+        if isinstance(tgt, Path):
+            with timer("write"):
+                tgt.write_bytes(fp.getbuffer())
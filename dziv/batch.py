@@ -0,0 +1,369 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Tile many images on one pool of processes.
+
+Small images are each tiled whole by one worker.  An image with more
+tiles than a split is decoded once into shared memory.  Workers make
+each coarser level into shared memory of its own, reduced from the
+level above if cascaded or else zoomed from the full image, as
+tile.Tiler does.  Each level is cut into chunks of tiles which any
+worker crops from it, so a few giant images spread over the whole
+pool instead of holding up the end of the batch.
+
+Each image makes name.dzi and name_files/ in the target.  The .dzi is
+written last so its presence marks a complete image.
+'''
+
+import glob
+import time
+from pathlib import Path
+from multiprocessing import resource_tracker
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .dzi import Pyramid
+from .tile import Tiler, Dedup, write, drain, reduced
+from .image import Data as Image, Pixels, header_shape
+from .shared import Array
+from .metrics import log, count, timer, registry
+
+image_suffixes = ('.jpg', '.jpeg', '.png')
+array_suffixes = ('.npy',)
+suffixes = image_suffixes + array_suffixes
+
+
+def find_images(inputs):
+    '''
+    Return list of (path, name) of images in files, globs or directory
+    trees.
+
+    The name of an image found in a directory is its path relative to
+    that directory, sans suffix, otherwise it is the file stem.
+    '''
+    if isinstance(inputs, (str, Path)):
+        inputs = [inputs]
+    found = list()
+    for one in inputs:
+        path = Path(one)
+        if path.is_dir():
+            found += [(p, p.relative_to(path).with_suffix("").as_posix())
+                      for p in sorted(path.rglob("*"))
+                      if p.suffix.lower() in suffixes and p.is_file()]
+            continue
+        if path.exists():
+            paths = [path]
+        else:
+            paths = [Path(p) for p in sorted(glob.glob(str(one), recursive=True))]
+            if not paths:
+                raise ValueError(f'no such file, directory or match: {one}')
+        for p in paths:
+            if p.suffix.lower() not in suffixes:
+                if path.exists():
+                    raise ValueError(f'unsupported format: {p.suffix}')
+                continue
+            found.append((p, p.stem))
+    seen = dict()
+    for p, name in found:
+        if name in seen and seen[name] != p.resolve():
+            raise ValueError(f'images {seen[name]} and {p} would both be named {name}')
+        seen[name] = p.resolve()
+    # an image given twice is tiled once
+    return list({name: (p, name) for p, name in found}.values())
+
+
+# the writer of a worker process, see _start_worker()
+_writer = write
+
+def _start_worker(writer):
+    'Initialize a worker process with the writer it shares between tasks'
+    global _writer
+    _writer = writer
+
+
+def _open(path, options):
+    'Return data of an image file'
+    if path.suffix.lower() in array_suffixes:
+        from .array import Data as Array
+        return Array(path, options["reduction"], options["colormap"])
+    return Image(path, colormap=options["colormap"], draft=options["draft"]).load()
+
+
+def _tile_image(path, directory, pyramid, options):
+    '''
+    Worker: tile a whole image, return the dedup stats and metrics.
+    '''
+    registry.reset()
+    data = _open(path, options)
+    t = Tiler(pyramid, data, options["cascade"], options["smooth_first"])
+    t.save(directory, _writer, dedup=options["dedup"])
+    return t.dedup_stats, registry.summary()
+
+
+def _make_level(spec, meta, level_spec, shape, reduce):
+    '''
+    Worker: fill the shared array of level_spec with the level of shape
+    reduced from the shared pixels of the level above it, if reduce,
+    else zoomed from those of the full image.  Return the meta of the
+    level and the metrics.
+    '''
+    registry.reset()
+    shared = Array.attach(spec)
+    target = Array.attach(level_spec)
+    try:
+        data = Pixels(shared.array, meta)
+        level = reduced(data, shape) if reduce else data.zoom(shape)
+        level.fill(target.array)
+        meta = level.meta()
+        del data, level
+    finally:
+        _detach(target)
+        _detach(shared)
+    return meta, registry.summary()
+
+
+def _tile_chunk(spec, meta, pyramid, level, locs, directory, options):
+    '''
+    Worker: write tiles at locs cropped from a level of an image in
+    shared memory, return the dedup stats and metrics.
+    '''
+    registry.reset()
+    writer = Dedup(_writer) if options["dedup"] else _writer
+    shared = Array.attach(spec)
+    try:
+        data = Pixels(shared.array, meta)
+        for loc in locs:
+            writer(data.crop(pyramid.slices(level, loc)),
+                   directory / pyramid.filename(level, loc))
+            count("tiles")
+        drain(writer)
+        del data
+    finally:
+        _detach(shared)
+    stats = writer.stats if options["dedup"] else dict(tiles=0, bytes=0)
+    return stats, registry.summary()
+
+
+def _detach(shared):
+    try:
+        shared.close()
+    except BufferError:
+        # a traceback still holds views of the pixels
+        pass
+
+
+class Batch(object):
+    '''
+    Tile many images into a target directory with a pool of processes.
+    '''
+    def __init__(self, target, tile_size=254, tile_overlap=1, tile_format=None,
+                 cascade=False, smooth_first=False, jobs=None, writer=write,
+                 dedup=True, split=1024, chunk=64, in_flight=2, skip_existing=False,
+                 reduction="mean", colormap=None, draft=True):
+        '''
+        Tile into target with jobs processes (None is one per CPU).
+
+        A tile_format of None follows each image (png for .npy).  The
+        writer must be picklable, each worker process runs its own
+        copy (eg, an output.Pipeline) for all its tasks.
+
+        An image with more than split tiles is cut into tasks of at
+        most chunk tiles.  At most in_flight split images, with their
+        levels, are held in shared memory at once.  With skip_existing,
+        images whose .dzi exists are left alone.
+
+        The reduction and colormap apply to .npy arrays and draft to
+        JPEG images as for tile.Tiler data.
+        '''
+        self.target = Path(target)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_format = tile_format
+        self.jobs = jobs
+        self.writer = writer
+        self.split = split
+        self.chunk = chunk
+        self.in_flight = in_flight
+        self.skip_existing = skip_existing
+        self.options = dict(cascade=cascade, smooth_first=smooth_first, dedup=dedup,
+                            reduction=reduction, colormap=colormap, draft=draft)
+        self.dedup_stats = dict(tiles=0, bytes=0)
+        self.results = dict()
+
+    def pyramid(self, path):
+        'Return the Pyramid of an image file reading just its header'
+        fmt = self.tile_format
+        if fmt is None:
+            fmt = path.suffix[1:]
+            if fmt == "npy":
+                fmt = "png"
+        if path.suffix.lower() in array_suffixes:
+            import numpy
+            shape = numpy.load(path, mmap_mode='r').shape[:2]
+        else:
+            shape = header_shape(path)
+        return Pyramid(shape, self.tile_size, self.tile_overlap, fmt)
+
+    def run(self, images):
+        '''
+        Tile images given as list of (path, name), eg from find_images().
+
+        Return dict by name of a result dict holding the number of
+        tiles and the seconds into the batch the image was done or the
+        error of a failed image.  Failures do not stop the batch.
+        '''
+        self._start = time.perf_counter()
+        self._images = dict()   # name -> dict of pending work
+        self._tasks = dict()    # future -> (name, level made or None)
+        self._ntotal = len(images)
+        # workers must share the tracker of the shared memory made later
+        resource_tracker.ensure_running()
+        with ProcessPoolExecutor(self.jobs, initializer=_start_worker,
+                                 initargs=(self.writer,)) as pool:
+            try:
+                self._submit(pool, images)
+                while self._tasks:
+                    self._collect(pool)
+            finally:
+                for work in self._images.values():
+                    self._release(work)
+        return self.results
+
+    def _submit(self, pool, images):
+        big = list()
+        for path, name in images:
+            dzi = self.target / f'{name}.dzi'
+            if self.skip_existing and dzi.exists():
+                log.debug('skip %s, %s exists', path, dzi)
+                self.results[name] = dict(skipped=True)
+                continue
+            try:
+                p = self.pyramid(path)
+            except Exception as err:
+                self._failed(name, path, err)
+                continue
+            work = dict(path=path, pyramid=p, tasks=0, levels=dict(), error=None)
+            self._images[name] = work
+            if p.ntiles > self.split and path.suffix.lower() in image_suffixes:
+                big.append(name)
+                continue
+            self._add(pool.submit(_tile_image, path, self.target / f'{name}_files', p,
+                                  self.options), name)
+
+        # Small images go first, split ones follow in chunks that any
+        # worker may take, so the end of the batch is evenly shared.
+        for name in big:
+            while sum([bool(work["levels"])
+                       for work in self._images.values()]) >= self.in_flight:
+                self._collect(pool)
+            work = self._images[name]
+            try:
+                with timer("decode"):
+                    data = Image(work["path"], colormap=self.options["colormap"],
+                                 draft=False).load()
+                    shared, meta = data.share()
+                    del data
+            except Exception as err:
+                self._failed(name, work["path"], err)
+                del self._images[name]
+                continue
+            top = work["pyramid"].depth - 1
+            work["levels"][top] = (shared, meta)
+            if not self.options["cascade"]:
+                for level in range(top - 1, -1, -1):
+                    self._make_level(pool, name, level, top)
+            self._level_done(pool, name, top, meta)
+
+    def _make_level(self, pool, name, level, source):
+        'Submit making a level of an image from its source level'
+        work = self._images[name]
+        p = work["pyramid"]
+        shared, meta = work["levels"][source]
+        lshape = p.level_shape(level)
+        # levels keep the pixel layout of the full image
+        arr = shared.array
+        target = Array.create(tuple(lshape) + arr.shape[2:], arr.dtype)
+        work["levels"][level] = (target, None)
+        # as tile.Tiler, a cascade may zoom just the first step
+        reduce = self.options["cascade"] and not (self.options["smooth_first"]
+                                                  and source == p.depth - 1)
+        self._add(pool.submit(_make_level, shared.spec, meta, target.spec, lshape, reduce),
+                  name, level)
+
+    def _level_done(self, pool, name, level, meta):
+        'Submit the chunks of a level of an image now in shared memory'
+        work = self._images[name]
+        shared = work["levels"][level][0]
+        work["levels"][level] = (shared, meta)
+        if self.options["cascade"] and level > 0:
+            # the next level goes first so reducing overlaps cropping
+            self._make_level(pool, name, level - 1, level)
+        p = work["pyramid"]
+        directory = self.target / f'{name}_files'
+        locs = [tuple(loc) for loc in p.level(level).locs().tolist()]
+        for beg in range(0, len(locs), self.chunk):
+            self._add(pool.submit(_tile_chunk, shared.spec, meta, p, level,
+                                  locs[beg:beg + self.chunk], directory, self.options),
+                      name)
+
+    def _add(self, fut, name, level=None):
+        self._tasks[fut] = (name, level)
+        self._images[name]["tasks"] += 1
+
+    def _collect(self, pool):
+        'Wait for some tasks and finish images they complete'
+        done, pending = wait(list(self._tasks), return_when=FIRST_COMPLETED)
+        for fut in done:
+            name, level = self._tasks.pop(fut)
+            work = self._images[name]
+            work["tasks"] -= 1
+            try:
+                got, summary = fut.result()
+            except Exception as err:
+                if work["error"] is None:
+                    work["error"] = err
+            else:
+                registry.merge(summary)
+                if level is None:
+                    for key in self.dedup_stats:
+                        self.dedup_stats[key] += got[key]
+                elif work["error"] is None:
+                    self._level_done(pool, name, level, got)
+            if work["tasks"] == 0:
+                self._finish(name, self._images.pop(name))
+
+    def _finish(self, name, work):
+        self._release(work)
+        if work["error"] is not None:
+            self._failed(name, work["path"], work["error"])
+            return
+        p = work["pyramid"]
+        p.save(self.target / f'{name}.dzi')
+        count("images")
+        self.results[name] = dict(tiles=p.ntiles, seconds=time.perf_counter() - self._start)
+        log.info('tiled %s (%d of %d)', name, len(self.results), self._ntotal)
+
+    def _failed(self, name, path, err):
+        log.error('failed to tile %s: %s', path, err)
+        self.results[name] = dict(error=str(err))
+
+    def _release(self, work):
+        levels, work["levels"] = work["levels"], dict()
+        for shared, meta in levels.values():
+            shared.close()
+            shared.unlink()
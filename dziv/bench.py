@@ -0,0 +1,171 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Benchmark tiling of synthetic images and arrays.
+
+Each case makes a source file, then times the full path of loading
+it, making its pyramid and saving all tiles.  Time is split into the
+stages of decode, zoom (including reduce), crop, dedup, encode and
+write.  Each case runs in a fresh process so that its peak resident
+memory may be reported.
+'''
+
+import sys
+import json
+import time
+import tempfile
+import resource
+from pathlib import Path
+
+import numpy
+
+from .dzi import Pyramid
+from .tile import Tiler
+from .metrics import registry, timer
+
+backends = ("image", "array", "stream")
+stages = ("decode", "zoom", "crop", "dedup", "encode", "write")
+
+
+def synthetic(path, shape, kind="image"):
+    '''
+    Write a synthetic source of shape (nrows, ncols) to path.
+
+    An "image" is RGB with smooth gradients and some noise.  An
+    "array" is float32 mostly zero with sparse peaks, like detector
+    data.  Rows are made in bands to bound memory.
+    '''
+    nr, nc = shape
+    rng = numpy.random.default_rng(0)
+    rows = max(1, (1 << 22) // nc)
+    if kind == "array":
+        arr = numpy.lib.format.open_memmap(path, "w+", numpy.float32, shape)
+        for r0 in range(0, nr, rows):
+            band = numpy.zeros((min(rows, nr - r0), nc), numpy.float32)
+            hits = rng.random(band.shape) < 0.001
+            band[hits] = rng.exponential(1000, hits.sum())
+            arr[r0:r0 + len(band)] = band
+        arr.flush()
+        del arr
+        return
+    from PIL import Image
+    img = Image.new("RGB", (nc, nr))
+    x = numpy.arange(nc, dtype=numpy.float32) / nc
+    for r0 in range(0, nr, rows):
+        y = (numpy.arange(r0, min(nr, r0 + rows), dtype=numpy.float32) / nr)[:, None]
+        band = numpy.empty((len(y), nc, 3), numpy.uint8)
+        band[..., 0] = 255 * x
+        band[..., 1] = 255 * y
+        band[..., 2] = rng.integers(0, 32, (len(y), nc))
+        img.paste(Image.fromarray(band), (0, r0))
+    img.save(path)
+
+
+def peak_rss():
+    'Return peak resident memory in bytes of this process and its children'
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, kids) * scale
+
+
+def run_case(backend="image", size=1024, tile_size=254, tile_format="jpg",
+             jobs=1, cascade=False, workdir=None):
+    '''
+    Run one benchmark case in this process and return its record.
+
+    Stage times are the seconds summed over the stage timings of the
+    metrics registry, which is reset first.  With jobs > 1 they are
+    summed over the worker processes and may exceed the wall time.
+    '''
+    if backend not in backends:
+        raise ValueError(f'unknown backend: {backend}')
+    from PIL import Image
+    maxpix = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        return _run_case(backend, size, tile_size, tile_format, jobs, cascade, workdir)
+    finally:
+        Image.MAX_IMAGE_PIXELS = maxpix
+
+
+def _run_case(backend, size, tile_size, tile_format, jobs, cascade, workdir):
+    shape = (size, size)
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        tmp = Path(tmp)
+        src = tmp / ("source.npy" if backend == "array" else "source.png")
+        synthetic(src, shape, "array" if backend == "array" else "image")
+        out = tmp / "tiles"
+        pyramid = Pyramid(shape, tile_size, 1, tile_format)
+
+        registry.reset()
+        t0 = time.perf_counter()
+        if backend == "stream":
+            from .stream import open_source, StreamTiler
+            with timer("decode"):
+                source = open_source(src)
+            tiler = StreamTiler(pyramid, source)
+            tiler.save(out)
+        else:
+            if backend == "array":
+                from .array import Data
+                data = Data(src)
+            else:
+                from .image import Data
+                data = Data(src).load()
+            tiler = Tiler(pyramid, data, cascade=cascade)
+            tiler.save(out, jobs=jobs)
+        seconds = time.perf_counter() - t0
+        timings = registry.summary()["timings"]
+
+        ntiles = pyramid.ntiles
+        nbytes = sum([f.stat().st_size for f in out.glob("*/*")])
+    return dict(backend=backend, shape=list(shape), tile_size=tile_size,
+                format=tile_format, jobs=jobs, cascade=cascade,
+                tiles=ntiles, bytes=nbytes, seconds=seconds,
+                tiles_per_sec=ntiles / seconds,
+                pixels_per_sec=size * size / seconds,
+                stages={stage: timings[stage]["sum"] if stage in timings else 0.0
+                        for stage in stages},
+                dedup=tiler.dedup_stats, peak_rss=peak_rss())
+
+
+def run(backend=("image",), size=(1024,), tile_size=(254,), tile_format=("jpg",),
+        jobs=1, cascade=False, workdir=None):
+    '''
+    Run the product of the given cases, each in a fresh process,
+    and return the list of their records.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    ctx = multiprocessing.get_context("spawn")
+    ret = list()
+    for b in backend:
+        for s in size:
+            for ts in tile_size:
+                for fmt in tile_format:
+                    with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                        got = pool.submit(run_case, b, s, ts, fmt, jobs, cascade, workdir)
+                        ret.append(got.result())
+    return ret
+
+
+def dumps(records):
+    'Return records as JSON text'
+    return json.dumps(records, indent=1)
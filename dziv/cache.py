@@ -0,0 +1,150 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+def nbytes(obj):
+    '''
+    Return the size in bytes that obj holds.
+
+    Objects providing nbytes (Data, numpy arrays) report their own
+    size, bytes-like objects their length and anything else counts 0.
+    '''
+    n = getattr(obj, "nbytes", None)
+    if n is not None:
+        return n
+    try:
+        return len(memoryview(obj))
+    except TypeError:
+        return 0
+
+
+class LRU(object):
+    '''
+    A least recently used cache bounded by a budget in bytes.
+
+    A budget of None is unbounded.  An object larger than the budget
+    is returned but not held.
+
+    The cache may be shared by threads.  Concurrent misses on one key
+    are coalesced so that only one thread makes the object while the
+    others wait for it.
+    '''
+    def __init__(self, budget=None, sizer=nbytes):
+        self.budget = budget
+        self._sizer = sizer
+        self._items = OrderedDict()   # key -> (obj, size)
+        self._lock = threading.Lock()
+        self._making = dict()         # key -> Future
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, make=None):
+        '''
+        Return the object at key.
+
+        On a miss, make() is called to produce the object which is
+        then held.  Without make, a miss returns None.
+        '''
+        with self._lock:
+            got = self._items.get(key)
+            if got is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return got[0]
+            if make is None:
+                self.misses += 1
+                return None
+            making = self._making.get(key)
+            if making is None:
+                self.misses += 1
+                making = self._making[key] = Future()
+                mine = True
+            else:
+                self.waits += 1
+                mine = False
+        if not mine:
+            return making.result()
+
+        try:
+            obj = make()
+        except BaseException as err:
+            with self._lock:
+                del self._making[key]
+            making.set_exception(err)
+            raise
+        self.put(key, obj)
+        with self._lock:
+            del self._making[key]
+        making.set_result(obj)
+        return obj
+
+    def put(self, key, obj):
+        'Hold obj at key, evicting least recently used as needed'
+        size = self._sizer(obj)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.used -= old[1]
+            if self.budget is not None and size > self.budget:
+                return
+            self._items[key] = (obj, size)
+            self.used += size
+            self._shrink()
+
+    def _shrink(self):
+        if self.budget is None:
+            return
+        while self.used > self.budget and self._items:
+            key, (obj, size) = self._items.popitem(last=False)
+            self.used -= size
+            self.evictions += 1
+
+    def pop(self, key):
+        'Remove and return object at key or None'
+        with self._lock:
+            got = self._items.pop(key, None)
+            if got is None:
+                return None
+            self.used -= got[1]
+            return got[0]
+
+    def clear(self):
+        'Drop all held objects, counters are kept'
+        with self._lock:
+            self._items.clear()
+            self.used = 0
+
+    @property
+    def stats(self):
+        'Dictionary of counters'
+        return dict(budget=self.budget, used=self.used, items=len(self._items),
+                    hits=self.hits, misses=self.misses, waits=self.waits,
+                    evictions=self.evictions)
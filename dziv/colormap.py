@@ -0,0 +1,184 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+False color of array values through a lookup table.
+
+Values are scaled, normalized to a range found in one pass and used
+to index a table of uint8 RGBA colors.  Large arrays are processed in
+chunks of rows so temporary memory is bounded by the chunk size and
+the input is never modified.
+'''
+
+import functools
+
+import numpy
+
+scales = ("log", "linear")
+
+# parameters that select a Colormap
+style_keys = ("cmap", "scale", "eps", "vmin", "vmax")
+
+
+def _matplotlib():
+    'Return matplotlib which only coloring array values needs'
+    try:
+        import matplotlib
+    except ImportError:
+        raise ImportError('coloring array values needs matplotlib, '
+                          'install it with: pip install dziv[colormap]') from None
+    return matplotlib
+
+
+def lut(name="plasma", size=256):
+    '''
+    Return uint8 (size, 4) RGBA table sampling the named matplotlib colormap.
+    '''
+    matplotlib = _matplotlib()
+    cmap = matplotlib.colormaps[name]
+    if cmap.N != size:
+        cmap = cmap.resampled(size)
+    return numpy.uint8(cmap(numpy.arange(size)) * 255)
+
+
+def chunk_rows(ncols, pixels=1<<22):
+    'Return number of rows in a chunk of about pixels pixels'
+    return max(1, pixels // max(1, ncols))
+
+
+class Colormap(object):
+    '''
+    Map array values to colors.
+    '''
+    def __init__(self, name="plasma", scale="log", eps=10, vrange=None, size=256):
+        '''
+        Create a colormap of the named matplotlib colormap.
+
+        The scale is "log" for log10(value/eps), with values below
+        eps clipped to eps, or "linear".  The vrange of (min, max)
+        values maps to the ends of the colormap and may be set later
+        by fit().  The size is the number of colors in the table
+        which is made on first use so only coloring needs matplotlib.
+        '''
+        if scale not in scales:
+            raise ValueError(f'unknown scale: {scale}')
+        self.name = name
+        self.scale = scale
+        self.eps = eps
+        self.vrange = vrange
+        self._size = size
+
+    @functools.cached_property
+    def _lut(self):
+        return lut(self.name, self._size)
+
+    def scaled(self, arr):
+        'Return new float32 array of scaled values of arr'
+        arr = numpy.asarray(arr, dtype=numpy.float32)
+        if self.scale == "log":
+            ret = numpy.maximum(arr, self.eps)
+            ret /= self.eps
+            return numpy.log10(ret, out=ret)
+        return arr.copy()
+
+    def fit(self, arr):
+        '''
+        Set vrange to the range of finite values of arr, return self.
+        '''
+        lo, hi = numpy.inf, -numpy.inf
+        rows = chunk_rows(arr.shape[1] if arr.ndim > 1 else arr.size)
+        for r0 in range(0, arr.shape[0], rows):
+            chunk = numpy.asarray(arr[r0:r0+rows])
+            chunk = chunk[numpy.isfinite(chunk)]
+            if chunk.size:
+                lo = min(lo, float(chunk.min()))
+                hi = max(hi, float(chunk.max()))
+        self.vrange = (0.0, 1.0) if lo > hi else (lo, hi)
+        return self
+
+    def __call__(self, arr, out=None):
+        '''
+        Return uint8 RGBA colors of 2D arr, filling out if given.
+        '''
+        if self.vrange is None:
+            self.fit(arr)
+        lo, hi = [float(v) for v in self.scaled(numpy.array(self.vrange))]
+        if hi <= lo:
+            hi = lo + 1
+        size = len(self._lut)
+        if out is None:
+            out = numpy.empty(arr.shape + (4,), dtype=numpy.uint8)
+        rows = chunk_rows(arr.shape[1])
+        for r0 in range(0, arr.shape[0], rows):
+            ind = self.scaled(arr[r0:r0+rows])
+            ind -= lo
+            ind *= size / (hi - lo)
+            numpy.nan_to_num(ind, copy=False, nan=0.0)
+            numpy.clip(ind, 0, size - 1, out=ind)
+            numpy.take(self._lut, ind.astype(numpy.intp), axis=0, out=out[r0:r0+rows], mode='clip')
+        return out
+
+
+def parse_style(text):
+    '''
+    Return dict of style parameters from "key=value,key=value" text.
+    '''
+    ret = dict()
+    for one in text.split(","):
+        if not one:
+            continue
+        key, eq, val = one.partition("=")
+        if not eq:
+            raise ValueError(f'malformed style parameter: {one}')
+        ret[key] = val
+    return ret
+
+
+def style_key(params):
+    '''
+    Return a canonical, hashable tuple of (key, value) of style params.
+
+    Raises ValueError on unknown keys or invalid values.
+    '''
+    ret = list()
+    for key in sorted(params):
+        val = params[key]
+        if key == "cmap":
+            if val not in _matplotlib().colormaps:
+                raise ValueError(f'unknown colormap: {val}')
+        elif key == "scale":
+            if val not in scales:
+                raise ValueError(f'unknown scale: {val}')
+        elif key in style_keys:
+            val = float(val)
+        else:
+            raise ValueError(f'unknown style parameter: {key}')
+        ret.append((key, val))
+    return tuple(ret)
+
+
+@functools.lru_cache(maxsize=64)
+def from_style(key, vrange):
+    '''
+    Return Colormap of a style_key() with vrange giving the default
+    vmin and vmax.
+    '''
+    d = dict(key)
+    lo, hi = vrange
+    return Colormap(d.get("cmap", "plasma"), d.get("scale", "log"), d.get("eps", 10),
+                    (d.get("vmin", lo), d.get("vmax", hi)))
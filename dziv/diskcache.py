@@ -0,0 +1,226 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+A directory of encoded tiles that outlives the server.
+
+Tiles are filed under a key of the source content hash and the pyramid
+parameters so a changed source or pyramid never sees stale tiles and
+the same content served from another path shares them.  The content
+hash of a source is remembered by its size and modification time so a
+restart does not rehash it.
+
+Tiles are written to a temporary file then renamed into place so any
+number of server processes may share the directory.  A hit refreshes
+the file time and when the total size exceeds the budget the least
+recently used files are removed by whichever process holds the
+eviction lock.
+'''
+
+import os
+import json
+import fcntl
+import hashlib
+import threading
+from pathlib import Path
+
+from .cache import LRU
+from .manifest import fingerprint
+from .metrics import log, timer
+
+
+class DiskCache(object):
+    '''
+    Encoded tiles held in a directory, bounded in size.
+    '''
+    def __init__(self, directory, budget=None, low_water=0.9):
+        '''
+        Cache tiles in directory.
+
+        With budget in bytes, eviction removes the least recently used
+        files until they total at most low_water of the budget.
+        '''
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / "sources").mkdir(exist_ok=True)
+        self.budget = budget
+        self._low_water = low_water
+        self._keys = LRU()
+        self._lock = threading.Lock()
+        self.used = self._usage() if budget else 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _tiles(self):
+        'Iterate (path, stat) of all tile files'
+        for top in self.directory.iterdir():
+            if top.name == "sources" or not top.is_dir():
+                continue
+            for path in top.glob("*/*"):
+                if path.name.startswith("."):
+                    # being written
+                    continue
+                try:
+                    yield path, path.stat()
+                except FileNotFoundError:
+                    pass
+
+    def _stale(self):
+        'Iterate temporary files left by writers no longer running'
+        for path in self.directory.glob("**/.*.tmp"):
+            try:
+                # .name.pid.tid.tmp
+                os.kill(int(path.name.split(".")[-3]), 0)
+            except ProcessLookupError:
+                yield path
+            except (ValueError, IndexError, PermissionError):
+                pass
+
+    def _usage(self):
+        return sum([st.st_size for path, st in self._tiles()])
+
+    def source_key(self, path, pyramid):
+        '''
+        Return key of the content of the source file at path and the
+        pyramid parameters.
+        '''
+        path = Path(path).resolve()
+        st = path.stat()
+        ident = (str(path), st.st_size, st.st_mtime_ns,
+                 pyramid.tile_size, pyramid.tile_overlap, pyramid.tile_format)
+        return self._keys.get(ident, lambda: self._source_key(path, pyramid))
+
+    def _source_key(self, path, pyramid):
+        memo = self.directory / "sources" / (hashlib.sha1(str(path).encode()).hexdigest() + ".json")
+        previous = None
+        try:
+            previous = json.loads(memo.read_text())
+        except (OSError, ValueError):
+            pass
+        with timer("hash"):
+            fp = fingerprint(path, previous)
+        if fp != previous:
+            self._replace(memo, json.dumps(fp).encode())
+        ident = ':'.join(map(str, (fp["hash"], pyramid.tile_size, pyramid.tile_overlap,
+                                   pyramid.tile_format)))
+        return hashlib.sha1(ident.encode()).hexdigest()[:20]
+
+    def _path(self, key, name):
+        return self.directory / key / name
+
+    def _replace(self, path, data):
+        'Atomically make path hold data'
+        tmp = path.parent / f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+
+    def get(self, key, name, make=None):
+        '''
+        Return bytes of the tile name of source key.
+
+        On a miss, return None or, if given, the bytes from calling
+        make() after storing them.
+        '''
+        path = self._path(key, name)
+        try:
+            with timer("disk_read"):
+                data = path.read_bytes()
+        except FileNotFoundError:
+            data = None
+        if data is not None:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self.hits += 1
+            return data
+        with self._lock:
+            self.misses += 1
+        if make is None:
+            return None
+        data = make()
+        self.put(key, name, data)
+        return data
+
+    def put(self, key, name, data):
+        'Store bytes of the tile name of source key'
+        path = self._path(key, name)
+        try:
+            # another process may have stored it meanwhile
+            old = path.stat().st_size
+        except FileNotFoundError:
+            old = 0
+        try:
+            with timer("disk_write"):
+                path.parent.mkdir(parents=True, exist_ok=True)
+                self._replace(path, data)
+        except OSError as err:
+            # a full or read only cache only costs speed
+            log.warning('disk cache: can not write %s: %s', path, err)
+            return
+        with self._lock:
+            self.used += len(data) - old
+            over = self.budget is not None and self.used > self.budget
+        if over:
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used tiles to bring the total below the
+        low water mark, unless another process is already doing so.
+        Temporary files of crashed writers are removed too.
+        '''
+        with open(self.directory / ".evict.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                for path in self._stale():
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                files = sorted(self._tiles(), key=lambda one: one[1].st_mtime_ns)
+                used = sum([st.st_size for path, st in files])
+                target = self.budget * self._low_water
+                removed = 0
+                for path, st in files:
+                    if used <= target:
+                        break
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                    used -= st.st_size
+                    removed += 1
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        with self._lock:
+            self.used = used
+            self.evicted += removed
+        log.debug('disk cache: evicted %d tiles, %d bytes remain', removed, used)
+
+    @property
+    def stats(self):
+        'Dictionary of counters and sizes'
+        return dict(budget=self.budget, used=self.used, hits=self.hits,
+                    misses=self.misses, evicted=self.evicted)
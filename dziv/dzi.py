@@ -22,6 +22,78 @@ import xml.dom.minidom
 from math import (ceil, log)
 from pathlib import Path
 
+import numpy
+
+
+def tile_edges(npix, tile_size, tile_overlap):
+    '''
+    Return arrays of the first pixel and one past the last pixel of
+    each tile, with overlap, along a dimension of npix pixels.
+    '''
+    ntiles = ceil(npix / tile_size)
+    starts = numpy.arange(ntiles, dtype=numpy.int64) * tile_size
+    starts[1:] -= tile_overlap
+    stops = numpy.minimum(starts + tile_size + 2 * tile_overlap, npix)
+    if ntiles:
+        stops[0] = min(tile_size + tile_overlap, npix)
+    return starts, stops
+
+
+class Level(object):
+    '''
+    Geometry of the tiles of one pyramid level.
+
+    The rows and cols are each a pair of arrays, indexed by tile row
+    or column, of the first pixel and one past the last pixel of the
+    tiles.  Lookup of one tile is O(1).
+    '''
+    def __init__(self, level, shape, tile_size, tile_overlap, tile_format):
+        self.level = level
+        self.shape = shape
+        self.rows = tile_edges(shape[0], tile_size, tile_overlap)
+        self.cols = tile_edges(shape[1], tile_size, tile_overlap)
+        self.tiles = (len(self.rows[0]), len(self.cols[0]))
+        self._format = tile_format
+        self._row_slices = [slice(a, b) for a, b in zip(*[e.tolist() for e in self.rows])]
+        self._col_slices = [slice(a, b) for a, b in zip(*[e.tolist() for e in self.cols])]
+        self._names = None
+
+    def __len__(self):
+        return self.tiles[0] * self.tiles[1]
+
+    def has(self, loc):
+        'True if loc=(row,col) is a tile of this level'
+        irow, icol = loc
+        return 0 <= irow < self.tiles[0] and 0 <= icol < self.tiles[1]
+
+    def slices(self, loc):
+        'Bounding box of the tile at a valid loc=(row,col)'
+        irow, icol = loc
+        return (self._row_slices[irow], self._col_slices[icol])
+
+    def row_slices(self, irow):
+        '''
+        Return the rows slice of tile row irow and the list of the
+        cols slices of its tiles.
+        '''
+        return self._row_slices[irow], self._col_slices
+
+    def locs(self):
+        'Return (ntiles, 2) array of loc=(row,col) in column major order'
+        nr, nc = self.tiles
+        icol, irow = numpy.divmod(numpy.arange(nr * nc), nr)
+        return numpy.stack((irow, icol), axis=1)
+
+    def names(self):
+        'Return list of tile file names in column major order'
+        if self._names is None:
+            level, fmt = self.level, self._format
+            rows = range(self.tiles[0])
+            self._names = [f'{level}/{icol}_{irow}.{fmt}'
+                           for icol in range(self.tiles[1]) for irow in rows]
+        return self._names
+
+
 class Pyramid(object):
     '''
     Describe the pyramid of tiles of an image.
@@ -38,12 +110,37 @@ class Pyramid(object):
         self.tile_size = tile_size
         self.tile_overlap = tile_overlap
         self.tile_format = tile_format
+        self._key = None
+        self._levels = None
+
+    @property
+    def levels(self):
+        '''
+        List of Level geometry indexed by level.
+
+        It is made on first use and again only after the shape, tile
+        size, overlap or format change.
+        '''
+        key = (tuple(self.shape), self.tile_size, self.tile_overlap, self.tile_format)
+        if key != self._key:
+            shape = key[0]
+            depth = int(ceil(log(max(*shape), 2))) + 1
+            self._levels = [
+                Level(level, tuple([int(ceil(s * 0.5 ** (depth - 1 - level))) for s in shape]),
+                      self.tile_size, self.tile_overlap, self.tile_format)
+                for level in range(depth)]
+            self._key = key
+        return self._levels
 
     @property
     def depth(self):
         "The number of levels in the pyramid"
-        bigger = max(*self.shape)
-        return int(ceil(log(bigger, 2))) + 1
+        return len(self.levels)
+
+    @property
+    def ntiles(self):
+        "The number of tiles in all levels"
+        return sum([len(g) for g in self.levels])
 
     def scale(self, level):
         '''Scale of a pyramid level.
@@ -56,19 +153,27 @@ class Pyramid(object):
         return 0.5 ** (self.depth - 1 - level)
 
     def level_shape(self, level):
-        "The (nrows,ncols) number of tiles in a level"
-        scale = self.scale(level)
-        return tuple([int(ceil(s * scale)) for s in self.shape])
+        "The (nrows,ncols) number of pixels in a level"
+        self._vet_level(level)
+        return self.levels[level].shape
 
     def tiles_shape(self, level):
         "Number of tiles (nrows, ncols)"
-        nrc = self.level_shape(level)
-        return tuple([ceil(float(s) / self.tile_size) for s in nrc])
+        self._vet_level(level)
+        return self.levels[level].tiles
+
+    def level(self, level):
+        "The Level geometry of a level"
+        self._vet_level(level)
+        return self.levels[level]
 
     def slices(self, level, loc):
         """Bounding box of the tile at loc=(row,col) as (rows_slice, cols_slice)
         """
         self._vet_level(level)
+        g = self.levels[level]
+        if g.has(loc):
+            return g.slices(loc)
         ret = list()
         for dim, ls in zip(loc, self.level_shape(level)):
             offset = 0 if dim == 0 else self.tile_overlap
@@ -95,15 +200,15 @@ class Pyramid(object):
 
         loc order is column major.
         '''
-        for level in range(self.depth):
-            ls = self.tiles_shape(level)
-            for icol in range(ls[1]):
-                for irow in range(ls[0]):
-                    yield (level, (irow, icol))
+        for g in self.levels:
+            rows = range(g.tiles[0])
+            for icol in range(g.tiles[1]):
+                for irow in rows:
+                    yield (g.level, (irow, icol))
 
     def _vet_level(self, level):
         "Assure level is valid"
-        if 0 <= level and level < self.depth:
+        if 0 <= level and level < len(self.levels):
             return
         raise ValueError(f'invalid pyramid level: {level}')
 
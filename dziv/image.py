@@ -17,10 +17,14 @@
 # You should have received a copy of the GNU General Public License
 # along with Foobar. If not, see <https://www.gnu.org/licenses/>.
 
+import io
+import copy
+import threading
+from math import ceil
 from pathlib import Path
 from PIL import Image
 import numpy
-from matplotlib import cm
+from .metrics import log, timed, timer
 
 # pil is kind of annoying
 def pil_fmt(fmt):
@@ -32,59 +36,305 @@ def pil_fmt(fmt):
 # we are, after all, here to deal with large images.
 Image.MAX_IMAGE_PIXELS = 14400 * 14400
 
-def load(image):
+def load(image, colormap=None):
     '''
     Return an Image from file name or path.
+
+    A .npy file is false colored with the colormap.Colormap, by
+    default a log scaled plasma fit to the array values.
     '''
     if isinstance(image, Image.Image):
         return image
     if isinstance(image, str):
         image = Path(image)
     if image.name.endswith(".npy"):
-        arr = numpy.load(image)
-        print(arr.shape)
-        eps=10
-        arr[arr<eps] = eps
-        arr=numpy.log10(arr/eps)
-        vmin = numpy.min(arr)
-        vmax = numpy.max(arr)
-        arr = (arr-vmin) / (vmax-vmin)
-        arr[arr < 0.0] = 0.0
-        arr[arr > 1.0] = 1.0
-        return Image.fromarray(numpy.uint8(cm.plasma(arr)*255))
-        # return Image.fromarray(arr.astype('uint8'))
+        from .colormap import Colormap
+        arr = numpy.load(image, mmap_mode='r')
+        log.debug('coloring array %s of %s', image, arr.shape)
+        if colormap is None:
+            colormap = Colormap()
+        if colormap.vrange is None:
+            colormap = copy.copy(colormap).fit(arr)
+        return Image.fromarray(colormap(arr))
     return Image.open(image)
 
+def header_shape(path):
+    '''
+    Return the (nrows, ncols) of an image file reading only its header.
+    '''
+    with Image.open(path) as img:
+        return (img.size[1], img.size[0])
+
+def image_nbytes(img):
+    '''
+    Return the size in bytes of the pixel buffer of a PIL image.
+
+    PIL holds single band 8 bit pixels in one byte, 16 bit in two
+    and everything else (including multi-band 8 bit) in four.
+    '''
+    mode = img.mode
+    if mode in ("1", "L", "P"):
+        pixsize = 1
+    elif mode.startswith("I;16"):
+        pixsize = 2
+    else:
+        pixsize = 4
+    return img.size[0] * img.size[1] * pixsize
+
+def row_span(array):
+    '''
+    Return a contiguous uint8 array spanning the rows of pixels in
+    array and the bytes from one row to the next, 0 if they abut.
+
+    A view of a region of a larger array spans its rows without a
+    copy, other layouts are copied.
+    '''
+    rowbytes = array.itemsize * int(numpy.prod(array.shape[1:]))
+    rows_contiguous = (array.strides[-1] == array.itemsize and
+                       (array.ndim < 3 or array.strides[1] == array.itemsize * array.shape[2]))
+    if array.flags.c_contiguous or not (array.size and rows_contiguous
+                                        and array.strides[0] > rowbytes):
+        array = numpy.ascontiguousarray(array)
+        return array.reshape(-1).view(numpy.uint8), 0
+    span = array.strides[0] * (array.shape[0] - 1) + rowbytes
+    flat = numpy.lib.stride_tricks.as_strided(array.view(numpy.uint8), (span,), (1,))
+    return flat, array.strides[0]
+
+def from_array(array, meta, interpolation = "bicubic"):
+    '''
+    Return a Data from pixels in array as produced by Data.share().
+
+    The meta dict restores what the bare pixels lack so that the
+    result encodes exactly as the original image would.
+    '''
+    mode = meta["mode"]
+    if mode == "1":
+        img = Image.fromarray(array)
+    else:
+        size = (array.shape[1], array.shape[0])
+        buf, stride = row_span(array)
+        if stride:
+            # rows of a region, copied once
+            img = Image.frombytes(mode, size, buf, "raw", mode, stride, 1)
+        else:
+            # PIL maps some modes (eg L, RGBA) in place, copies others once
+            img = Image.frombuffer(mode, size, buf, "raw", mode, 0, 1)
+    palette = meta.get("palette")
+    if palette:
+        img.putpalette(palette[1], palette[0])
+    img.info = dict(meta["info"])
+    return Data(img, interpolation)
+
 class Data(object):
     '''
     Adapt PIL image to dzi data model.
     '''
-    def __init__(self, image, interpolation = "bicubic"):
-        self._image = load(image)
+    def __init__(self, image, interpolation = "bicubic", colormap = None, draft = True):
+        '''
+        Create a Data from a PIL image or an image file.
+
+        An image file is decoded on first use of its pixels.  With
+        draft, a JPEG file zoomed by 1/2 or less is instead decoded at
+        a reduced scale of 1/2, 1/4 or 1/8 (see PIL Image.draft()).
+        '''
+        self._image = load(image, colormap)
         s = self._image.size
         self.shape = (s[1], s[0])
         self._interpolation = interpolation
+        self._path = None
+        self._decoded = True
+        if isinstance(image, (str, Path)):
+            self._decoded = False
+            self._lock = threading.Lock()
+            if draft and self._image.format == "JPEG":
+                self._path = Path(image)
+                self._drafts = dict()
+
+    def _full(self):
+        'Return the image, decoding it if needed, once, safe for threads'
+        if self._decoded:
+            return self._image
+        with self._lock:
+            if not self._decoded:
+                with timer("decode"):
+                    self._image.load()
+                self._decoded = True
+        return self._image
+
+    def load(self):
+        '''
+        Decode the image now rather than on first use.
+        '''
+        self._full()
+        return self
+
+    def _drafted(self, size):
+        '''
+        Return the JPEG image decoded at the smallest reduced scale
+        at least size=(width,height) or None.
+        '''
+        if self._path is None or min(size) < 1:
+            return None
+        width, height = self._image.size
+        factor = min(width // size[0], height // size[1])
+        if factor < 2:
+            return None
+        factor = min(8, 1 << (factor.bit_length() - 1))
+        with self._lock:
+            img = self._drafts.get(factor)
+            if img is None:
+                with timer("decode"):
+                    img = Image.open(self._path)
+                    img.draft(img.mode, (width // factor, height // factor))
+                    img.load()
+                log.debug('decoded %s at 1/%d scale', self._path, factor)
+                self._drafts[factor] = img
+        return img
 
+    @property
+    def nbytes(self):
+        '''
+        Size in bytes of the decoded pixel buffer.
+        '''
+        return image_nbytes(self._image)
+
+    @property
+    def held_nbytes(self):
+        '''
+        Size in bytes of the pixels decoded so far, the full image
+        once decoded and any reduced scale JPEG drafts.
+        '''
+        held = self.nbytes if self._decoded else 0
+        if self._path is not None:
+            with self._lock:
+                held += sum([image_nbytes(img) for img in self._drafts.values()])
+        return held
+
+    @timed("zoom")
     def zoom(self, shape):
         '''
         Return a new Data scaled to fit shape.
         '''
         sz = (shape[1],shape[0])
         filt = getattr(Image, self._interpolation.upper())
-        print(f'zoom {self.shape} to {shape} size={self._image.size}')
-        newimg = self._image.resize(sz, filt)
+        log.debug('zoom %s to %s', self.shape, shape)
+        img = self._drafted(sz) or self._full()
+        newimg = img.resize(sz, filt)
+        return Data(newimg, self._interpolation)
+
+    @timed("zoom")
+    def zoom_box(self, shape, box):
+        '''
+        Return a new Data of shape zoomed from a box of this data.
+
+        The box is (left, upper, right, lower) in (fractional) pixels
+        of this data.  Only pixels in the box and those within the
+        interpolation filter support around it are read, so the result
+        matches the same region of zoom() to the full level shape.
+        '''
+        sz = (shape[1],shape[0])
+        filt = getattr(Image, self._interpolation.upper())
+        width, height = self._image.size
+        scale = min(sz[0] / max(box[2] - box[0], 1e-9), sz[1] / max(box[3] - box[1], 1e-9))
+        img = self._drafted((ceil(width * scale), ceil(height * scale)))
+        if img is None:
+            img = self._full()
+        else:
+            fx = img.size[0] / width
+            fy = img.size[1] / height
+            box = (box[0] * fx, box[1] * fy, box[2] * fx, box[3] * fy)
+        newimg = img.resize(sz, filt, box=box)
+        return Data(newimg, self._interpolation)
+
+    @timed("zoom")
+    def reduce(self, factor=2):
+        '''
+        Return a new Data reduced by an integer factor.
+
+        Each factor x factor block of pixels is averaged.  Partial
+        blocks at the bottom and right edges are averaged over the
+        pixels they hold so the new shape is rounded up.
+        '''
+        try:
+            newimg = self._full().reduce(factor)
+        except ValueError:
+            # some modes (eg palette) can not be block averaged
+            shape = tuple([int(ceil(s / factor)) for s in self.shape])
+            return self.zoom(shape)
         return Data(newimg, self._interpolation)
 
+    @timed("crop")
     def crop(self, slices):
         '''
         Return a new Data in slices 
         '''
         sr, sc = slices
         box = (sc.start, sr.start, sc.stop,  sr.stop)
-        print(f'crop shape:{self.shape} size:{self._image.size} to box:{box}')
-        newimg = self._image.crop(box)
+        newimg = self._full().crop(box)
         return Data(newimg, self._interpolation)
 
+    def asarray(self):
+        'Return the pixels as a numpy array'
+        return numpy.asarray(self._full())
+
+    @timed("dedup")
+    def uniform(self):
+        '''
+        Return a key of the mode, shape and value if all pixels have
+        the same value, else None.
+        '''
+        img = self._full()
+        ext = img.getextrema()
+        if len(img.getbands()) == 1:
+            ext = (ext,)
+        if any([lo != hi for lo, hi in ext]):
+            return None
+        return (img.mode, self.shape, tuple([lo for lo, hi in ext]))
+
+    def paste(self, other, corner):
+        '''
+        Overwrite the region of self at corner=(row,col) with other Data.
+        '''
+        row, col = corner
+        self._full().paste(other._full(), (col, row))
+
+    def share(self, rows=256):
+        '''
+        Copy pixels to shared memory.
+
+        Return a shared.Array and a meta dict which from_array() may
+        use to make an equivalent Data from (part of) the array in
+        another process.  Caller must eventually unlink the array.
+
+        The copy is done in bands of rows to limit temporary memory.
+        '''
+        from .shared import Array
+        shared = Array.create(*self.layout())
+        self.fill(shared.array, rows)
+        return shared, self.meta()
+
+    def layout(self):
+        'Return (shape, dtype) of the pixels as a numpy array'
+        img = self._full()
+        first = numpy.asarray(img.crop((0, 0, img.size[0], 1)))
+        return self.shape + first.shape[2:], first.dtype
+
+    def fill(self, array, rows=256):
+        'Copy pixels into an array of layout() in bands of rows'
+        img = self._full()
+        for r0 in range(0, self.shape[0], rows):
+            r1 = min(r0 + rows, self.shape[0])
+            array[r0:r1] = numpy.asarray(img.crop((0, r0, img.size[0], r1)))
+
+    def meta(self):
+        'Return dict of what from_array() needs besides the pixels'
+        img = self._full()
+        meta = dict(mode=img.mode, info=dict(img.info), palette=None)
+        if img.palette is not None:
+            pmode = img.palette.mode
+            meta["palette"] = (pmode, img.getpalette(pmode))
+        return meta
+
     def save(self, tgt, fmt=None):
         '''
         Save self to target.
@@ -97,9 +347,100 @@ class Data(object):
             tgt = Path(tgt)
         if isinstance(tgt, Path):
             if not tgt.parent.exists():
-                tgt.parent.mkdir(parents=True)
+                # parallel writers may race to make it
+                tgt.parent.mkdir(parents=True, exist_ok=True)
             if fmt is None:
                 fmt = tgt.suffix[1:]
         fmt = pil_fmt(fmt)
-        print(f'saving: {tgt} {fmt}')
-        self._image.save(tgt, format=fmt)
+        if not isinstance(tgt, Path):
+            with timer("encode"):
+                self._full().save(tgt, format=fmt)
+            return
+        with timer("encode"):
+            fp = io.BytesIO()
+            self._full().save(fp, format=fmt)
+        with timer("write"):
+            tgt.write_bytes(fp.getbuffer())
+
+
+class Pixels(object):
+    '''
+    Adapt an array of image pixels, eg memory mapped, to dzi data model.
+
+    Crops are views so a tile costs no copy until it is encoded.  The
+    meta is as from Data.meta().  Zooms work on an image.Data of just
+    the pixels they read, copied at most once into PIL's layout.
+    '''
+    def __init__(self, array, meta, interpolation = "bicubic"):
+        self._array = array
+        self._meta = meta
+        self._interpolation = interpolation
+        self.shape = array.shape[:2]
+
+    @property
+    def nbytes(self):
+        'Size in bytes of the pixels, which may be shared'
+        return self._array.nbytes
+
+    def load(self):
+        'Nothing to decode, return self'
+        return self
+
+    def asarray(self):
+        'Return the pixel array'
+        return self._array
+
+    def image(self):
+        'Return an image.Data of the pixels, shared if PIL can map them'
+        return from_array(self._array, self._meta, self._interpolation)
+
+    @timed("crop")
+    def crop(self, slices):
+        '''
+        Return a new Pixels in slices as a view of these.
+        '''
+        sr, sc = slices
+        return Pixels(self._array[sr, sc], self._meta, self._interpolation)
+
+    def zoom(self, shape):
+        return self.image().zoom(shape)
+
+    def zoom_box(self, shape, box):
+        '''
+        Return an image.Data as image.Data.zoom_box() copying only
+        the box and the filter support around it.
+        '''
+        left, upper, right, lower = box
+        step = max((right - left) / max(shape[1], 1), (lower - upper) / max(shape[0], 1), 1)
+        # widest PIL filter (lanczos) reaches 3 output pixels
+        pad = int(ceil(3 * step)) + 1
+        r0 = max(int(upper) - pad, 0)
+        c0 = max(int(left) - pad, 0)
+        r1 = min(int(ceil(lower)) + pad, self.shape[0])
+        c1 = min(int(ceil(right)) + pad, self.shape[1])
+        region = from_array(self._array[r0:r1, c0:c1], self._meta, self._interpolation)
+        return region.zoom_box(shape, (left - c0, upper - r0, right - c0, lower - r0))
+
+    def reduce(self, factor=2):
+        return self.image().reduce(factor)
+
+    @timed("dedup")
+    def uniform(self):
+        '''
+        Return a key of the mode, shape and value if all pixels have
+        the same value, else None.
+        '''
+        arr = self._array
+        if not arr.size:
+            return None
+        flat = arr.reshape((-1, arr.shape[2]) if arr.ndim == 3 else (-1, 1))
+        first = flat[0]
+        if not (flat == first).all():
+            return None
+        return (self._meta["mode"], self.shape, tuple(first.tolist()))
+
+    def save(self, tgt, fmt=None):
+        '''
+        Save as image.Data.save().
+        '''
+        self.image().save(tgt, fmt)
@@ -0,0 +1,287 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+A manifest of completed tiles allows tiling to resume.
+
+The manifest is a file of JSON lines in the tile directory.  The first
+line records the source fingerprint, the pyramid parameters and any
+tiling options.  Each following line records one written tile by its
+file name, size and hash.  Lines are appended as tiles are written so
+an interrupted run leaves a usable manifest.
+'''
+
+import io
+import os
+import json
+import hashlib
+from pathlib import Path
+
+from .metrics import timer
+
+filename = "dziv-manifest.jsonl"
+
+
+def digest(data):
+    'Return hash of bytes'
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(path, blksize=1<<20):
+    'Return hash of file content'
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fp:
+        while True:
+            got = fp.read(blksize)
+            if not got:
+                break
+            h.update(got)
+    return h.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    '''
+    Return dictionary identifying the content of the file at path.
+
+    The content hash is only computed if size or modification time
+    differ from a previous fingerprint.
+    '''
+    path = Path(path)
+    st = path.stat()
+    fp = dict(name=path.name, size=st.st_size, mtime=st.st_mtime_ns)
+    if previous and all([previous.get(k) == fp[k] for k in ("size", "mtime")]):
+        fp["hash"] = previous.get("hash")
+    else:
+        fp["hash"] = file_digest(path)
+    return fp
+
+
+class Manifest(object):
+    '''
+    Record tiles written to a directory and tell which need writing.
+    '''
+    def __init__(self, directory, source, pyramid, options=None, verify=False):
+        '''
+        Open the manifest in directory for tiling source into pyramid.
+
+        The options are anything else that changes the tiles.  Prior
+        records are kept only if source, pyramid and options are
+        unchanged and the tile file still exists with the recorded
+        size (and, with verify, hash).  Otherwise tiles listed in an
+        invalid manifest are removed.
+        '''
+        self.directory = Path(directory)
+        self.path = self.directory / filename
+        self._done = dict()
+        self.kept = 0
+        self.dropped = 0
+
+        old_header, old_tiles = self._read()
+        self.header = dict(source=fingerprint(source, old_header and old_header.get("source")),
+                           pyramid=pyramid.as_dict(), options=options or dict())
+        if old_header == self.header:
+            for name, (size, hsh) in old_tiles.items():
+                if self._check(name, size, hsh if verify else None):
+                    self._done[name] = (size, hsh)
+                    self.kept += 1
+                else:
+                    self.dropped += 1
+        else:
+            for name in old_tiles:
+                tile = self.directory / name
+                if tile.exists():
+                    tile.unlink()
+            self.dropped = len(old_tiles)
+
+        self._write_all()
+        self._fp = open(self.path, "a")
+
+    def _read(self):
+        'Return header and dict of tiles from existing manifest'
+        tiles = dict()
+        if not self.path.exists():
+            return None, tiles
+        header = None
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue    # likely cut off by a crash
+                if header is None:
+                    header = rec
+                    continue
+                tiles[rec["t"]] = (rec["n"], rec["h"])
+        return header, tiles
+
+    def _check(self, name, size, hsh=None):
+        path = self.directory / name
+        try:
+            if path.stat().st_size != size:
+                return False
+        except FileNotFoundError:
+            return False
+        if hsh is None:
+            return True
+        return file_digest(path) == hsh
+
+    def _write_all(self):
+        'Atomically rewrite compact manifest'
+        if not self.directory.exists():
+            self.directory.mkdir(parents=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as fp:
+            fp.write(json.dumps(self.header) + "\n")
+            for name, (size, hsh) in self._done.items():
+                fp.write(json.dumps(dict(t=name, n=size, h=hsh)) + "\n")
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self._done)
+
+    def __contains__(self, name):
+        'True if tile file name is done'
+        return name in self._done
+
+    def get(self, name):
+        'Return (size, hash) of the done tile file name or None'
+        return self._done.get(name)
+
+    def add(self, name, size, hsh):
+        'Record tile file name as written'
+        self._done[name] = (size, hsh)
+        self._fp.write(json.dumps(dict(t=name, n=size, h=hsh)) + "\n")
+
+    def add_all(self, records):
+        'Record list of (name, size, hash) and flush'
+        for rec in records:
+            self.add(*rec)
+        self.flush()
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        'Close and compact the manifest'
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+        self._write_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Recorder(object):
+    '''
+    A writer noting the size and hash of the tiles it writes so they
+    need not be read back.
+
+    Tiles are encoded here and the bytes are handed to the wrapped
+    writer if it takes them (a submit(path, bytes) as output.Pipeline
+    has) or else written in line by the default tile.write.  Any
+    other writer writes the tile itself, which is then read back.
+
+    Records are added to the manifest, or without one kept in the
+    records dict of name to (size, hash), only after flush() drains
+    the wrapped writer, so no tile is recorded before it is written.
+    This happens every batch tiles and whenever the tiler drains its
+    writer (eg, at the end of each level).
+    '''
+    def __init__(self, writer, directory, manifest=None, batch=1024):
+        from .tile import write, link
+        self._writer = writer
+        self._directory = Path(directory)
+        self._manifest = manifest
+        self._batch = batch
+        self._submit = getattr(writer, "submit", None)
+        if self._submit is None and writer is write:
+            self._submit = _write_encoded
+        self._link = getattr(writer, "link", link)
+        self._pending = list()
+        self.records = dict()
+
+    def _name(self, path):
+        return Path(path).relative_to(self._directory).as_posix()
+
+    def __call__(self, data, path):
+        path = Path(path)
+        name = self._name(path)
+        if self._submit is None:
+            self._writer(data, path)
+            self._pending.append((name, None, None))
+        else:
+            fp = io.BytesIO()
+            data.save(fp, path.suffix[1:])
+            buf = fp.getbuffer()
+            with timer("hash"):
+                rec = (name, len(buf), digest(buf))
+            self._submit(path, buf)
+            self._pending.append(rec)
+        if len(self._pending) >= self._batch:
+            self.flush()
+
+    def link(self, path, other):
+        'Link path to the written other as the wrapped writer does'
+        saved = self._link(path, other)
+        self._pending.append((self._name(path), self._name(other)))
+        return saved
+
+    def flush(self):
+        'Drain the wrapped writer then keep and add pending records'
+        from .tile import drain
+        drain(self._writer)
+        pending, self._pending = self._pending, list()
+        done = self.records if self._manifest is None else dict()
+        for rec in pending:
+            if len(rec) == 2:
+                # a link shares the record of its earlier written tile
+                name, other = rec
+                got = done.get(other)
+                if got is None:
+                    got = self._manifest.get(other)
+                done[name] = got
+            elif rec[1] is None:
+                done[rec[0]] = _file_record(self._directory / rec[0])
+            else:
+                done[rec[0]] = rec[1:]
+        if self._manifest is not None and done:
+            self._manifest.add_all([(name,) + got for name, got in done.items()])
+
+
+def _write_encoded(path, buf):
+    'Write encoded tile bytes as tile.write would'
+    path = Path(path)
+    if path.is_file() and path.stat().st_nlink > 1:
+        # do not write through to the other links of a shared tile
+        path.unlink()
+    if not path.parent.exists():
+        # parallel writers may race to make it
+        path.parent.mkdir(parents=True, exist_ok=True)
+    with timer("write"):
+        path.write_bytes(buf)
+
+
+def _file_record(path):
+    'Return (size, hash) of a written file'
+    data = path.read_bytes()
+    return len(data), digest(data)
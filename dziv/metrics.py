@@ -0,0 +1,187 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Counters and timing histograms of the stages of tiling.
+
+Stages (decode, zoom, crop, dedup, encode, write, ...) are timed into
+histograms and events are counted in the module level registry.  Its
+summary() is a JSON-able dict and prometheus() is the Prometheus text
+exposition format.  Both are cheap enough to leave on.
+
+Diagnostic messages go to the "dziv" logger, silent by default.
+'''
+
+import time
+import bisect
+import logging
+import threading
+import functools
+import contextlib
+
+log = logging.getLogger("dziv")
+
+# upper bounds in seconds of histogram buckets
+buckets = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0, float("inf"))
+
+
+class Histogram(object):
+    '''
+    Counts of observed values in buckets with their count and sum.
+    '''
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        'Add counts of the as_dict() of another histogram'
+        for ind, num in enumerate(other["counts"]):
+            self.counts[ind] += num
+        self.count += other["count"]
+        self.sum += other["sum"]
+
+    def as_dict(self):
+        return dict(count=self.count, sum=self.sum, counts=list(self.counts))
+
+
+class Registry(object):
+    '''
+    Named counters and stage timing histograms.
+
+    The registry may be shared by threads.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict()
+        self.timings = dict()
+
+    def count(self, name, num=1):
+        'Add num to the named counter'
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def observe(self, stage, seconds):
+        'Add a duration of the stage'
+        with self._lock:
+            hist = self.timings.get(stage)
+            if hist is None:
+                hist = self.timings[stage] = Histogram()
+            hist.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        'Context timing its body as the stage'
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def timed(self, stage):
+        'Decorator timing each call as the stage'
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwds):
+                t0 = time.perf_counter()
+                try:
+                    return func(*args, **kwds)
+                finally:
+                    self.observe(stage, time.perf_counter() - t0)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+    def summary(self):
+        '''
+        Return a dict of counters and of per stage count, total seconds
+        and bucket counts.  The buckets are the finite upper bounds,
+        the last count is of those above them all.
+        '''
+        with self._lock:
+            return dict(counters=dict(self.counters), buckets=list(buckets[:-1]),
+                        timings={stage: hist.as_dict() for stage, hist in self.timings.items()})
+
+    def merge(self, summary):
+        'Add in the summary() of another registry, eg of a worker process'
+        with self._lock:
+            for name, num in summary["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + num
+            for stage, other in summary["timings"].items():
+                hist = self.timings.get(stage)
+                if hist is None:
+                    hist = self.timings[stage] = Histogram()
+                hist.merge(other)
+
+    def prometheus(self, gauges=None, counters=None, prefix="dziv"):
+        '''
+        Return Prometheus text exposition of counters, timings and any
+        further gauges and counters given as dicts of name to value.
+        '''
+        summ = self.summary()
+        summ["counters"].update(counters or dict())
+        lines = list()
+        name = f'{prefix}_stage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for stage, hist in sorted(summ["timings"].items()):
+            cum = 0
+            for le, num in zip(buckets, hist["counts"]):
+                cum += num
+                le = "+Inf" if le == float("inf") else repr(le)
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cum}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {hist["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {hist["count"]}')
+        for cname, num in sorted(summ["counters"].items()):
+            lines.append(f'# TYPE {prefix}_{cname}_total counter')
+            lines.append(f'{prefix}_{cname}_total {num}')
+        for gname, val in sorted((gauges or dict()).items()):
+            lines.append(f'# TYPE {prefix}_{gname} gauge')
+            lines.append(f'{prefix}_{gname} {val}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+count = registry.count
+timer = registry.timer
+timed = registry.timed
+
+
+def cache_metrics(name, stats):
+    '''
+    Return dicts of gauges and of counters from LRU.stats of the
+    named cache.
+    '''
+    gauges = dict()
+    counters = dict()
+    for key, val in stats.items():
+        if val is None:
+            continue
+        if key in ("budget", "used", "items"):
+            gauges[f'{name}_cache_{key}'] = val
+        else:
+            counters[f'{name}_cache_{key}'] = val
+    return gauges, counters
@@ -0,0 +1,187 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Overlap encoding tiles with writing them.
+
+Tiles are encoded to bytes in memory by the tiler and handed through
+a bounded queue to a pool of writer threads so that making tiles does
+not wait on a slow (eg, network or parallel) file system.  Each
+directory is made once rather than checked for each tile.
+'''
+
+import io
+import os
+import threading
+import functools
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .tile import link
+from .metrics import count, timer
+
+
+class Pipeline(object):
+    '''
+    A tile writer encoding in the caller and writing in the background.
+
+    Use flush() to wait for all pending writes and close() when done.
+    '''
+    def __init__(self, writers=4, queue=64, fsync=0):
+        '''
+        Write with a pool of writers threads.
+
+        At most queue encoded tiles wait to be written, beyond that
+        the caller stalls.  With fsync > 0, written files and their
+        directories are synced in batches of that many files.
+
+        Only this configuration is pickled so each process of a
+        parallel tiling runs its own writer threads.
+        '''
+        self.writers = writers
+        self.queue = queue
+        self.fsync = fsync
+        self._pool = None
+
+    def __getstate__(self):
+        return dict(writers=self.writers, queue=self.queue, fsync=self.fsync)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start(self):
+        self._pool = ThreadPoolExecutor(self.writers, thread_name_prefix="dziv-write")
+        self._slots = threading.Semaphore(self.queue)
+        self._lock = threading.Lock()
+        self._pending = dict()  # path -> future of its write
+        self._unsynced = list()
+        self._dirs = set()
+        self._error = None
+
+    def __call__(self, data, path):
+        path = Path(path)
+        fp = io.BytesIO()
+        data.save(fp, path.suffix[1:])
+        self.submit(path, fp.getbuffer())
+
+    def submit(self, path, buf):
+        '''
+        Queue bytes to be written to path, stalling while the queue
+        is full.
+        '''
+        if self._pool is None:
+            self._start()
+        self._check()
+        if not self._slots.acquire(blocking=False):
+            count("write_stalls")
+            with timer("stall"):
+                self._slots.acquire()
+        with self._lock:
+            fut = self._pool.submit(self._write, path, buf)
+            self._pending[path] = fut
+        fut.add_done_callback(functools.partial(self._done, path))
+
+    def _done(self, path, fut):
+        with self._lock:
+            if self._pending.get(path) is fut:
+                del self._pending[path]
+            if fut.exception() is not None and self._error is None:
+                self._error = fut.exception()
+        self._slots.release()
+
+    def _check(self):
+        'Raise the first error of a background write'
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+    def _write(self, path, buf):
+        with timer("write"):
+            parent = path.parent
+            if parent not in self._dirs:
+                parent.mkdir(parents=True, exist_ok=True)
+                self._dirs.add(parent)
+            try:
+                if os.stat(path).st_nlink > 1:
+                    # do not write through to the other links of a shared tile
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+            with open(path, "wb") as fp:
+                fp.write(buf)
+        count("written_bytes", len(buf))
+        if not self.fsync:
+            return
+        with self._lock:
+            self._unsynced.append(path)
+            if len(self._unsynced) < self.fsync:
+                return
+            batch, self._unsynced = self._unsynced, list()
+        self._sync(batch)
+
+    def _sync(self, paths):
+        with timer("fsync"):
+            for path in paths + sorted(set([p.parent for p in paths])):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def link(self, path, other):
+        '''
+        Make path share the file other once it is written, return
+        bytes saved.
+        '''
+        if self._pool is not None:
+            with self._lock:
+                fut = self._pending.get(Path(other))
+            if fut is not None:
+                wait([fut])
+        return link(path, other)
+
+    def flush(self):
+        '''
+        Wait for all pending writes (and syncs) to finish.
+        '''
+        if self._pool is None:
+            return
+        with self._lock:
+            futs = list(self._pending.values())
+        wait(futs)
+        with self._lock:
+            batch, self._unsynced = self._unsynced, list()
+        if batch:
+            self._sync(batch)
+        self._check()
+
+    def close(self):
+        'Flush and stop the writer threads'
+        if self._pool is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,202 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+A packed pyramid holds all encoded tiles in one file.
+
+The file is laid out as:
+
+- magic (8 bytes)
+- encoded tiles, concatenated in the order written
+- DZI XML of the pyramid
+- index of (offset, length) per tile ordered as Pyramid.visit
+- footer of (dzi offset, dzi length, index offset, number of tiles, magic)
+
+Missing tiles have zero length.  Identical tiles may share one entry
+of encoded bytes.
+'''
+
+import io
+import mmap
+import struct
+from pathlib import Path
+
+import numpy
+
+from .dzi import load as load_dzi
+
+magic = b"DZIVPK01"
+footer = struct.Struct("<QQQQ8s")
+index_dtype = numpy.dtype([("offset", "<u8"), ("length", "<u4")])
+
+
+def ordinals(pyramid):
+    '''
+    Return the index position of the first tile of each level.
+
+    Tiles of a level follow in column major order as Pyramid.visit.
+    '''
+    ret = list()
+    count = 0
+    for level in range(pyramid.depth):
+        ret.append(count)
+        nr, nc = pyramid.tiles_shape(level)
+        count += nr * nc
+    ret.append(count)
+    return ret
+
+
+def parse_filename(path):
+    '''
+    Return (level, (row, col)) from a tile path ending in level/col_row.fmt
+    '''
+    path = Path(path)
+    col, row = path.stem.split("_")
+    return int(path.parent.name), (int(row), int(col))
+
+
+class PackWriter(object):
+    '''
+    Write tiles to a packed pyramid file.
+
+    This may be used as a Tiler.save() writer.  It must run in the
+    process that made it and so it marks itself as serial.
+    '''
+    serial = True
+
+    def __init__(self, path, pyramid):
+        self._path = Path(path)
+        self._pyramid = pyramid
+        self._first = ordinals(pyramid)
+        self._index = numpy.zeros(self._first[-1], dtype=index_dtype)
+        if not self._path.parent.exists():
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._fp = open(self._path, "wb")
+        self._fp.write(magic)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __call__(self, data, path):
+        'Encode and add data as the tile named by path'
+        level, loc = parse_filename(path)
+        fp = io.BytesIO()
+        data.save(fp, self._pyramid.tile_format)
+        self.add(level, loc, fp.getvalue())
+
+    def link(self, path, other):
+        '''
+        Make the tile named by path an alias of the already added
+        tile named by other.  Return the number of bytes saved.
+        '''
+        ind = self._ordinal(*parse_filename(path))
+        self._index[ind] = self._index[self._ordinal(*parse_filename(other))]
+        return int(self._index[ind]["length"])
+
+    def _ordinal(self, level, loc):
+        nr, nc = self._pyramid.tiles_shape(level)
+        row, col = loc
+        return self._first[level] + col * nr + row
+
+    def add(self, level, loc, encoded):
+        'Add encoded tile bytes at level and loc=(row,col)'
+        self._index[self._ordinal(level, loc)] = (self._fp.tell(), len(encoded))
+        self._fp.write(encoded)
+
+    def close(self):
+        'Write the DZI, index and footer'
+        if self._fp is None:
+            return
+        fp = self._fp
+        dzi = self._pyramid.as_xml().toxml(encoding="UTF-8")
+        dzi_offset = fp.tell()
+        fp.write(dzi)
+        index_offset = fp.tell()
+        fp.write(self._index.tobytes())
+        fp.write(footer.pack(dzi_offset, len(dzi), index_offset, len(self._index), magic))
+        fp.close()
+        self._fp = None
+
+
+class Pack(object):
+    '''
+    Read a packed pyramid through a memory map.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        if len(mm) < len(magic) + footer.size or mm[:len(magic)] != magic:
+            raise ValueError(f'not a packed pyramid: {path}')
+        dzi_offset, dzi_length, index_offset, ntiles, tail = footer.unpack(mm[-footer.size:])
+        if tail != magic:
+            raise ValueError(f'truncated packed pyramid: {path}')
+        self.pyramid = load_dzi(io.BytesIO(mm[dzi_offset:dzi_offset+dzi_length]))
+        self._first = ordinals(self.pyramid)
+        if ntiles != self._first[-1]:
+            raise ValueError(f'corrupt packed pyramid index: {path}')
+        self._index = numpy.frombuffer(mm, dtype=index_dtype, count=ntiles, offset=index_offset)
+
+    def tile(self, level, loc):
+        '''
+        Return encoded bytes of tile at level and loc=(row,col) as a
+        memoryview of the map, not a copy.
+
+        Raises KeyError if there is no such tile.
+        '''
+        p = self.pyramid
+        if level < 0 or level >= p.depth:
+            raise KeyError(f'no level {level}')
+        nr, nc = p.tiles_shape(level)
+        row, col = loc
+        if row < 0 or row >= nr or col < 0 or col >= nc:
+            raise KeyError(f'no tile {loc} in level {level}')
+        offset, length = self._index[self._first[level] + col * nr + row]
+        if not length:
+            raise KeyError(f'missing tile {loc} in level {level}')
+        return memoryview(self._mm)[offset:offset+length]
+
+    def unpack(self, directory):
+        '''
+        Write tiles to the usual DZI directory tree.
+        '''
+        directory = Path(directory)
+        for level, loc in self.pyramid.visit:
+            try:
+                data = self.tile(level, loc)
+            except KeyError:
+                continue
+            path = directory / self.pyramid.filename(level, loc)
+            if not path.parent.exists():
+                path.parent.mkdir(parents=True)
+            path.write_bytes(data)
+
+    def close(self):
+        '''
+        Release the map.  While views of tiles remain, eg being sent,
+        the map is instead released when the last of them is.
+        '''
+        self._index = None
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
@@ -0,0 +1,202 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Make server tiles ahead of their viewers.
+
+A background thread makes the tiles of each source from the coarsest
+level down, each level from its center out, which is the order a
+viewer opening the image asks for them.  It yields to live requests
+and, when a viewer asks for a tile not yet made, turns to the
+neighbors and finer tiles of that one before going on.
+'''
+
+import time
+import heapq
+import itertools
+import threading
+import contextlib
+
+from .metrics import log, count
+
+
+def plan(pyramid):
+    '''
+    Generate (level, loc) of all tiles from coarse to fine, each level
+    ordered from its center out.
+    '''
+    for g in pyramid.levels:
+        nr, nc = g.tiles
+        cr, cc = (nr - 1) / 2, (nc - 1) / 2
+        locs = sorted([(irow, icol) for irow in range(nr) for icol in range(nc)],
+                      key=lambda loc: (loc[0] - cr) ** 2 + (loc[1] - cc) ** 2)
+        for loc in locs:
+            yield g.level, loc
+
+
+class Prewarmer(object):
+    '''
+    Make tiles of sources in the background, giving way to viewers.
+    '''
+    def __init__(self, warm, pyramids, budget=None, duty=0.5, focus=256):
+        '''
+        Make tiles by calling warm(number, level, loc).
+
+        The pyramids maps source number to its Pyramid.  At most
+        budget tiles (None is all) of each source are made in the
+        planned order, besides those near tiles viewers ask for.
+
+        The thread rests after each tile so it is busy at most duty
+        of the time and waits while any live() request is being
+        served.  At most focus tiles near requested tiles are queued.
+        '''
+        self._warm = warm
+        self._pyramids = dict(pyramids)
+        self._budget = budget
+        self._duty = duty
+        self._nfocus = focus
+        self._cond = threading.Condition()
+        self._live = 0
+        self._focus = list()        # heap of (priority, number, level, loc)
+        self._hints = itertools.count()
+        self._done = set()
+        self._stopped = False
+        self._exhausted = False
+        self._thread = None
+        self.progress = dict()
+        for num, p in self._pyramids.items():
+            total = p.ntiles
+            planned = total if budget is None else min(budget, total)
+            self.progress[num] = dict(warmed=0, planned=planned, total=total, level=0)
+
+    def start(self):
+        'Start the background thread'
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        'Stop after the tile being made'
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    @contextlib.contextmanager
+    def live(self):
+        'Context of serving a request, during which warming waits'
+        with self._cond:
+            self._live += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._live -= 1
+                self._cond.notify_all()
+
+    def hint(self, number, level, loc):
+        '''
+        Note that a viewer asked for a tile that was not ready.
+
+        Its neighbors and the tiles under them one level finer are
+        made next, before those of earlier hints.
+        '''
+        p = self._pyramids.get(number)
+        if p is None:
+            return
+        hint = -next(self._hints)
+        irow, icol = loc
+        near = [(0, level, (irow + dr, icol + dc))
+                for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc]
+        if level + 1 < p.depth:
+            near += [(1, level + 1, (2 * irow + dr, 2 * icol + dc))
+                     for dr in (-1, 0, 1, 2) for dc in (-1, 0, 1, 2)]
+        with self._cond:
+            for rank, lvl, nloc in near:
+                nr, nc = p.tiles_shape(lvl)
+                if not (0 <= nloc[0] < nr and 0 <= nloc[1] < nc):
+                    continue
+                if (number, lvl, nloc) in self._done:
+                    continue
+                heapq.heappush(self._focus, ((hint, rank), number, lvl, nloc))
+            if len(self._focus) > self._nfocus:
+                self._focus = heapq.nsmallest(self._nfocus, self._focus)
+                heapq.heapify(self._focus)
+            self._cond.notify_all()
+
+    def status(self):
+        'Return dict of progress per source and overall'
+        with self._cond:
+            sources = {str(num): dict(prog) for num, prog in self.progress.items()}
+            warmed = sum([prog["warmed"] for prog in self.progress.values()])
+            planned = sum([prog["planned"] for prog in self.progress.values()])
+            return dict(sources=sources, warmed=warmed, planned=planned,
+                        focus=len(self._focus), live=self._live,
+                        done=self._exhausted and not self._focus)
+
+    def _planned(self):
+        'Generate (number, level, loc) in planned order within budgets'
+        for num in sorted(self._pyramids):
+            yield from itertools.islice(((num,) + one for one in plan(self._pyramids[num])),
+                                        self.progress[num]["planned"])
+
+    def _next(self, planned):
+        '''
+        Return the next (number, level, loc) to make, waiting while
+        requests are live or there is nothing to do, or None if stopped.
+        '''
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                if self._live:
+                    self._cond.wait()
+                    continue
+                while self._focus:
+                    prio, num, level, loc = heapq.heappop(self._focus)
+                    if (num, level, loc) not in self._done:
+                        return num, level, loc
+                for item in planned:
+                    if item not in self._done:
+                        return item
+                # all planned, wait for hints
+                self._exhausted = True
+                self._cond.wait()
+
+    def _run(self):
+        planned = self._planned()
+        while True:
+            item = self._next(planned)
+            if item is None:
+                return
+            num, level, loc = item
+            t0 = time.perf_counter()
+            try:
+                self._warm(num, level, loc)
+            except Exception as err:
+                log.warning('prewarm of source %d level %d tile %s failed: %s',
+                            num, level, loc, err)
+            dt = time.perf_counter() - t0
+            count("prewarm_tiles")
+            with self._cond:
+                self._done.add(item)
+                prog = self.progress[num]
+                prog["warmed"] += 1
+                prog["level"] = max(prog["level"], level)
+                if self._duty < 1:
+                    self._cond.wait(dt * (1 - self._duty) / self._duty)
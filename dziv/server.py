@@ -18,48 +18,622 @@
 # along with Foobar. If not, see <https://www.gnu.org/licenses/>.
 
 import io
+import os
+import time
+import hashlib
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import mimetypes
+import numpy
+from datetime import datetime, timezone
 
 from pathlib import Path
-from flask import Flask, url_for, send_from_directory, send_file
+from flask import (Flask, url_for, send_from_directory, send_file, jsonify,
+                   request, Response, abort)
 # from flask_restful import Resource, Api
 
 from .tile import Tiler
 from .dzi import Pyramid
-from .image import Data as Image
-from .web import osd_header
+from .image import Data as Image, header_shape
+from .web import osd_header, osd_dir
+from .cache import LRU
+from .pack import Pack
+from .dzi import load as load_dzi
+from . import colormap
+from .metrics import log, registry, timer, cache_metrics
 
-# fixme: this will only work for in-source running!
 # fixme: need to install osd/ files!
-osd_dir = Path(__file__).parent.parent / "osd"
-print("OSD_DIR:", osd_dir)
+log.debug('OSD_DIR: %s', osd_dir)
 
-def create(source):
-    if isinstance(source, str):
-        source=[source]
+# tiles of a given source never change
+tile_max_age = 365 * 24 * 3600
+
+# byte budget per source of encoded uniform tiles
+uniform_cache = 1 << 20
+
+def source_tag(path, pyramid):
+    '''
+    Return a string identifying the tiles of a source.
+
+    It changes when the source file or pyramid parameters change.
+    '''
+    st = path.stat()
+    ident = ':'.join(map(str, (path.resolve(), st.st_size, st.st_mtime_ns,
+                               pyramid.tile_size, pyramid.tile_overlap,
+                               pyramid.tile_format)))
+    return hashlib.sha1(ident.encode()).hexdigest()[:20]
+
+def tile_mimetype(fmt):
+    'Return MIME type of tile format'
+    return mimetypes.guess_type(f'tile.{fmt}')[0] or 'application/octet-stream'
+
+def tile_response(data, etag, fmt, modified):
+    '''
+    Return a response for encoded tile bytes that may be cached forever.
+
+    A memoryview (eg, of a packed pyramid) is sent without a copy.
+    '''
+    if isinstance(data, memoryview):
+        resp = Response([data], mimetype=tile_mimetype(fmt))
+        resp.content_length = data.nbytes
+    else:
+        resp = Response(data, mimetype=tile_mimetype(fmt))
+    resp.set_etag(etag)
+    resp.last_modified = modified
+    resp.cache_control.public = True
+    resp.cache_control.max_age = tile_max_age
+    resp.cache_control.immutable = True
+    return resp
+
+# image files which may be served
+source_suffixes = ('.jpg','.jpeg','.png')
+# arrays of values which may be served
+array_suffixes = ('.npy',)
+# packed pyramids which may be served
+pack_suffixes = ('.dzp',)
+# pre-tiled pyramids which may be served
+dzi_suffixes = ('.dzi',)
+
+class Source(object):
+    '''
+    Something served as a pyramid of tiles.
+
+    Subclasses provide tile() and may hold memory while open.
+    '''
+    # whether encoded tiles are worth caching
+    cached = True
+    # whether tiles depend on a requested style
+    styled = False
+
+    def __init__(self, path, pyramid, format):
+        self.path = path
+        self.pyramid = pyramid
+        self.format = format
+        self.tag = source_tag(path, self.pyramid)
+        self.modified = datetime.fromtimestamp(int(path.stat().st_mtime), timezone.utc)
+        self.last_used = 0
+
+    def tile_path(self, level, loc):
+        '''
+        Return path of a file holding the encoded tile or None.
+        '''
+        return None
+
+    @property
+    def content_path(self):
+        '''
+        The file whose content the made tiles depend on.
+        '''
+        return self.path
+
+    def has_tile(self, level, loc):
+        '''
+        True if level and loc=(row,col) are in the pyramid.
+        '''
+        p = self.pyramid
+        if level < 0 or level >= p.depth:
+            return False
+        nr, nc = p.tiles_shape(level)
+        return 0 <= loc[0] < nr and 0 <= loc[1] < nc
+
+    @property
+    def is_open(self):
+        return False
+
+    @property
+    def nbytes(self):
+        '''
+        Memory held by the open source.
+        '''
+        return 0
+
+    @property
+    def cache_stats(self):
+        return dict(open=self.is_open)
+
+    def close(self):
+        pass
+
+
+class ImageSource(Source):
+    '''
+    An image to serve.
+
+    Only the header is read on construction.  The image is decoded
+    when its tiler is first needed and may later be closed to release
+    its memory.
+    '''
+    def __init__(self, path, level_cache=None, crop_cache=None, regional=True,
+                 pyramid=None, pixel_store=None, **kwds):
+        '''
+        Serve image at path.
+
+        A pyramid may be given in place of the default one.  With a
+        shared.PixelStore, decoded levels are kept in it, once for
+        all processes serving the image.
+        '''
+        if pyramid is None:
+            super().__init__(path, Pyramid(header_shape(path)), path.suffix[1:])
+        else:
+            super().__init__(path, pyramid, pyramid.tile_format)
+        self._caches = (level_cache, crop_cache)
+        self._regional = regional
+        self._store = pixel_store
+        self._tiler = None
+        self._lock = threading.Lock()
+        # uniform tiles of one value share their encoding
+        self._uniform = LRU(uniform_cache)
+
+    @property
+    def is_open(self):
+        return self._tiler is not None
+
+    @property
+    def tiler(self):
+        '''
+        The Tiler of this source, opening it if needed.
+        '''
+        self.last_used = time.monotonic()
+        with self._lock:
+            if self._tiler is None:
+                # decoded on first use, coarse levels of a JPEG at reduced scale
+                d = Image(self.path)
+                level_cache, crop_cache = self._caches
+                store = None
+                if self._store is not None:
+                    store = self._store.levels(self.tag)
+                self._tiler = Tiler(self.pyramid, d, level_cache=level_cache,
+                                    crop_cache=crop_cache, regional=self._regional,
+                                    level_store=store)
+                log.info('opened %s shape:%s', self.path, d.shape)
+            return self._tiler
 
-    tilers = dict()
+    def tile(self, level, loc, style=None):
+        '''
+        Return the encoded tile at level and loc=(row,col)
+
+        Images have fixed colors and the style is ignored.
+        '''
+        return self._encode(self.tiler.crop(level, loc))
+
+    def _encode(self, d, style=None):
+        '''
+        Return encoded data, shared with any other uniform tile of
+        the same value.
+        '''
+        def encode():
+            fp = io.BytesIO()
+            d.save(fp, self.format)
+            return fp.getvalue()
+        key = d.uniform()
+        if key is None:
+            return encode()
+        return self._uniform.get((key, style), encode)
+
+    @property
+    def nbytes(self):
+        if self._tiler is None:
+            return 0
+        cs = self._tiler.cache_stats
+        # the decoded source itself, levels may stay unmade
+        held = getattr(self._tiler.data, "held_nbytes", 0)
+        return cs["levels"]["used"] + cs["crops"]["used"] + held
+
+    @property
+    def cache_stats(self):
+        if self._tiler is None:
+            return dict(open=False)
+        return dict(self._tiler.cache_stats, uniform=self._uniform.stats, open=True)
+
+    def close(self):
+        '''
+        Release the decoded image and everything made from it.
+        '''
+        self._tiler = None
+
+
+class ArraySource(ImageSource):
+    '''
+    A .npy array of values to serve.
+
+    Levels of values are made by block reduction and colored per tile
+    when it is encoded, so a style (see colormap.style_key()) chosen
+    by the request costs only the tiles it is used for.
+    '''
+    styled = True
+
+    def __init__(self, path, level_cache=None, crop_cache=None, reduction="mean", **kwds):
+        shape = numpy.load(path, mmap_mode='r').shape[:2]
+        Source.__init__(self, path, Pyramid(shape, tile_format="png"), "png")
+        self._caches = (level_cache, crop_cache)
+        self._reduction = reduction
+        self._tiler = None
+        self._lock = threading.Lock()
+        self._uniform = LRU(uniform_cache)
+
+    @property
+    def tiler(self):
+        '''
+        The Tiler of this source, opening it if needed.
+        '''
+        from .array import Data as Array
+        self.last_used = time.monotonic()
+        with self._lock:
+            if self._tiler is None:
+                d = Array(self.path, self._reduction)
+                level_cache, crop_cache = self._caches
+                self._tiler = Tiler(self.pyramid, d, cascade=True,
+                                    level_cache=level_cache, crop_cache=crop_cache)
+                log.info('opened %s shape:%s', self.path, d.shape)
+            return self._tiler
+
+    def tile(self, level, loc, style=None):
+        '''
+        Return the encoded tile at level and loc=(row,col) colored
+        by the style key.
+        '''
+        d = self.tiler.crop(level, loc)
+        if style:
+            d = d.recolor(colormap.from_style(style, d.colormap.vrange))
+        return self._encode(d, style)
+
+
+class PackSource(Source):
+    '''
+    A packed pyramid served by slicing its memory map.
+
+    Tiles are already encoded so they are not cached.  They are sent
+    as views of the map which keep it alive if the source is closed
+    meanwhile.
+    '''
+    cached = False
+
+    def __init__(self, path, **kwds):
+        self._pack = Pack(path)
+        super().__init__(path, self._pack.pyramid, self._pack.pyramid.tile_format)
+        self._pack.close()
+        self._pack = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._pack is not None
+
+    def tile(self, level, loc, style=None):
+        '''
+        Return the encoded tile at level and loc=(row,col)
+        '''
+        self.last_used = time.monotonic()
+        # close() must not unmap between the lookup and taking a view
+        with self._lock:
+            if self._pack is None:
+                self._pack = Pack(self.path)
+            return self._pack.tile(level, loc)
+
+    def close(self):
+        with self._lock:
+            pack, self._pack = self._pack, None
+            if pack is not None:
+                pack.close()
+
+
+class DziSource(Source):
+    '''
+    A pre-tiled pyramid of a DZI file and its directory of tiles.
+
+    Tile files are sent straight from disk.  With fallback, tiles
+    missing from the directory are made from an image next to the DZI
+    file with the same stem, if there is one.
+    '''
+    def __init__(self, path, fallback=False, **kwds):
+        pyramid = load_dzi(path)
+        super().__init__(path, pyramid, pyramid.tile_format)
+        self.tiles = path.parent / f'{path.stem}_files'
+        if not self.tiles.exists():
+            # as made by "dziv tile"
+            self.tiles = path.parent / path.stem
+        self._fallback = None
+        if fallback:
+            for suffix in source_suffixes:
+                img = path.with_suffix(suffix)
+                if img.exists() and header_shape(img) == tuple(self.pyramid.shape):
+                    self._fallback = ImageSource(img, pyramid=self.pyramid, **kwds)
+                    break
+
+    def tile_path(self, level, loc):
+        path = self.tiles / self.pyramid.filename(level, loc)
+        if path.exists():
+            self.last_used = time.monotonic()
+            return path
+        return None
+
+    def tile(self, level, loc, style=None):
+        '''
+        Return the tile made from the fallback image.
 
-    sources = list()
+        Raises KeyError if there is no fallback.
+        '''
+        if self._fallback is None:
+            raise KeyError(f'missing tile {loc} in level {level}')
+        self.last_used = time.monotonic()
+        return self._fallback.tile(level, loc, style)
+
+    @property
+    def content_path(self):
+        # made tiles come from the fallback, not the DZI file
+        if self._fallback is None:
+            return self.path
+        return self._fallback.path
+
+    @property
+    def is_open(self):
+        return self._fallback is not None and self._fallback.is_open
+
+    @property
+    def nbytes(self):
+        return 0 if self._fallback is None else self._fallback.nbytes
+
+    @property
+    def cache_stats(self):
+        if self._fallback is None:
+            return dict(open=False)
+        return self._fallback.cache_stats
+
+    def close(self):
+        if self._fallback is not None:
+            self._fallback.close()
+
+
+def make_source(path, **kwds):
+    '''
+    Return a Source of a type suited to the file at path.
+    '''
+    suffix = path.suffix.lower()
+    if suffix in pack_suffixes:
+        return PackSource(path, **kwds)
+    if suffix in dzi_suffixes:
+        return DziSource(path, **kwds)
+    if suffix in array_suffixes:
+        return ArraySource(path, **kwds)
+    return ImageSource(path, **kwds)
+
+
+class Sources(object):
+    '''
+    The served sources, closing those idle for too long or the least
+    recently used when together they hold too much memory.
+    '''
+    def __init__(self, paths, idle=None, budget=None, **caches):
+        self._sources = [make_source(path, **caches) for path in paths]
+        self.idle = idle
+        self.budget = budget
+        self._open = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._sources)
+
+    def __iter__(self):
+        return iter(self._sources)
+
+    def __getitem__(self, number):
+        if number < 0 or number >= len(self._sources):
+            raise ValueError("unknown source")
+        return self._sources[number]
+
+    def tiler(self, number):
+        '''
+        Return the Tiler of an image source and note its use.
+        '''
+        src = self[number]
+        t = src.tiler
+        self._touch(number, src)
+        return t
+
+    def tile(self, number, level, loc, style=None):
+        '''
+        Return the encoded tile of a source and note its use.
+        '''
+        src = self[number]
+        data = src.tile(level, loc, style)
+        self._touch(number, src)
+        return data
+
+    def _touch(self, number, src):
+        with self._lock:
+            self._open[number] = src
+            self._open.move_to_end(number)
+        self.evict(keep=number)
+
+    def evict(self, keep=None):
+        '''
+        Close idle sources and those over the memory budget.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            if self.idle:
+                for num, src in list(self._open.items()):
+                    if num != keep and now - src.last_used > self.idle:
+                        self._close(num)
+            if self.budget:
+                held = sum([src.nbytes for src in self._open.values()])
+                for num, src in list(self._open.items()):
+                    if held <= self.budget:
+                        break
+                    if num == keep:
+                        continue
+                    held -= src.nbytes
+                    self._close(num)
+
+    def _close(self, num):
+        src = self._open.pop(num)
+        log.info('closing source %s', src.path)
+        src.close()
+
+    def start_reaper(self):
+        '''
+        Periodically close idle sources in a background thread.
+        '''
+        if not self.idle:
+            return
+        def reap():
+            while True:
+                time.sleep(self.idle / 2)
+                self.evict()
+        threading.Thread(target=reap, daemon=True).start()
+
+
+served_suffixes = source_suffixes + array_suffixes + pack_suffixes + dzi_suffixes
+
+def find_sources(source):
+    '''
+    Return list of image paths from files and directories.
+    '''
+    if isinstance(source, (str, Path)):
+        source=[source]
+    paths = list()
     for one in source:
         path = Path(one)
         if not path.exists():
             raise ValueError(f'no such file or directory: {one}')
-        
-        ## for a numpy array, this makes a good false color image. 
-        # matplotlib.image.imsave('arr.png', arr, cmap='gist_ncar')
-        if path.suffix in ('.jpg','.jpeg','.png'):
-            sources.append(path)
-            d = Image(path)            
-            p = Pyramid(d.shape)
-            t = Tiler(p,d)
-
-            # for level, loc in p.visit:
-            #     t.crop(level, loc) # precalc
-
-            tilers[path] = t
-            print(f'TILER for {path} shape:{d.shape}')
-        else:
+        if path.is_dir():
+            paths += sorted([p for p in path.iterdir()
+                             if p.suffix.lower() in served_suffixes])
+            continue
+        if path.suffix.lower() not in served_suffixes:
             raise ValueError(f'unsupported format: {path.suffix}')
+        paths.append(path)
+    return paths
+
+
+def create(source, level_cache=None, crop_cache=None, tile_cache=None,
+           idle=None, source_budget=None, workers=None, regional=True,
+           dzi_fallback=False, disk_cache=None, disk_budget=None, prewarm=0,
+           pixel_store=None):
+    '''
+    Return a Flask app serving the sources.
+
+    A source may be an image file, a packed pyramid file, a DZI file
+    with its directory of tiles or a directory of any of these.
+    Images are only decoded once their tiles are requested.  A .npy
+    array is served as levels of values colored per tile by style
+    parameters (cmap, scale, eps, vmin, vmax) given in the query
+    string or as a "key=value,..." path segment before image.dzi and
+    image_files.  Packed
+    tiles are served directly from a memory map and DZI tiles from
+    their files.  With dzi_fallback, tiles missing from a DZI
+    directory are made from an image of the same stem.
+
+    The level_cache and crop_cache give the byte budget of each
+    source's cache of zoomed levels and of cropped tiles.  The
+    tile_cache gives the byte budget of encoded tiles shared by all
+    sources.  Decoded sources are closed after idle seconds without
+    use or, least recently used first, when together they hold more
+    than source_budget bytes.
+
+    Cropping and encoding of tiles is done in a pool of workers
+    threads (default is one per CPU) so that it is bounded no matter
+    how many requests are served concurrently.  Concurrent requests
+    for the same tile or level wait on the one computing it.
+
+    With regional, each tile is resampled from just its region of the
+    source rather than from a fully zoomed level, so the first tile
+    of a level is fast regardless of image size.
+
+    With a disk_cache directory, encoded tiles missing from memory are
+    looked for there, and kept there once made, bounded by disk_budget
+    bytes (see diskcache.DiskCache).  It may be shared by several
+    server processes and keeps its tiles over restarts.
+
+    With prewarm, up to that many tiles of each image or array source
+    (or all if negative) are made in the background ahead of viewers
+    (see prewarm.Prewarmer).  Progress is at /prewarm.
+
+    With a pixel_store directory, decoded and zoomed levels of images
+    are kept there as memory mapped files which all server processes
+    share (see shared.PixelStore), so memory does not grow with the
+    number of processes.  This disables regional: the first tile of a
+    level waits for the whole level to be zoomed from the full image.
+    Entries of sources not served here, such as images since changed,
+    are removed on start so the store is meant for processes serving
+    the same sources.
+    '''
+    if pixel_store:
+        from .shared import PixelStore
+        pixel_store = PixelStore(pixel_store)
+    sources = Sources(find_sources(source), idle, source_budget,
+                      level_cache=level_cache, crop_cache=crop_cache,
+                      regional=regional, fallback=dzi_fallback,
+                      pixel_store=pixel_store)
+    if pixel_store:
+        freed = pixel_store.prune([src.tag for src in sources])
+        log.info('pruned %d bytes from pixel store %s', freed, pixel_store.directory)
+    sources.start_reaper()
+    encoded = LRU(tile_cache)
+    pool = ThreadPoolExecutor(workers or os.cpu_count())
+    disk = None
+    if disk_cache:
+        from .diskcache import DiskCache
+        disk = DiskCache(disk_cache, disk_budget)
+
+    def tile_name(src, level, loc, style):
+        'Return the name of an encoded tile, distinct per style'
+        row, col = loc
+        if style:
+            shash = hashlib.sha1(repr(style).encode()).hexdigest()[:12]
+            return f'{level}/{col}_{row}-{shash}.{src.format}'
+        return f'{level}/{col}_{row}.{src.format}'
+
+    def tile_key(src, level, loc, style):
+        'Return key of an encoded tile in memory'
+        return (src.path, level, loc[1], loc[0], src.format, style)
+
+    def encoded_tile(number, level, loc, style=()):
+        'Return an encoded tile from the caches or made by the pool'
+        src = sources[number]
+        if not src.cached:
+            return sources.tile(number, level, loc, style)
+
+        def make():
+            return pool.submit(sources.tile, number, level, loc, style).result()
+
+        def fetch():
+            if disk is None:
+                return make()
+            return disk.get(disk.source_key(src.content_path, src.pyramid),
+                            tile_name(src, level, loc, style), make)
+
+        return encoded.get(tile_key(src, level, loc, style), fetch)
+
+    warmer = None
+    if prewarm:
+        from .prewarm import Prewarmer
+        pyramids = {num: one.pyramid for num, one in enumerate(sources)
+                    if isinstance(one, ImageSource)}
+        warmer = Prewarmer(encoded_tile, pyramids, None if prewarm < 0 else prewarm)
+        warmer.start()
 
     app = Flask(__name__)
     assert app.has_static_folder
@@ -69,44 +643,90 @@ def create(source):
     def index():
         lines = ['<ul>']
         for num, one in enumerate(sources):
-            lines.append(f'<li><a href="/{num}/index.html">{one.stem}</a></li>')
+            lines.append(f'<li><a href="/{num}/index.html">{one.path.stem}</a></li>')
         lines.append('</ul>')
         return '\n'.join(lines)
 
 
+    @app.route("/stats")
+    def stats():
+        '''
+        Return cache counters for each source
+        '''
+        ret = {str(num): one.cache_stats
+               for num, one in enumerate(sources) if one.is_open}
+        ret["tiles"] = encoded.stats
+        if disk is not None:
+            ret["disk"] = disk.stats
+        return jsonify(ret)
+
+    @app.route("/prewarm")
+    def prewarm_status():
+        '''
+        Return progress of making tiles ahead of viewers
+        '''
+        if warmer is None:
+            return jsonify(dict(enabled=False))
+        return jsonify(dict(warmer.status(), enabled=True))
+
+    @app.route("/metrics")
+    def metrics():
+        '''
+        Return stage timings and counters in Prometheus text format
+        '''
+        gauges, counters = cache_metrics("tile", encoded.stats)
+        if disk is not None:
+            more = cache_metrics("disk", disk.stats)
+            gauges.update(more[0])
+            counters.update(more[1])
+        gauges["open_sources"] = sum([one.is_open for one in sources])
+        gauges["source_bytes"] = sum([one.nbytes for one in sources])
+        text = registry.prometheus(gauges, counters)
+        return Response(text, mimetype="text/plain; version=0.0.4")
+
     @app.route('/favicon.ico')
     def favicon():
         d = Path(".")
         fi = d / "favicon.ico"
-        print(f'serve {fi.absolute()}')
         return send_file(fi.absolute())
 
     @app.route('/osd/<path:path>')
     def send_osd(path):
         # osd = Path("/home/bv/dev/openseadragon/src")
-        print(f'serve OSD file: {path} from {osd_dir.absolute()}')
-        got = send_from_directory(osd_dir.absolute(), path)
-        print("SUCCESS", type(got))
-        return got
+        log.debug('serve OSD file: %s from %s', path, osd_dir.absolute())
+        return send_from_directory(osd_dir.absolute(), path)
 
     ## something asks for /src/openseadragon.js
     @app.route('/src/<path:path>')
     def send_src(path):
         # osd = Path("/home/bv/dev/openseadragon/src")
-        print(f'serve OSD file: {path} from {osd_dir.absolute()}')
-        got = send_from_directory(osd_dir.absolute(), path)
-        return got
+        log.debug('serve OSD file: %s from %s', path, osd_dir.absolute())
+        return send_from_directory(osd_dir.absolute(), path)
 
 
+    def request_style(text=None):
+        '''
+        Return the style key of the URL path text and query string.
+        '''
+        params = {k: v for k, v in request.args.items() if k in colormap.style_keys}
+        try:
+            if text:
+                params.update(colormap.parse_style(text))
+            return colormap.style_key(params)
+        except ValueError:
+            abort(400)
+
     @app.route("/<int:number>/index.html")
     def image_number(number):
-        if number < 0 or number >= len(sources):
-            raise ValueError("unknown source")
-        path = sources[number]
+        sources[number]
+        request_style()
 
         osd_js_url = f'/osd/openseadragon.js'
         osd_images_url = f'/osd/images/'
         image_dzi = f'/{number}/image.dzi'
+        params = [f'{k}={v}' for k, v in request.args.items() if k in colormap.style_keys]
+        if params:
+            image_dzi = f'/{number}/{",".join(params)}/image.dzi'
 
         html = f'''
 <html>
@@ -130,7 +750,6 @@ def create(source):
 </script>
 </body>
 </html>'''
-        print(html)
         fp = io.BytesIO()
         fp.write(html.encode())
         fp.seek(0)
@@ -138,17 +757,13 @@ def create(source):
 
 
     @app.route("/<int:number>/image.dzi")
-    def dzi_number(number):
+    @app.route("/<int:number>/<string:style>/image.dzi")
+    def dzi_number(number, style=None):
         '''
         Return the DZI
         '''
-        if number < 0 or number >= len(sources):
-            raise ValueError("unknown source")
-        path = sources[number]
-        # print(f'DZI: {number} with {path}')
-        t = tilers[path]
-        assert(t)
-        p = t._pyramid
+        # print(f'DZI: {number} with {sources[number].path}')
+        p = sources[number].pyramid
         fp = io.BytesIO()
         fp.write(p.as_xml().toxml(encoding="UTF-8"))
         fp.seek(0)
@@ -156,17 +771,59 @@ def create(source):
 
 
     @app.route("/<int:number>/image_files/<int:layer>/<int:col>_<int:row>.<string:fmt>")
-    def dzi_tile(number, layer, col, row, fmt):
-        if number < 0 or number >= len(sources):
-            raise ValueError("unknown source")
-        path = sources[number]
+    @app.route("/<int:number>/<string:style>/image_files/<int:layer>/<int:col>_<int:row>.<string:fmt>")
+    def dzi_tile(number, layer, col, row, fmt, style=None):
+        src = sources[number]
+        path = src.path
         # print(f'DZI image: {number} with {path} {layer} ({row},{col}).{fmt}')
-        t = tilers[path]
-        assert(t)
-        d = t.crop(layer, (row,col))
-        fp = io.BytesIO()
-        d.save(fp, path.suffix[1:])
-        fp.seek(0)
-        return send_file(fp, download_name=str(path))
+        loc = (row, col)
+        if not src.has_tile(layer, loc):
+            abort(404)
+        registry.count("tile_requests")
+        enc = src.format
+        tpath = src.tile_path(layer, loc)
+        if tpath is not None:
+            registry.count("tile_files")
+            resp = send_file(tpath, mimetype=tile_mimetype(enc),
+                             conditional=True, max_age=tile_max_age)
+            resp.cache_control.immutable = True
+            return resp
+
+        style = request_style(style) if src.styled else ()
+        etag = src.tag + '-' + tile_name(src, layer, loc, style).replace('/', '-').replace('_', '-')
+        if request.if_none_match.contains(etag):
+            registry.count("tile_not_modified")
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            return resp
+
+        live = contextlib.nullcontext()
+        if warmer is not None:
+            if src.cached and tile_key(src, layer, loc, style) not in encoded:
+                warmer.hint(number, layer, loc)
+            live = warmer.live()
+        try:
+            with timer("tile"), live:
+                data = encoded_tile(number, layer, loc, style)
+        except KeyError:
+            abort(404)
+        return tile_response(data, etag, enc, src.modified)
 
     return app
+
+
+def run(app, host="0.0.0.0", port=5100, threads=32):
+    '''
+    Serve app with a production WSGI server handling requests in
+    concurrent threads.
+
+    This uses waitress if it is installed and otherwise the threaded
+    werkzeug server.
+    '''
+    try:
+        import waitress
+    except ImportError:
+        log.warning("waitress not found, using threaded werkzeug server")
+        app.run(host=host, port=port, threaded=True)
+        return
+    waitress.serve(app, host=host, port=port, threads=threads)
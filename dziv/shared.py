@@ -0,0 +1,174 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import fcntl
+import pickle
+from pathlib import Path
+
+import numpy
+from multiprocessing.shared_memory import SharedMemory
+
+class Array(object):
+    '''
+    A numpy array held in shared memory.
+
+    The process that creates an Array owns it and must unlink() it.
+    Other processes attach() using the spec and only close().
+    '''
+    def __init__(self, shm, shape, dtype):
+        self._shm = shm
+        self.array = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, shape, dtype):
+        'Make a new, uninitialized shared array'
+        dtype = numpy.dtype(dtype)
+        nbytes = max(1, int(numpy.prod(shape)) * dtype.itemsize)
+        shm = SharedMemory(create=True, size=nbytes)
+        return cls(shm, shape, dtype)
+
+    @classmethod
+    def attach(cls, spec):
+        'Attach to an existing shared array given its spec'
+        name, shape, dtype = spec
+        return cls(SharedMemory(name=name), shape, dtype)
+
+    @property
+    def spec(self):
+        'A picklable (name, shape, dtype) to pass to attach()'
+        return (self._shm.name, self.array.shape, self.array.dtype.str)
+
+    def close(self):
+        'Release this process view of the shared memory'
+        self.array = None
+        self._shm.close()
+
+    def unlink(self):
+        'Destroy the shared memory, called once by the owner'
+        self._shm.unlink()
+
+
+def _running(pid):
+    'True unless pid is of no running process'
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, PermissionError):
+        pass
+    return True
+
+
+class PixelStore(object):
+    '''
+    Decoded pixels in memory mapped files shared by processes.
+
+    Each entry is a raw .npy file of pixels and a pickle of their
+    meta.  The first process needing an entry makes it while holding
+    a lock on it, others wait and then map the same file read only, so
+    the pixels are held once in the page cache however many processes
+    use them.  A directory on a RAM file system (eg /dev/shm) keeps
+    them in memory.  Entries are never changed, their keys must change
+    with their content, so entries of changed sources are left behind
+    until pruned.
+    '''
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _open(self, key):
+        'Return image.Pixels of an existing entry'
+        from .image import Pixels
+        array = numpy.load(self.directory / f'{key}.npy', mmap_mode='r')
+        meta = pickle.loads((self.directory / f'{key}.meta').read_bytes())
+        return Pixels(array, meta)
+
+    def get(self, key, make):
+        '''
+        Return image.Pixels mapping the entry key, first saving the
+        image.Data returned by make() if it is missing.
+        '''
+        try:
+            return self._open(key)
+        except FileNotFoundError:
+            pass
+        with open(self.directory / f'{key}.lock', "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    # made while we waited
+                    return self._open(key)
+                except FileNotFoundError:
+                    pass
+                self._save(key, make())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return self._open(key)
+
+    def _save(self, key, data):
+        tmp = self.directory / f'.{key}.{os.getpid()}.tmp'
+        tmp.write_bytes(pickle.dumps(data.meta()))
+        os.replace(tmp, self.directory / f'{key}.meta')
+        shape, dtype = data.layout()
+        array = numpy.lib.format.open_memmap(tmp, "w+", dtype, shape)
+        data.fill(array)
+        array.flush()
+        del array
+        # the .npy appears last and whole
+        os.replace(tmp, self.directory / f'{key}.npy')
+
+    def prune(self, tags):
+        '''
+        Remove entries of sources not identified by one of tags and
+        partial entries of crashed processes, return the number of
+        bytes removed.
+
+        Processes still mapping a removed entry keep its pixels until
+        they unmap them.  Lock files are kept as a process may hold
+        one.
+        '''
+        tags = set(tags)
+        freed = 0
+        for path in self.directory.iterdir():
+            if path.suffix == ".tmp":
+                # .{key}.{pid}.tmp
+                if _running(path.name.split('.')[-2]):
+                    continue
+            elif path.suffix in (".npy", ".meta"):
+                # {tag}-{level}.npy
+                if path.stem.rpartition('-')[0] in tags:
+                    continue
+            else:
+                continue
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                # pruned by another process
+                continue
+            freed += size
+        return freed
+
+    def levels(self, tag):
+        '''
+        Return a function (level, make) giving the entry of a level of
+        the source identified by tag, as a Tiler level_store.
+        '''
+        return lambda level, make: self.get(f'{tag}-{level}', make)
@@ -0,0 +1,388 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Out-of-core tiling.
+
+A source is read in horizontal strips of full resolution rows.  Each
+pyramid level holds only the rows needed to finish its current row of
+tiles.  Lower levels are made by 2x reduction of rows passed down from
+the level above, as with Tiler(cascade=True).  Peak memory is thus
+bounded by the image width times a few tile rows.
+'''
+
+import copy
+import zlib
+import struct
+from pathlib import Path
+
+import numpy
+from PIL import Image
+
+from .image import Data
+from .colormap import Colormap
+from .metrics import log
+from .tile import write, Dedup, drain
+
+
+class NpySource(object):
+    '''
+    Strips of a .npy file read through a memory map.
+
+    Values, of any dtype, are false colored with a colormap.Colormap
+    (by default as image.load() does) fit to the values in one
+    chunked pass.
+    '''
+    def __init__(self, path, colormap=None):
+        self._arr = numpy.load(path, mmap_mode='r')
+        self.shape = self._arr.shape[:2]
+        self.info = dict()
+        if colormap is None:
+            colormap = Colormap()
+        if colormap.vrange is None:
+            colormap = copy.copy(colormap).fit(self._arr)
+        self._colormap = colormap
+
+    def strips(self, rows):
+        'Yield PIL images of consecutive bands of rows'
+        for r0 in range(0, self.shape[0], rows):
+            yield Image.fromarray(self._colormap(self._arr[r0:r0+rows]))
+
+
+class PngSource(object):
+    '''
+    Strips of a non-interlaced PNG.
+
+    The IDAT stream is inflated incrementally and each band of still
+    filtered rows is handed to PIL's own PNG decoder.  The last row
+    of the previous band, packed and unfiltered, is prepended so that
+    filters referring to the row above decode correctly.
+    '''
+    channels = {0:1, 2:3, 3:1, 4:2, 6:4}
+
+    def __init__(self, path, im):
+        self._path = path
+        self.shape = (im.size[1], im.size[0])
+        self.info = dict(im.info)
+        self._mode = im.mode
+        self._rawmode = im.tile[0][3]
+        self._palette = None
+        if im.palette is not None:
+            pmode = im.palette.mode
+            self._palette = (pmode, im.getpalette(pmode))
+
+        with open(path, 'rb') as fp:
+            fp.seek(8)
+            length, ctype = struct.unpack(">I4s", fp.read(8))
+            ihdr = fp.read(length)
+        width, height, depth, color, comp, filt, interlace = struct.unpack(">IIBBBBB", ihdr)
+        if interlace:
+            raise ValueError("interlaced PNG can not be read in strips")
+        # raises ValueError if rows can not be repacked
+        Image.new(self._mode, (1,1)).tobytes("raw", self._rawmode)
+        self._rowbytes = 1 + (width * depth * self.channels[color] + 7) // 8
+
+    def _idat(self, blksize=1<<20):
+        'Yield compressed IDAT payloads'
+        with open(self._path, 'rb') as fp:
+            fp.seek(8)
+            while True:
+                head = fp.read(8)
+                if len(head) < 8:
+                    return
+                length, ctype = struct.unpack(">I4s", head)
+                if ctype == b'IEND':
+                    return
+                if ctype != b'IDAT':
+                    fp.seek(length + 4, 1)
+                    continue
+                while length:
+                    got = fp.read(min(length, blksize))
+                    length -= len(got)
+                    yield got
+                fp.seek(4, 1)   # crc
+
+    def _decode(self, raw, nrows):
+        img = Image.new(self._mode, (self.shape[1], nrows))
+        decoder = Image._getdecoder(self._mode, "zip", self._rawmode)
+        decoder.setimage(img.im, (0, 0, self.shape[1], nrows))
+        nbytes, err = decoder.decode(zlib.compress(raw, 0))
+        decoder.cleanup()
+        if err < 0:
+            raise ValueError(f'PNG decoding error {err}: {self._path}')
+        return img
+
+    def strips(self, rows):
+        'Yield PIL images of consecutive bands of rows'
+        inflate = zlib.decompressobj()
+        idat = self._idat()
+        pending = b''
+        prev = None
+        done = 0
+        while done < self.shape[0]:
+            nrows = min(rows, self.shape[0] - done)
+            need = nrows * self._rowbytes
+            while len(pending) < need:
+                chunk = next(idat, None)
+                if chunk is None:
+                    pending += inflate.flush()
+                    if len(pending) < need:
+                        raise ValueError(f'truncated PNG: {self._path}')
+                    break
+                pending += inflate.decompress(chunk)
+            raw, pending = pending[:need], pending[need:]
+            w = self.shape[1]
+            if prev is None:
+                img = self._decode(raw, nrows)
+            else:
+                img = self._decode(b'\x00' + prev + raw, nrows + 1)
+                img = img.crop((0, 1, w, nrows + 1))
+            prev = img.crop((0, nrows - 1, w, nrows)).tobytes("raw", self._rawmode)
+            if self._palette:
+                img.putpalette(self._palette[1], self._palette[0])
+            img.info = dict(self.info)
+            done += nrows
+            yield img
+
+
+class RawSource(object):
+    '''
+    Strips of an uncompressed image (eg, plain TIFF, PPM, BMP).
+
+    PIL describes these with one "raw" tile from which a tile for any
+    band of rows is made by offsetting into the file.
+    '''
+    def __init__(self, path, im):
+        self._path = path
+        self.shape = (im.size[1], im.size[0])
+        self.info = dict(im.info)
+        self._mode = im.mode
+        codec, extents, offset, args = im.tile[0]
+        if codec != "raw" or tuple(extents) != (0, 0) + im.size:
+            raise ValueError("not a single raw tile")
+        if isinstance(args, str):
+            args = (args, 0, 1)
+        rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+        if not stride:
+            stride = len(Image.new(self._mode, (im.size[0], 1)).tobytes("raw", rawmode))
+        self._offset = offset
+        self._rawmode = rawmode
+        self._stride = stride
+        self._orientation = orientation
+        self._palette = None
+        if im.palette is not None:
+            pmode = im.palette.mode
+            self._palette = (pmode, im.getpalette(pmode))
+
+    def strips(self, rows):
+        'Yield PIL images of consecutive bands of rows'
+        nrows, ncols = self.shape
+        with open(self._path, 'rb') as fp:
+            for r0 in range(0, nrows, rows):
+                r1 = min(r0 + rows, nrows)
+                if self._orientation < 0:
+                    fp.seek(self._offset + (nrows - r1) * self._stride)
+                else:
+                    fp.seek(self._offset + r0 * self._stride)
+                data = fp.read((r1 - r0) * self._stride)
+                img = Image.frombuffer(self._mode, (ncols, r1 - r0), data, "raw",
+                                       self._rawmode, self._stride, self._orientation)
+                img = img.copy()
+                if self._palette:
+                    img.putpalette(self._palette[1], self._palette[0])
+                img.info = dict(self.info)
+                yield img
+
+
+class WholeSource(object):
+    '''
+    Strips cropped from a fully decoded image.
+
+    This is the fall back for formats that can not be read in strips.
+    '''
+    def __init__(self, path):
+        self._image = Data(path)._image
+        self.shape = (self._image.size[1], self._image.size[0])
+        self.info = dict(self._image.info)
+
+    def strips(self, rows):
+        'Yield PIL images of consecutive bands of rows'
+        for r0 in range(0, self.shape[0], rows):
+            r1 = min(r0 + rows, self.shape[0])
+            yield self._image.crop((0, r0, self.shape[1], r1))
+
+
+def open_source(path, colormap=None):
+    '''
+    Return a strip source for the file at path.
+
+    A colormap.Colormap colors a .npy file of values.
+    '''
+    path = Path(path)
+    if path.suffix == ".npy":
+        return NpySource(path, colormap)
+
+    # Only headers are read here and the strip readers never decode
+    # the whole image so the decompression bomb check does not apply.
+    maxpix = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        im = Image.open(path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = maxpix
+
+    try:
+        if im.format == "PNG":
+            return PngSource(path, im)
+        return RawSource(path, im)
+    except ValueError as err:
+        log.warning('can not stream %s (%s), decoding whole image', path, err)
+    finally:
+        im.close()
+    return WholeSource(path)
+
+
+def _vstack(top, bot):
+    'Return image with rows of bot below rows of top'
+    if top is None:
+        return bot
+    if bot is None:
+        return top
+    img = Image.new(top.mode, (top.size[0], top.size[1] + bot.size[1]))
+    img.paste(top, (0, 0))
+    img.paste(bot, (0, top.size[1]))
+    if top.palette is not None:
+        img.putpalette(top.getpalette(top.palette.mode), top.palette.mode)
+    img.info = top.info
+    return img
+
+
+class _Level(object):
+    '''
+    The rows of one level held while its tiles are completed.
+    '''
+    def __init__(self, pyramid, level):
+        self.level = level
+        self.shape = pyramid.level_shape(level)
+        self.ntiles = pyramid.tiles_shape(level)
+        self.rows = None        # image of rows held
+        self.row0 = 0           # level row index of first held row
+        self.irow = 0           # next tile row to emit
+        self.received = 0       # rows received so far
+        self.pending = None     # rows not yet reduced to level below
+
+
+class StreamTiler(object):
+    '''
+    Tile a strip source with memory bounded by a few rows of tiles.
+    '''
+    def __init__(self, pyramid, source):
+        '''
+        Create a streaming tiler of a source as from open_source().
+        '''
+        self._pyramid = pyramid
+        self._pyramid.shape = source.shape
+        self._source = source
+
+    def save(self, directory=Path("."), writer = write, rows=None, manifest=None,
+             dedup=True):
+        '''
+        Fully tile, saving the tiles with the per data writer.
+
+        The source is read in strips of rows which defaults to the
+        tile size.  With a manifest.Manifest, tiles it holds are not
+        written and those written are recorded in batches (see
+        manifest.Recorder).  If it holds all tiles, the source is not
+        read at all.  The dedup is as for
+        Tiler.save(), as is a writer writing in the background.
+        '''
+        if isinstance(directory, str):
+            directory = Path(directory)
+        self.dedup_stats = dict(tiles=0, bytes=0)
+        p = self._pyramid
+        rows = rows or p.tile_size
+        if manifest is not None:
+            if all([p.filename(level, loc) in manifest for level, loc in p.visit]):
+                return
+        if manifest is not None:
+            from .manifest import Recorder
+            writer = Recorder(writer, directory, manifest)
+        if dedup:
+            writer = Dedup(writer)
+        self._directory = directory
+        self._writer = writer
+        self._manifest = manifest
+        self._levels = [_Level(p, level) for level in range(p.depth)]
+        for strip in self._source.strips(rows):
+            strip = self._reducible(strip)
+            self._push(p.depth - 1, strip)
+        drain(writer)
+        if dedup:
+            self.dedup_stats = writer.stats
+
+    def _reducible(self, img):
+        'Palette and bilevel pixels can not be averaged'
+        if img.mode == "P":
+            return img.convert("RGBA" if "transparency" in img.info else "RGB")
+        if img.mode == "1":
+            return img.convert("L")
+        return img
+
+    def _push(self, level, img):
+        'Add rows to a level, emit what tiles it can and pass rows down'
+        st = self._levels[level]
+        st.rows = _vstack(st.rows, img)
+        st.received += img.size[1]
+        self._emit(st)
+        if level == 0:
+            return
+
+        pend = _vstack(st.pending, img)
+        width, nrows = pend.size
+        keep = 0 if st.received == st.shape[0] else nrows % 2
+        st.pending = None
+        if keep:
+            st.pending = pend.crop((0, nrows - keep, width, nrows))
+        if nrows > keep:
+            pend = pend.crop((0, 0, width, nrows - keep))
+            self._push(level - 1, pend.reduce(2))
+
+    def _emit(self, st):
+        'Write all complete tile rows of the level'
+        p = self._pyramid
+        nrows, ncols = st.ntiles
+        while st.irow < nrows:
+            rs = p.slices(st.level, (st.irow, 0))[0]
+            if st.row0 + st.rows.size[1] < rs.stop:
+                return
+            for icol in range(ncols):
+                loc = (st.irow, icol)
+                name = p.filename(st.level, loc)
+                if self._manifest is not None and name in self._manifest:
+                    continue
+                rs, cs = p.slices(st.level, loc)
+                box = (cs.start, rs.start - st.row0, cs.stop, rs.stop - st.row0)
+                self._writer(Data(st.rows.crop(box)), self._directory / name)
+            st.irow += 1
+            if st.irow == nrows:
+                st.rows = None
+                return
+            start = p.slices(st.level, (st.irow, 0))[0].start
+            width, height = st.rows.size
+            st.rows = st.rows.crop((0, start - st.row0, width, height))
+            st.row0 = start
@@ -18,47 +18,386 @@
 # along with Foobar. If not, see <https://www.gnu.org/licenses/>.
 
 
+import os
+import shutil
 from pathlib import Path
-from functools import cache
+from .cache import LRU
+from .metrics import log, count, timer, registry
+
+def write(data, path):
+    '''
+    The default tile writer.
+    '''
+    path = Path(path)
+    if path.is_file() and path.stat().st_nlink > 1:
+        # do not write through to the other links of a shared tile
+        path.unlink()
+    data.save(path)
+
+
+def link(path, other):
+    '''
+    Make the tile file path share the already written file other.
+
+    This is a hard link, or a copy where links are not supported.
+    Return the number of bytes saved.
+    '''
+    path = Path(path)
+    if not path.parent.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        path.unlink()
+    try:
+        os.link(other, path)
+    except OSError:
+        shutil.copyfile(other, path)
+        return 0
+    return Path(other).stat().st_size
+
+
+def drain(writer):
+    '''
+    Wait for the writes of a writer that writes in the background
+    (as output.Pipeline does).
+    '''
+    flush = getattr(writer, "flush", None)
+    if flush is not None:
+        flush()
+
+
+def reduced(above, shape):
+    '''
+    Return the data of a level of shape made by reducing the level
+    above it by 2.
+    '''
+    if hasattr(above, "reduce"):
+        newdat = above.reduce(2)
+        if tuple(newdat.shape) == tuple(shape):
+            return newdat
+    # data lacking reduce or giving unexpected geometry
+    return above.zoom(shape)
+
+
+class Dedup(object):
+    '''
+    A writer writing each distinct uniform tile once and linking the
+    others to it.
+
+    Data providing uniform() (as image.Data and array.Data do) tell
+    if a tile is of one value.  The wrapped writer may provide a
+    link(path, other) method (as pack.PackWriter does), otherwise
+    only the default write() is linked with link().
+    '''
+    def __init__(self, writer=write):
+        self._writer = writer
+        self._link = getattr(writer, "link", link if writer is write else None)
+        self._first = dict()
+        self.tiles = 0
+        self.bytes = 0
+
+    def __call__(self, data, path):
+        key = None
+        if self._link is not None and hasattr(data, "uniform"):
+            key = data.uniform()
+        if key is None:
+            self._writer(data, path)
+            return
+        first = self._first.get(key)
+        if first is None:
+            self._writer(data, path)
+            self._first[key] = path
+            return
+        with timer("write"):
+            self.bytes += self._link(path, first)
+        self.tiles += 1
+        count("dedup_tiles")
+
+    def flush(self):
+        drain(self._writer)
+
+    @property
+    def stats(self):
+        'Dictionary of number of linked tiles and bytes saved'
+        return dict(tiles=self.tiles, bytes=self.bytes)
+
 
 class Tiler(object):
-    def __init__(self, pyramid, data):
+    def __init__(self, pyramid, data, cascade=False, smooth_first=False,
+                 level_cache=None, crop_cache=None, regional=False, level_store=None):
         '''
         Create a pyramid tiler of the data.
 
         The data should be like image.Data or array.Data
+
+        By default each level is zoomed directly from the full
+        resolution data.  With cascade, each level is instead made by
+        a 2x reduction of the level above it.  With smooth_first, the
+        first step down from full resolution uses the data's own
+        (higher quality) zoom interpolation instead of a reduction.
+        Data with a true cascade attribute (as array.Data, which zooms
+        by block reduction anyway) is always cascaded.
+
+        Zoomed levels and crops are held in LRU caches bounded by
+        level_cache and crop_cache bytes (None is unbounded).
+
+        With regional, crop() of a level not already zoomed renders
+        just the tile's region of the full resolution data so its
+        cost does not depend on the image size.  This requires data
+        with zoom_box() and reduce() (as image.Data has).
+
+        A level_store(level, make) returns the data of a level, made by
+        make() if it lacks it, to share levels between processes (see
+        shared.PixelStore.levels()).  Levels then always come from it
+        and regional is ignored.
         '''
         self._pyramid = pyramid
         self._pyramid.shape = data.shape
         self._data = data
+        self._cascade = cascade or getattr(data, "cascade", False)
+        self._smooth_first = smooth_first
+        self._levels = LRU(level_cache)
+        self._crops = LRU(crop_cache)
+        self._store = level_store
+        self._regional = (regional and level_store is None
+                          and hasattr(data, "zoom_box") and hasattr(data, "reduce"))
 
-    @cache
     def zoom(self, level):
         '''
         Return a new data zoomed to this level
         '''
+        return self._levels.get(level, lambda: self._stored(level))
+
+    def _stored(self, level):
+        if self._store is None:
+            return self._zoom(level)
+        return self._store(level, lambda: self._zoom(level))
+
+    def _zoom(self, level):
         lshape = self._pyramid.level_shape(level)
-        print(f'ZOOM level={level} shape={lshape}')
+        if self._cascade:
+            return self._cascade_zoom(level, lshape)
+        log.debug('zoom level=%d shape=%s', level, lshape)
         newdat = self._data.zoom(lshape)
         return newdat
 
-    @cache
+    def _cascade_zoom(self, level, lshape):
+        '''
+        Make level by reducing the level above it.
+        '''
+        top = self._pyramid.depth - 1
+        if level == top:
+            return self._data
+        if level == top - 1 and self._smooth_first:
+            log.debug('zoom level=%d shape=%s', level, lshape)
+            return self._data.zoom(lshape)
+
+        above = self.zoom(level + 1)
+        log.debug('reduce level=%d shape=%s', level, lshape)
+        return reduced(above, lshape)
+
     def crop(self, level, loc):
         '''
         Return crop of data at given level and tile loc=(row,col)
         '''
+        return self._crops.get((level, tuple(loc)), lambda: self._crop(level, loc))
+
+    def _crop(self, level, loc):
+        if self._regional and level not in self._levels:
+            return self.render(level, loc)
         zi = self.zoom(level)
         sl = self._pyramid.slices(level, loc)
         return zi.crop(sl)
 
-    def save(self, directory=Path("."), writer = lambda data,path: data.save(path)):
+    def render(self, level, loc):
+        '''
+        Return the tile at level and loc=(row,col) resampled from its
+        region of the full resolution data.
+        '''
+        p = self._pyramid
+        sr, sc = p.slices(level, loc)
+        top = p.depth - 1
+        if level == top:
+            return self._data.crop((sr, sc))
+        if not self._cascade:
+            return self._zoom_box(level, sr, sc)
+
+        # A window aligned to the 2^n blocks that make the tile,
+        # reduced n times, gives exactly the cascaded level pixels.
+        base = top
+        if self._smooth_first:
+            base = top - 1
+        nred = base - level
+        f = 2 ** nred
+        bshape = p.level_shape(base)
+        rows = slice(sr.start * f, min(sr.stop * f, bshape[0]))
+        cols = slice(sc.start * f, min(sc.stop * f, bshape[1]))
+        if base == top:
+            win = self._data.crop((rows, cols))
+        else:
+            win = self._zoom_box(base, rows, cols)
+        for count in range(nred):
+            win = win.reduce(2)
+        return win
+
+    def _zoom_box(self, level, sr, sc):
+        'Zoom full resolution region to level region of slices'
+        lshape = self._pyramid.level_shape(level)
+        fr = self._data.shape[0] / lshape[0]
+        fc = self._data.shape[1] / lshape[1]
+        box = (sc.start * fc, sr.start * fr, sc.stop * fc, sr.stop * fr)
+        return self._data.zoom_box((sr.stop - sr.start, sc.stop - sc.start), box)
+
+    @property
+    def data(self):
+        'The full resolution data'
+        return self._data
+
+    @property
+    def cache_stats(self):
+        '''
+        Dictionary of level and crop cache counters.
+        '''
+        return dict(levels=self._levels.stats, crops=self._crops.stats)
+
+    def save(self, directory=Path("."), writer = write, jobs = 1, manifest = None,
+             dedup = True):
         '''
         Fully tile, saving the tiles with the per data writer.
+
+        With jobs > 1, levels are split into groups of tiles which are
+        cropped and written by a pool of that many processes.  Each
+        level is passed to the workers in shared memory.  The writer
+        must then be picklable (eg, a module level function) and the
+        data must support share() (as image.Data does), otherwise
+        tiling is serial.  A writer that must run in this process (eg,
+        pack.PackWriter) sets a true "serial".
+
+        With a manifest.Manifest, tiles it holds are skipped and those
+        written are recorded in it, from their encoded bytes, after
+        each level (see manifest.Recorder).  A level with nothing to
+        write is never zoomed.  A writer writing in the background
+        (see output.Pipeline) is flushed before tiles are recorded and
+        before returning.
+
+        With dedup, uniform tiles of one value are written once and
+        shared (see Dedup).  The number shared and bytes saved are
+        then in dedup_stats.
         '''
         if isinstance(directory, str):
             directory = Path(directory)
+        self.dedup_stats = dict(tiles=0, bytes=0)
+
+        if getattr(writer, "serial", False):
+            jobs = 1
+        if jobs > 1 and hasattr(self._data, "share"):
+            self._save_parallel(directory, writer, jobs, manifest, dedup)
+            return
+
+        if manifest is not None:
+            from .manifest import Recorder
+            writer = Recorder(writer, directory, manifest)
+        if dedup:
+            writer = Dedup(writer)
+        for level in range(self._pyramid.depth):
+            # each tile is visited once so crops bypass their cache
+            self._save_tiles(directory, writer, level, self._todo(level, manifest))
+            drain(writer)
+        if dedup:
+            self.dedup_stats = writer.stats
+
+    def _todo(self, level, manifest):
+        '''
+        Return locs of tiles in level to write, in visit order.
+        '''
+        g = self._pyramid.level(level)
+        locs = [tuple(loc) for loc in g.locs().tolist()]
+        if manifest is None:
+            return locs
+        return [loc for loc, name in zip(locs, g.names()) if name not in manifest]
+
+    def _save_tiles(self, directory, writer, level, locs):
+        p = self._pyramid
+        for loc in locs:
+            writer(self._crop(level, loc), directory / p.filename(level, loc))
+            count("tiles")
+
+    def _save_parallel(self, directory, writer, jobs, manifest, dedup):
+        '''
+        Tile with a process pool of jobs workers.
+
+        Each worker deduplicates just the tiles it writes.
+        '''
+        from concurrent.futures import ProcessPoolExecutor
+
+        p = self._pyramid
+        here = writer
+        if manifest is not None:
+            from .manifest import Recorder
+            here = Recorder(writer, directory, manifest)
+        if dedup:
+            here = Dedup(here)
+        with ProcessPoolExecutor(jobs) as pool:
+            for level in range(p.depth):
+                locs = self._todo(level, manifest)
+
+                if len(locs) < jobs:
+                    # not worth the trip through shared memory
+                    self._save_tiles(directory, here, level, locs)
+                    drain(here)
+                    continue
+
+                shared, meta = self.zoom(level).share()
+                try:
+                    nbands = min(len(locs), 4 * jobs)
+                    futures = [pool.submit(_save_band, shared.spec, meta, p, level,
+                                           locs[b::nbands], directory, writer,
+                                           manifest is not None, dedup)
+                               for b in range(nbands)]
+                    for fut in futures:
+                        recs, stats, summary = fut.result()
+                        if manifest is not None:
+                            manifest.add_all(recs)
+                        for key in stats:
+                            self.dedup_stats[key] += stats[key]
+                        registry.merge(summary)
+                finally:
+                    shared.close()
+                    shared.unlink()
+        drain(here)
+        if dedup:
+            for key, val in here.stats.items():
+                self.dedup_stats[key] += val
+
+
+def _save_band(spec, meta, pyramid, level, locs, directory, writer, record, dedup):
+    '''
+    Worker: write tiles at locs of one level.
 
-        for layer, loc in self._pyramid.visit:
-            path = directory / self._pyramid.filename(layer, loc)
-            data = self.crop(layer, loc)
-            writer(data, path)
+    Return list of (name, size, hash) of written tiles if record and
+    the dedup stats.
+    '''
+    from .shared import Array
+    from .image import from_array
+    from .manifest import Recorder
+    shared = Array.attach(spec)
+    # report just what this band does
+    registry.reset()
+    recorder = None
+    if record:
+        writer = recorder = Recorder(writer, directory, batch=len(locs) + 1)
+    if dedup:
+        writer = Dedup(writer)
+    try:
+        for loc in locs:
+            name = pyramid.filename(level, loc)
+            with timer("crop"):
+                data = from_array(shared.array[pyramid.slices(level, loc)], meta)
+            writer(data, directory / name)
+            count("tiles")
+    finally:
+        shared.close()
+    drain(writer)
+    ret = list()
+    if recorder is not None:
+        ret = [(name,) + got for name, got in recorder.records.items()]
+    return ret, (writer.stats if dedup else dict()), registry.summary()
@@ -0,0 +1,242 @@
+#!python
+
+# Copyright 2023 Brett Viren <brett.viren@gmail.com>
+#
+# This file is part of dziv
+#
+# dziv is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# dziv is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Foobar. If not, see <https://www.gnu.org/licenses/>.
+'''
+Keep tiles up to date with a changing image.
+
+When the image file changes it is compared to the previous version to
+find dirty rectangles.  Each level of the pyramid is held in memory
+and only the dirty part of each is remade, from the level above when
+cascading, and only tiles touching a dirty part are written.  The
+cost of an update then scales with the changed area.
+'''
+
+import time
+from math import ceil, floor
+from pathlib import Path
+
+import numpy
+
+from .tile import Tiler, write
+from .image import Data
+from .metrics import log
+
+
+def dirty_rects(old, new, cell=16):
+    '''
+    Return list of (rows_slice, cols_slice) covering pixels that
+    differ between two arrays of the same shape.
+
+    Differences are found on a grid of cell x cell pixels and
+    neighboring dirty cells are merged into rectangles.
+    '''
+    diff = old != new
+    if diff.ndim == 3:
+        diff = diff.any(axis=2)
+    nr, nc = diff.shape
+    cr, cc = ceil(nr / cell), ceil(nc / cell)
+    grid = numpy.zeros((cr * cell, cc * cell), dtype=bool)
+    grid[:nr, :nc] = diff
+    cells = grid.reshape(cr, cell, cc, cell).any(axis=(1, 3))
+
+    found = list()              # (r0, r1, c0, c1) in cells
+    running = dict()            # (c0, c1) -> r0 of runs still growing
+    for irow in range(cr + 1):
+        runs = list()
+        if irow < cr:
+            edges = numpy.diff(numpy.concatenate(([0], cells[irow].view(numpy.int8), [0])))
+            runs = zip(numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1))
+        grown = dict()
+        for run in runs:
+            run = (int(run[0]), int(run[1]))
+            grown[run] = running.pop(run, irow)
+        for (c0, c1), r0 in running.items():
+            found.append((r0, irow, c0, c1))
+        running = grown
+
+    return [(slice(r0 * cell, min(r1 * cell, nr)), slice(c0 * cell, min(c1 * cell, nc)))
+            for r0, r1, c0, c1 in found]
+
+
+def tile_range(sl, size, overlap, ntiles):
+    '''
+    Return range of tile indices along one dimension whose extent,
+    including overlap, intersects the slice.
+    '''
+    first = max(0, (sl.start - overlap) // size)
+    last = min(ntiles, -(-(sl.stop + overlap) // size))
+    return range(first, last)
+
+
+class Watcher(object):
+    '''
+    Tile an image and retile what changes when its file changes.
+    '''
+    def __init__(self, path, pyramid, directory, writer=write,
+                 cascade=False, smooth_first=False, output=None, cell=16, pad=4,
+                 colormap=None):
+        '''
+        Watch image file path, writing tiles of pyramid to directory.
+
+        The cascade and smooth_first are as for Tiler.  If output is
+        given, the DZI file is rewritten when the image shape changes.
+        Differences are found in cell x cell pixel blocks.  A level
+        zoomed directly from full resolution is remade with a margin
+        of pad pixels to cover the interpolation filter support.  A
+        colormap.Colormap colors a .npy file.
+        '''
+        self.path = Path(path)
+        self._pyramid = pyramid
+        self._directory = Path(directory)
+        self._writer = writer
+        self._cascade = cascade
+        self._smooth_first = smooth_first
+        self._output = output
+        self._cell = cell
+        self._pad = pad
+        self._colormap = colormap
+        self._stamp = None
+        self._pixels = None
+        self._levels = None
+
+    def _reduces(self, level):
+        'True if level is made by reducing the level above'
+        top = self._pyramid.depth - 1
+        if not self._cascade:
+            return False
+        return not (self._smooth_first and level == top - 1)
+
+    def full(self, data):
+        '''
+        Tile all of data, return number of tiles written.
+        '''
+        p = self._pyramid
+        t = Tiler(p, data, self._cascade, self._smooth_first)
+        if self._output:
+            p.save(self._output)
+        t.save(self._directory, self._writer)
+        top = p.depth - 1
+        self._levels = [t.zoom(level) for level in range(top)] + [data]
+        self._pixels = data.asarray()
+        return p.ntiles
+
+    def level_rects(self, rects):
+        '''
+        Return list, indexed by level, of lists of dirty rectangles
+        given those of full resolution.
+        '''
+        p = self._pyramid
+        top = p.depth - 1
+        ret = [None] * p.depth
+        ret[top] = rects
+        for level in range(top - 1, -1, -1):
+            lshape = p.level_shape(level)
+            if self._reduces(level):
+                # each pixel is the mean of a 2x2 block above
+                ret[level] = [tuple([slice(s.start // 2, -(-s.stop // 2)) for s in rect])
+                              for rect in ret[level + 1]]
+                continue
+            got = list()
+            for rect in rects:
+                got.append(tuple([
+                    slice(max(0, floor(s.start * n / N) - self._pad),
+                          min(n, ceil(s.stop * n / N) + self._pad))
+                    for s, n, N in zip(rect, lshape, p.shape)]))
+            ret[level] = got
+        return ret
+
+    def _remake(self, level, rect):
+        'Remake the rect of level from the level above or full resolution'
+        sr, sc = rect
+        if self._reduces(level):
+            above = self._levels[level + 1]
+            ar, ac = above.shape
+            win = above.crop((slice(2 * sr.start, min(2 * sr.stop, ar)),
+                              slice(2 * sc.start, min(2 * sc.stop, ac))))
+            patch = win.reduce(2)
+        else:
+            data = self._levels[-1]
+            lshape = self._pyramid.level_shape(level)
+            fr = data.shape[0] / lshape[0]
+            fc = data.shape[1] / lshape[1]
+            box = (sc.start * fc, sr.start * fr, sc.stop * fc, sr.stop * fr)
+            patch = data.zoom_box((sr.stop - sr.start, sc.stop - sc.start), box)
+        self._levels[level].paste(patch, (sr.start, sc.start))
+
+    def changed(self):
+        'True if the file differs from when last tiled'
+        st = self.path.stat()
+        return self._stamp != (st.st_size, st.st_mtime_ns)
+
+    def update(self):
+        '''
+        Retile if the file changed, return number of tiles written.
+        '''
+        st = self.path.stat()
+        stamp = (st.st_size, st.st_mtime_ns)
+        if stamp == self._stamp:
+            return 0
+        self._stamp = stamp
+
+        data = Data(self.path, colormap=self._colormap).load()
+        if self._levels is None:
+            return self.full(data)
+        pixels = data.asarray()
+        if pixels.shape != self._pixels.shape or pixels.dtype != self._pixels.dtype:
+            log.info('%s changed shape, retiling', self.path)
+            return self.full(data)
+
+        rects = dirty_rects(self._pixels, pixels, self._cell)
+        self._pixels = pixels
+        if not rects:
+            return 0
+
+        p = self._pyramid
+        top = p.depth - 1
+        self._levels[top] = data
+        count = 0
+        for level, lrects in reversed(list(enumerate(self.level_rects(rects)))):
+            if level < top:
+                for rect in lrects:
+                    self._remake(level, rect)
+            nrows, ncols = p.tiles_shape(level)
+            locs = set()
+            for sr, sc in lrects:
+                for irow in tile_range(sr, p.tile_size, p.tile_overlap, nrows):
+                    for icol in tile_range(sc, p.tile_size, p.tile_overlap, ncols):
+                        locs.add((irow, icol))
+            for loc in sorted(locs):
+                tile = self._levels[level].crop(p.slices(level, loc))
+                self._writer(tile, self._directory / p.filename(level, loc))
+            count += len(locs)
+        log.info('%s: %d dirty regions, %d tiles rewritten', self.path, len(rects), count)
+        return count
+
+    def run(self, interval=2.0):
+        '''
+        Update whenever the file changes, checking every interval seconds.
+        '''
+        while True:
+            try:
+                if self.changed():
+                    self.update()
+            except (OSError, ValueError) as err:
+                # file may be caught mid-write, try again next time
+                log.warning('%s: update failed: %s', self.path, err)
+                self._stamp = None
+            time.sleep(interval)
@@ -17,10 +17,19 @@
 # You should have received a copy of the GNU General Public License
 # along with Foobar. If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import html
+import shutil
+from pathlib import Path
+from urllib.parse import quote
+
 from .tile import Tiler
 from .dzi import Pyramid
 from .image import Data as Image
 
+# fixme: this will only work for in-source running!
+osd_dir = Path(__file__).parent.parent / "osd"
+
 def osd_header(dzi_url, osd_url="", divid="osd1"):
     'Return HTML for OSD widget'
     return f'''
@@ -37,6 +46,50 @@ def osd_header(dzi_url, osd_url="", divid="osd1"):
     }});
 </script>'''
 
+def install_osd(target, source=osd_dir):
+    '''
+    Copy the OpenSeadragon files pages need to target/osd.
+
+    Files already there are replaced so this may be repeated.  Return
+    the installed directory.
+    '''
+    source = Path(source)
+    osd = Path(target) / "osd"
+    shutil.copytree(source / "images", osd / "images", dirs_exist_ok=True)
+    shutil.copy(source / "openseadragon.min.js", osd / "openseadragon.min.js")
+    return osd
+
+def write_page(target, name, divid="osd1"):
+    '''
+    Write target/name.html viewing target/name.dzi with the OSD files
+    of install_osd(target).  The name may have directories.
+    '''
+    target = Path(target)
+    page = target / f'{name}.html'
+    page.parent.mkdir(parents=True, exist_ok=True)
+    osd = Path(os.path.relpath(target / "osd", page.parent)).as_posix()
+    header = osd_header(quote(f'{Path(name).name}.dzi'), osd, divid)
+    page.write_text(f'<html>\n{header}\n</html>\n')
+    return page
+
+def write_index(target, names, title="dziv"):
+    '''
+    Write target/index.html linking the write_page() of each name.
+    '''
+    items = "\n".join([f'<li><a href="{quote(name)}.html">{html.escape(name)}</a></li>'
+                        for name in names])
+    page = Path(target) / "index.html"
+    page.write_text(f'''<html>
+<head><title>{html.escape(title)}</title></head>
+<body>
+<ul>
+{items}
+</ul>
+</body>
+</html>
+''')
+    return page
+
 def populate_relative(tgt, img, base_url):
     '''
     Populate a relative web directory with everything needed
@@ -44,14 +97,14 @@ def populate_relative(tgt, img, base_url):
     tgt = Path(tgt)
     img = Path(img)
 
-    d = Image(image)
+    d = Image(img)
     p = Pyramid(d.shape)
     t = Tiler(p,d)
     t.save(tgt)
 
     dzifname = img.name + ".dzi"
     osd = osd_header(f'{base_url}/{dzifname}', f'{base_url}/osd')
-    with open(tgt / "index.html") as html:
+    with open(tgt / "index.html", "w") as html:
         html.write(f'''<html>\n{osd}\n</html>\n''')
-    shutil.copytree("osd/images", tgt / "osd/images")
+    install_osd(tgt)
     
@@ -8,14 +8,18 @@ setuptools.setup(
     description="Deep zoom image views",
     url="https://brettviren.github.io/dziv",
     packages=setuptools.find_packages(),
-    python_requires='>=3.5',
+    python_requires='>=3.8',
     install_requires=[
         "click",
         "pytest",
-        "scipy",
+        "numpy",
         "pillow",
         "flask",
     ],
+    extras_require={
+        # coloring .npy array values
+        "colormap": ["matplotlib"],
+    },
     entry_points = {
         'console_scripts': [
             'dziv = dziv.__main__:main',
@@ -0,0 +1,69 @@
+#!/usr/bin/env pytest
+
+import numpy
+from PIL import Image as PILImage
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.array import Data, block_reduce
+
+def test_block_reduce():
+    arr = numpy.arange(5*7, dtype=numpy.uint16).reshape(5, 7)
+    for how, op in [("mean", numpy.mean), ("max", numpy.max), ("min", numpy.min)]:
+        got = block_reduce(arr, 2, how, rows=2)
+        assert got.shape == (3, 4)
+        for r in range(3):
+            for c in range(4):
+                want = op(arr[2*r:2*r+2, 2*c:2*c+2])
+                assert got[r, c] == want
+    assert block_reduce(arr, 2, "mean").dtype == numpy.float32
+    assert block_reduce(arr, 2, "max").dtype == numpy.uint16
+
+def test_array_tiler(tmp_path):
+    src = tmp_path / "src.npy"
+    arr = numpy.zeros((300, 500), dtype=numpy.float32)
+    arr[123, 321] = 1000.0
+    numpy.save(src, arr)
+
+    d = Data(src, "max")
+    assert isinstance(d.asarray(), numpy.memmap)
+    view = d.crop((slice(10, 20), slice(30, 50)))
+    assert view.shape == (10, 20)
+    assert numpy.shares_memory(view.asarray(), d.asarray())
+
+    # a single hot pixel survives to the coarsest level with max
+    assert d.zoom((1, 1)).asarray()[0, 0] == 1000.0
+    assert d.zoom((38, 63)).asarray().max() == 1000.0
+    assert Data(src, "mean").zoom((38, 63)).asarray().max() < 1000.0
+
+    for cascade in (False, True):
+        p = Pyramid((1,1), 64, 1, "png")
+        out = tmp_path / f'tiles-{cascade}'
+        Tiler(p, d, cascade).save(out)
+        for level, loc in p.visit:
+            img = PILImage.open(out / p.filename(level, loc))
+            sr, sc = p.slices(level, loc)
+            assert img.size == (sc.stop - sc.start, sr.stop - sr.start)
+            assert img.mode == "RGBA"
+        top = numpy.asarray(PILImage.open(out / p.filename(0, (0, 0))))
+        hot = numpy.asarray(PILImage.open(out / p.filename(p.depth-1, (1, 5))))
+        # shared normalization maps the peak to the same color
+        assert numpy.array_equal(top[0, 0], hot.reshape(-1, 4)[hot[..., 0].argmax()])
+
+def test_array_levels(tmp_path, monkeypatch):
+    'Each level is reduced from the one above, the full array is read once'
+    import dziv.array
+    src = tmp_path / "src.npy"
+    numpy.save(src, numpy.arange(300 * 500, dtype=numpy.float32).reshape(300, 500))
+    d = Data(src)
+    calls = list()
+    reduce = dziv.array.block_reduce
+    def counted(arr, factor=2, *args, **kwds):
+        calls.append((arr.shape, factor))
+        return reduce(arr, factor, *args, **kwds)
+    monkeypatch.setattr(dziv.array, "block_reduce", counted)
+
+    p = Pyramid((1,1), 64, 1, "png")
+    Tiler(p, d).save(tmp_path / "tiles")
+    assert len(calls) == p.depth - 1
+    assert all([factor == 2 for shape, factor in calls])
+    assert [shape for shape, factor in calls].count((300, 500)) == 1
@@ -0,0 +1,118 @@
+#!/usr/bin/env pytest
+
+import numpy
+import pytest
+from PIL import Image
+from dziv.dzi import Pyramid, load
+from dziv.tile import Tiler
+from dziv.image import Data, Pixels, from_array
+from dziv.output import Pipeline
+from dziv.batch import Batch, find_images
+from dziv.web import install_osd
+
+
+def make_image(path, shape, seed=1):
+    rng = numpy.random.default_rng(seed)
+    Image.fromarray(rng.integers(0, 255, shape + (3,), dtype=numpy.uint8)).save(path)
+    return path
+
+
+def pixels(directory):
+    return {f.relative_to(directory): numpy.asarray(Image.open(f), dtype=int)
+            for f in directory.glob("*/*")}
+
+
+def test_find_images(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    make_image(tmp_path / "a" / "one.png", (10, 10))
+    make_image(tmp_path / "a" / "b" / "two.jpg", (10, 10))
+    (tmp_path / "a" / "notes.txt").write_text("not an image")
+    make_image(tmp_path / "three.png", (10, 10))
+
+    got = find_images([tmp_path / "a", str(tmp_path / "t*.png")])
+    assert sorted([name for path, name in got]) == ["b/two", "one", "three"]
+
+    # same name from two directories
+    with pytest.raises(ValueError):
+        find_images([tmp_path / "a" / "one.png", make_image(tmp_path / "one.png", (10, 10))])
+    with pytest.raises(ValueError):
+        find_images([tmp_path / "nothing*.png"])
+
+
+def test_from_array():
+    'Pixels are wrapped, not copied, where PIL can map them'
+    rng = numpy.random.default_rng(4)
+    for mode, arr in (("L", rng.integers(0, 255, (60, 80), dtype=numpy.uint8)),
+                      ("RGB", rng.integers(0, 255, (60, 80, 3), dtype=numpy.uint8))):
+        meta = Data(Image.fromarray(arr)).meta()
+        assert meta["mode"] == mode
+        for region in (arr, arr[5:50, 7:71], arr[:, ::2]):
+            img = from_array(region, meta)._image
+            assert numpy.array_equal(numpy.asarray(img), region)
+    # a whole array of a mode PIL maps is shared
+    arr = arr[..., 0].copy()
+    img = from_array(arr, dict(mode="L", info=dict()))._image
+    arr[0, 0] = 255 - img.getpixel((0, 0))
+    assert img.getpixel((0, 0)) == arr[0, 0]
+
+
+def test_pixels_zoom_box():
+    'Zooming a box reads just its region yet matches zooming the whole'
+    rng = numpy.random.default_rng(3)
+    arr = rng.integers(0, 255, (300, 500, 3), dtype=numpy.uint8)
+    d = Data(Image.fromarray(arr))
+    px = Pixels(arr, d.meta())
+    for shape, box in [((20, 30), (10.5, 20.25, 310.5, 220.25)),
+                       ((64, 64), (400, 200, 500, 300)),
+                       ((5, 8), (0, 0, 500, 300))]:
+        a = numpy.asarray(d.zoom_box(shape, box)._image)
+        b = numpy.asarray(px.zoom_box(shape, box)._image)
+        assert numpy.array_equal(a, b)
+
+
+@pytest.mark.parametrize("cascade,smooth_first", [(False, False), (True, False), (True, True)])
+def test_batch(tmp_path, cascade, smooth_first):
+    big = make_image(tmp_path / "big.png", (700, 1100))
+    small = make_image(tmp_path / "small.png", (200, 300), 2)
+    out = tmp_path / "out"
+    with Pipeline(writers=2) as writer:
+        b = Batch(out, 128, 1, cascade=cascade, smooth_first=smooth_first, jobs=2,
+                  writer=writer, split=20, chunk=7)
+        got = b.run(find_images([big, small]))
+    assert set(got) == {"big", "small"}
+
+    # a split image makes the tiles of tiling it whole
+    for name, path in (("big", big), ("small", small)):
+        p = Pyramid((1, 1), 128, 1, "png")
+        Tiler(p, Data(path).load(), cascade, smooth_first).save(tmp_path / name)
+        want = pixels(tmp_path / name)
+        have = pixels(out / f'{name}_files')
+        assert want.keys() == have.keys()
+        for key in want:
+            assert numpy.array_equal(want[key], have[key])
+        assert load(out / f'{name}.dzi').shape == p.shape
+        assert got[name]["tiles"] == p.ntiles
+
+    # done images are skipped, a missing one is retiled
+    (out / "small.dzi").unlink()
+    got = Batch(out, 128, 1, jobs=2, skip_existing=True).run(find_images([big, small]))
+    assert got["big"] == dict(skipped=True)
+    assert "tiles" in got["small"]
+
+
+def test_batch_failure(tmp_path):
+    good = make_image(tmp_path / "good.png", (100, 100))
+    bad = tmp_path / "bad.png"
+    bad.write_bytes(b"not a png")
+    got = Batch(tmp_path / "out", jobs=2).run(find_images([good, bad]))
+    assert "error" in got["bad"]
+    assert not (tmp_path / "out" / "bad.dzi").exists()
+    assert (tmp_path / "out" / "good.dzi").exists()
+
+
+def test_install_osd(tmp_path):
+    osd = install_osd(tmp_path)
+    # repeating is harmless
+    assert install_osd(tmp_path) == osd
+    assert (osd / "openseadragon.min.js").exists()
+    assert list((osd / "images").iterdir())
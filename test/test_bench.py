@@ -0,0 +1,34 @@
+#!/usr/bin/env pytest
+
+import json
+import pytest
+from dziv.bench import run_case, run, dumps, stages
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+def test_run_case(tmp_path):
+    for backend in ("image", "array", "stream"):
+        rec = run_case(backend, 300, 128, "png", workdir=tmp_path)
+        assert rec["tiles"] == 21
+        assert rec["bytes"] > 0
+        assert set(rec["stages"]) == set(stages)
+        assert sum(rec["stages"].values()) <= rec["seconds"]
+        assert rec["peak_rss"] > 0
+    assert json.loads(dumps([rec]))[0]["backend"] == "stream"
+
+def test_run_isolated(tmp_path):
+    recs = run(("image",), (200,), (128,), ("jpg",), jobs=2, workdir=tmp_path)
+    assert len(recs) == 1
+    # worker stage timings are merged
+    assert set(recs[0]["stages"]) == set(stages)
+    assert recs[0]["stages"]["encode"] > 0
+
+@pytest.mark.skipif(pytest_benchmark is None, reason="requires pytest-benchmark")
+@pytest.mark.parametrize("backend", ["image", "array", "stream"])
+def test_tiling_benchmark(benchmark, tmp_path, backend):
+    rec = benchmark.pedantic(run_case, args=(backend, 2048, 254, "jpg"),
+                             kwargs=dict(workdir=tmp_path), rounds=3)
+    benchmark.extra_info.update(rec)
@@ -0,0 +1,61 @@
+#!/usr/bin/env pytest
+
+from PIL import Image as PILImage
+from dziv.cache import LRU, nbytes
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.image import Data
+
+def test_lru():
+    c = LRU(10)
+    assert c.get("a", lambda: b"1234") == b"1234"
+    assert c.get("b", lambda: b"1234") == b"1234"
+    assert c.get("a") == b"1234"            # a is now most recent
+    c.put("c", b"1234")                     # evicts b
+    assert "b" not in c
+    assert "a" in c and "c" in c
+    assert c.used == 8
+    c.put("big", b"x" * 11)                 # too big to hold
+    assert "big" not in c
+    s = c.stats
+    assert s["hits"] == 1
+    assert s["misses"] == 2
+    assert s["evictions"] == 1
+
+def test_nbytes():
+    assert nbytes(b"abc") == 3
+    assert nbytes(object()) == 0
+    assert Data(PILImage.new("RGB", (10, 3))).nbytes == 120
+    assert Data(PILImage.new("L", (10, 3))).nbytes == 30
+
+def test_tiler_budget():
+    d = Data(PILImage.new("RGB", (1000, 800)))
+    p = Pyramid(d.shape)
+    budget = 2 * d.nbytes
+    t = Tiler(p, d, cascade=True, level_cache=budget, crop_cache=100000)
+    for level, loc in p.visit:
+        t.crop(level, loc)
+        assert t.cache_stats["levels"]["used"] <= budget
+        assert t.cache_stats["crops"]["used"] <= 100000
+    assert t.cache_stats["crops"]["evictions"] > 0
+
+def test_coalesce():
+    import time
+    import threading
+    c = LRU()
+    made = list()
+    def make():
+        made.append(1)
+        time.sleep(0.1)
+        return b"tile"
+    got = list()
+    threads = [threading.Thread(target=lambda: got.append(c.get("k", make)))
+               for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert got == [b"tile"] * 8
+    assert len(made) == 1
+    assert c.stats["misses"] == 1
+    assert c.stats["waits"] == 7
@@ -0,0 +1,43 @@
+#!/usr/bin/env pytest
+
+import sys
+import numpy
+import pytest
+from matplotlib import cm
+from dziv.colormap import Colormap
+import dziv.colormap
+
+def test_colormap(monkeypatch):
+    rng = numpy.random.default_rng(42)
+    arr = rng.exponential(100, size=(300, 200)).astype(numpy.float32)
+    arr[5, 5] = numpy.nan
+    orig = arr.copy()
+
+    c = Colormap().fit(arr)
+    got = c(arr)
+    assert got.shape == (300, 200, 4) and got.dtype == numpy.uint8
+    assert numpy.array_equal(arr, orig, equal_nan=True)
+
+    # same colors as mapping the whole scaled array through matplotlib
+    scaled = numpy.log10(numpy.maximum(arr.astype(numpy.float64), 10) / 10)
+    lo, hi = numpy.nanmin(scaled), numpy.nanmax(scaled)
+    want = numpy.uint8(cm.plasma((scaled - lo) / (hi - lo)) * 255)
+    finite = numpy.isfinite(arr)
+    same = (got == want).all(axis=2)[finite]
+    assert same.mean() > 0.999
+
+    # chunking does not change the result
+    monkeypatch.setattr(dziv.colormap, "chunk_rows", lambda ncols, pixels=0: 7)
+    assert numpy.array_equal(Colormap().fit(arr)(arr), got)
+
+    lin = Colormap("gray", "linear", vrange=(0, 10))
+    got = lin(numpy.array([[-1.0, 0.0, 5.0, 10.0, 20.0]]))
+    assert list(got[0, :, 0]) == [0, 0, 128, 255, 255]
+
+
+def test_colormap_without_matplotlib(monkeypatch):
+    'Only coloring values needs matplotlib'
+    monkeypatch.setitem(sys.modules, "matplotlib", None)
+    c = Colormap("viridis", vrange=(0, 1))
+    with pytest.raises(ImportError, match="matplotlib"):
+        c(numpy.zeros((2, 2)))
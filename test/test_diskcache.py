@@ -0,0 +1,75 @@
+#!/usr/bin/env pytest
+
+import os
+import sys
+import shutil
+import subprocess
+from dziv.dzi import Pyramid
+from dziv.diskcache import DiskCache
+
+
+def test_source_key(tmp_path):
+    a = tmp_path / "a.png"
+    a.write_bytes(b"one")
+    b = tmp_path / "b.png"
+    shutil.copy(a, b)
+    dc = DiskCache(tmp_path / "cache")
+    p = Pyramid((100, 100))
+    key = dc.source_key(a, p)
+    # same content, same key
+    assert dc.source_key(b, p) == key
+    assert dc.source_key(a, Pyramid((100, 100), tile_format="png")) != key
+    # remembered over restarts, changed with content
+    assert DiskCache(tmp_path / "cache").source_key(a, p) == key
+    a.write_bytes(b"two")
+    assert DiskCache(tmp_path / "cache").source_key(a, p) != key
+
+
+def test_get_put(tmp_path):
+    dc = DiskCache(tmp_path, budget=1000)
+    made = list()
+
+    def make():
+        made.append(1)
+        return b"x" * 300
+    assert dc.get("k", "0/0_0.png") is None
+    assert dc.get("k", "0/0_0.png", make) == b"x" * 300
+    assert dc.get("k", "0/0_0.png", make) == b"x" * 300
+    assert len(made) == 1
+    assert dc.stats["hits"] == 1
+
+    # a second process sees it
+    assert DiskCache(tmp_path, budget=1000).get("k", "0/0_0.png") == b"x" * 300
+
+    for n in range(1, 4):
+        dc.put("k", f'0/{n}_0.png', b"y" * 300)
+        # distinct times for least recently used order
+        os.utime(tmp_path / "k" / f'0/{n}_0.png', ns=(n * 10**9, n * 10**9))
+    os.utime(tmp_path / "k" / '0/0_0.png', ns=(5 * 10**9, 5 * 10**9))
+    dc.put("k", "0/4_0.png", b"z" * 300)
+    assert dc.used <= 900
+    assert dc.stats["evicted"] >= 2
+    # least recently used are gone
+    assert not (tmp_path / "k" / "0/1_0.png").exists()
+    assert (tmp_path / "k" / "0/4_0.png").exists()
+    assert not list(tmp_path.glob("k/*/.*.tmp"))
+
+
+def test_usage(tmp_path):
+    'Replaced tiles count once, crashed writes are cleaned up'
+    dc = DiskCache(tmp_path, budget=1000)
+    dc.put("k", "0/0_0.png", b"x" * 300)
+    dc.put("k", "0/0_0.png", b"x" * 200)
+    assert dc.used == 200
+
+    # left by a writer that died and by one still running
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    stale = tmp_path / "k" / "0" / f'.1_0.png.{dead.pid}.1.tmp'
+    stale.write_bytes(b"y" * 100)
+    live = tmp_path / "k" / "0" / f'.2_0.png.{os.getpid()}.1.tmp'
+    live.write_bytes(b"y" * 100)
+    dc.evict()
+    assert not stale.exists()
+    assert live.exists()
+    assert dc.used == 200
@@ -41,3 +41,37 @@ def test_visit():
     p.dump(True)
 
     
+def test_geometry():
+    'The geometry table agrees with direct calculation'
+    from math import ceil, log
+    for shape, ts, ov in [((1230, 4560), 254, 1), ((1, 1), 254, 1),
+                          ((333, 291), 64, 2), ((4096, 4096), 256, 0)]:
+        p = Pyramid(shape, ts, ov, "png")
+        depth = int(ceil(log(max(shape), 2))) + 1
+        assert p.depth == depth
+        locs = list()
+        for l in range(depth):
+            ls = tuple([int(ceil(s * 0.5 ** (depth - 1 - l))) for s in shape])
+            assert p.level_shape(l) == ls
+            nr, nc = [ceil(s / ts) for s in ls]
+            assert p.tiles_shape(l) == (nr, nc)
+            g = p.level(l)
+            assert g.locs().tolist() == [[ir, ic] for ic in range(nc) for ir in range(nr)]
+            assert g.names() == [p.filename(l, (ir, ic)) for ic in range(nc) for ir in range(nr)]
+            for ic in range(nc):
+                for ir in range(nr):
+                    want = list()
+                    for dim, n in zip((ir, ic), ls):
+                        d = dim * ts - (0 if dim == 0 else ov)
+                        want.append(slice(d, d + min(ts + (1 if dim == 0 else 2) * ov, n - d)))
+                    assert p.slices(l, (ir, ic)) == tuple(want)
+                    locs.append((l, (ir, ic)))
+        assert list(p.visit) == locs
+        assert p.ntiles == len(locs)
+
+    # changing the shape remakes the table
+    p = Pyramid((100, 100))
+    assert p.depth == 8
+    p.shape = (1000, 100)
+    assert p.depth == 11
+    assert p.level_shape(10) == (1000, 100)
@@ -0,0 +1,141 @@
+#!/usr/bin/env pytest
+
+from PIL import Image as PILImage
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.image import Data
+from dziv.manifest import Manifest
+
+class Counter(object):
+    'Writer remembering what it wrote'
+    def __init__(self):
+        self.names = list()
+    def __call__(self, data, path):
+        self.names.append(path)
+        data.save(path)
+
+def tile(src, out, jobs=1, tile_format="png", **opts):
+    d = Data(src)
+    p = Pyramid(d.shape, 64, 1, tile_format)
+    writer = Counter()
+    with Manifest(out, src, p, opts) as m:
+        if jobs == 1:
+            Tiler(p, d, **opts).save(out, writer=writer, manifest=m)
+        else:
+            Tiler(p, d, **opts).save(out, jobs=jobs, manifest=m)
+    return p, writer.names, m
+
+def test_resume(tmp_path):
+    src = tmp_path / "src.png"
+    PILImage.radial_gradient("L").resize((300, 200)).save(src)
+    out = tmp_path / "out"
+
+    p, written, m = tile(src, out)
+    ntiles = len(list(p.visit))
+    assert len(written) == ntiles
+    assert len(m) == ntiles
+
+    # nothing to do
+    p, written, m = tile(src, out)
+    assert written == []
+    assert m.kept == ntiles
+
+    # damaged and missing tiles are redone
+    (out / p.filename(8, (0,0))).unlink()
+    (out / p.filename(9, (0,1))).write_bytes(b"junk")
+    p, written, m = tile(src, out)
+    assert sorted(written) == sorted([out / p.filename(8, (0,0)), out / p.filename(9, (0,1))])
+
+    # an interrupted manifest still counts what was recorded
+    lines = (out / "dziv-manifest.jsonl").read_text().splitlines()
+    (out / "dziv-manifest.jsonl").write_text("\n".join(lines[:5]) + '\n{"t": "9/0')
+    p, written, m = tile(src, out)
+    assert len(written) == ntiles - 4
+
+    # changed options invalidate all
+    p, written, m = tile(src, out, cascade=True)
+    assert len(written) == ntiles
+    assert m.dropped == ntiles
+
+    # changed source invalidates all, format change removes old files
+    PILImage.radial_gradient("L").resize((300, 201)).save(src)
+    p, written, m = tile(src, out, tile_format="jpg", cascade=True)
+    assert len(written) == len(list(p.visit))
+    assert not list(out.glob("*/*.png"))
+
+def test_resume_parallel(tmp_path):
+    src = tmp_path / "src.png"
+    PILImage.radial_gradient("L").resize((900, 700)).save(src)
+    out = tmp_path / "out"
+    p, written, m = tile(src, out, jobs=3)
+    assert len(m) == len(list(p.visit))
+    p, written, m = tile(src, out, jobs=3)
+    assert m.kept == len(list(p.visit))
+
+def test_recorder(tmp_path, monkeypatch):
+    'Records are made from the encoded tiles, never read back'
+    import numpy
+    import dziv.manifest
+    from dziv.manifest import file_digest
+    from dziv.output import Pipeline
+    from dziv.stream import open_source, StreamTiler
+    def read_back(path):
+        raise AssertionError(f'read back {path}')
+    monkeypatch.setattr(dziv.manifest, "_file_record", read_back)
+
+    arr = numpy.zeros((300, 500), dtype=numpy.uint8)
+    arr[:100, :200] = numpy.random.default_rng(1).integers(0, 255, (100, 200))
+    src = tmp_path / "src.png"
+    PILImage.fromarray(arr).save(src)
+
+    for name, writer in (("plain", None), ("piped", Pipeline(writers=2))):
+        out = tmp_path / name
+        p = Pyramid((1, 1), 64, 1, "png")
+        with Manifest(out, src, p) as m:
+            kwds = dict(manifest=m) if writer is None else dict(manifest=m, writer=writer)
+            t = Tiler(p, Data(src).load())
+            t.save(out, **kwds)
+        if writer is not None:
+            writer.close()
+        # uniform tiles are linked and share the record of their first
+        assert t.dedup_stats["tiles"] > 0
+        assert len(m) == len(list(p.visit))
+        for level, loc in p.visit:
+            tile = out / p.filename(level, loc)
+            assert m.get(p.filename(level, loc)) == (tile.stat().st_size, file_digest(tile))
+
+    out = tmp_path / "stream"
+    p = Pyramid((1, 1), 64, 1, "png")
+    with Manifest(out, src, p) as m:
+        StreamTiler(p, open_source(src)).save(out, manifest=m, rows=50)
+    assert len(m) == len(list(p.visit))
+    tile = out / p.filename(9, (1, 2))
+    assert m.get(p.filename(9, (1, 2))) == (tile.stat().st_size, file_digest(tile))
+
+def test_resume_options(tmp_path):
+    'Changing any option that changes pixels retiles on resume'
+    import numpy
+    from click.testing import CliRunner
+    from dziv.__main__ import cli
+    src = tmp_path / "src.npy"
+    numpy.save(src, numpy.random.default_rng(1).random((300, 400)) * 100)
+    out = tmp_path / "out"
+    tile = out / "8/0_0.png"
+    def run(*args):
+        got = CliRunner().invoke(cli, ["tile", "-r", "-o", str(tmp_path / "out.dzi"),
+                                       "-d", str(out), *args, str(src)])
+        assert got.exit_code == 0, got.output
+        return tile.read_bytes()
+
+    first = run()
+    assert run() == first
+    for args in (["--cmap", "viridis"], ["--scale", "linear"], ["--eps", "1"],
+                 ["--reduction", "max"]):
+        assert run(*args) != first
+
+    jpg = tmp_path / "src.jpg"
+    PILImage.radial_gradient("L").resize((1200, 900)).convert("RGB").save(jpg)
+    src = jpg
+    tile = out / "8/0_0.jpg"
+    first = run()
+    assert run("--no-draft") != first
@@ -0,0 +1,41 @@
+#!/usr/bin/env pytest
+
+from PIL import Image as PILImage
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.image import Data
+from dziv.metrics import Registry, registry
+
+def test_registry():
+    r = Registry()
+    r.count("tiles")
+    r.count("tiles", 2)
+    r.observe("zoom", 0.002)
+    with r.timer("zoom"):
+        pass
+    summ = r.summary()
+    assert summ["counters"] == dict(tiles=3)
+    assert summ["timings"]["zoom"]["count"] == 2
+    assert sum(summ["timings"]["zoom"]["counts"]) == 2
+
+    other = Registry()
+    other.merge(summ)
+    other.merge(summ)
+    assert other.summary()["timings"]["zoom"]["count"] == 4
+
+    text = r.prometheus(dict(open_sources=1))
+    assert 'dziv_stage_seconds_bucket{stage="zoom",le="+Inf"} 2' in text
+    assert 'dziv_stage_seconds_count{stage="zoom"} 2' in text
+    assert 'dziv_tiles_total 3' in text
+    assert 'dziv_open_sources 1' in text
+
+def test_tiling_metrics(tmp_path):
+    d = Data(PILImage.radial_gradient("L").resize((700, 500)))
+    p = Pyramid(d.shape, 128, 1, "png")
+    for jobs in (1, 2):
+        registry.reset()
+        Tiler(p, d).save(tmp_path / str(jobs), jobs=jobs)
+        summ = registry.summary()
+        assert summ["counters"]["tiles"] == len(list(p.visit))
+        for stage in ("zoom", "crop", "encode", "write"):
+            assert summ["timings"][stage]["count"] > 0
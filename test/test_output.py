@@ -0,0 +1,68 @@
+#!/usr/bin/env pytest
+
+import pickle
+import numpy
+import pytest
+from PIL import Image
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.image import Data
+from dziv.output import Pipeline
+from dziv.manifest import Manifest
+from dziv.metrics import registry
+
+
+def make_image(path):
+    arr = numpy.zeros((700, 900, 3), dtype=numpy.uint8)
+    arr[100:300, 200:650] = numpy.random.default_rng(1).integers(0, 255, (200, 450, 3))
+    Image.fromarray(arr).save(path)
+    return path
+
+
+def tiles(directory):
+    return {f.relative_to(directory): f.read_bytes() for f in directory.glob("*/*")}
+
+
+def test_pipeline(tmp_path):
+    'Background writing makes the same tiles as writing in line'
+    src = make_image(tmp_path / "src.png")
+    p = Pyramid((1, 1), 128, 1, "png")
+    Tiler(p, Data(src).load()).save(tmp_path / "inline")
+
+    registry.reset()
+    with Pipeline(writers=2, queue=1, fsync=5) as writer:
+        t = Tiler(p, Data(src).load())
+        t.save(tmp_path / "piped", writer)
+    assert tiles(tmp_path / "inline") == tiles(tmp_path / "piped")
+    assert t.dedup_stats["tiles"] > 0
+
+    summ = registry.summary()
+    assert summ["counters"]["written_bytes"] > 0
+    assert summ["timings"]["fsync"]["count"] > 0
+    # with room for one tile, some must wait
+    assert summ["counters"]["write_stalls"] > 0
+
+
+def test_pipeline_manifest(tmp_path):
+    'Tiles are written before they are recorded'
+    src = make_image(tmp_path / "src.png")
+    p = Pyramid((700, 900), 128, 1, "png")
+    out = tmp_path / "tiles"
+    with Pipeline(writers=2) as writer:
+        with Manifest(out, src, p, dict()) as manifest:
+            Tiler(p, Data(src).load()).save(out, writer, manifest=manifest)
+        assert len(manifest) == p.ntiles
+
+
+def test_pipeline_pickle():
+    w = Pipeline(3, 7, 2)
+    w2 = pickle.loads(pickle.dumps(w))
+    assert (w2.writers, w2.queue, w2.fsync) == (3, 7, 2)
+
+
+def test_pipeline_error(tmp_path):
+    (tmp_path / "file").write_text("not a directory")
+    w = Pipeline(writers=1)
+    w.submit(tmp_path / "file" / "tile.png", b"x")
+    with pytest.raises(OSError):
+        w.close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env pytest
+
+import pytest
+from PIL import Image as PILImage
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.image import Data
+from dziv.pack import Pack, PackWriter
+import dziv.server
+
+def make_pack(tmp_path):
+    d = Data(PILImage.radial_gradient("L").resize((700, 300)))
+    p = Pyramid(d.shape, 128, 1, "png")
+    Tiler(p, d).save(tmp_path / "tree")
+    pack = tmp_path / "img.dzp"
+    with PackWriter(pack, p) as writer:
+        Tiler(p, d).save(writer=writer, jobs=2)
+    return p, pack
+
+def test_pack(tmp_path):
+    p, pack = make_pack(tmp_path)
+    pk = Pack(pack)
+    assert pk.pyramid.as_dict() == p.as_dict()
+    for level, loc in p.visit:
+        want = (tmp_path / "tree" / p.filename(level, loc)).read_bytes()
+        assert pk.tile(level, loc) == want
+    with pytest.raises(KeyError):
+        pk.tile(p.depth, (0,0))
+    with pytest.raises(KeyError):
+        pk.tile(0, (0,1))
+
+    pk.unpack(tmp_path / "unpacked")
+    for f in (tmp_path / "tree").glob("*/*"):
+        assert (tmp_path / "unpacked" / f.relative_to(tmp_path / "tree")).read_bytes() == f.read_bytes()
+    pk.close()
+
+def test_serve_pack(tmp_path):
+    p, pack = make_pack(tmp_path)
+    c = dziv.server.create([str(pack)]).test_client()
+    r = c.get('/0/image_files/9/2_1.png')
+    assert r.status_code == 200
+    assert r.data == (tmp_path / "tree" / "9/2_1.png").read_bytes()
+    assert c.get('/0/image_files/9/9_9.png').status_code == 404
+    assert b'TileSize="128"' in c.get('/0/image.dzi').data
+
+def test_pack_close_while_serving(tmp_path):
+    'Closing a source never breaks a tile being read or sent'
+    import threading
+    p, pack = make_pack(tmp_path)
+    src = dziv.server.PackSource(pack)
+    want = (tmp_path / "tree" / "9/2_1.png").read_bytes()
+    view = src.tile(9, (1, 2))
+    src.close()
+    assert bytes(view) == want
+
+    # readers racing the idle reaper
+    errors = list()
+    def read():
+        for count in range(300):
+            try:
+                assert bytes(src.tile(9, (1, 2))) == want
+            except Exception as err:
+                errors.append(err)
+    threads = [threading.Thread(target=read) for n in range(4)]
+    for t in threads:
+        t.start()
+    for count in range(300):
+        src.close()
+    for t in threads:
+        t.join()
+    assert not errors
@@ -0,0 +1,50 @@
+#!/usr/bin/env pytest
+
+import time
+import threading
+from dziv.dzi import Pyramid
+from dziv.prewarm import plan, Prewarmer
+
+
+def wait_for(cond, timeout=10):
+    t0 = time.time()
+    while not cond():
+        assert time.time() - t0 < timeout
+        time.sleep(0.01)
+
+
+def test_plan():
+    p = Pyramid((1000, 1500), 128)
+    got = list(plan(p))
+    assert sorted(got) == sorted(p.visit)
+    levels = [level for level, loc in got]
+    assert levels == sorted(levels)
+    # center first
+    assert got[-len(p.level(p.depth - 1))][1] in [(3, 5), (4, 5), (3, 6), (4, 6)]
+
+
+def test_prewarmer():
+    p = Pyramid((1000, 1500), 128)
+    made = list()
+    gate = threading.Event()
+
+    def warm(num, level, loc):
+        gate.wait()
+        made.append((num, level, loc))
+
+    w = Prewarmer(warm, {0: p}, budget=10, duty=1)
+    # nothing is made while a request is live
+    with w.live():
+        w.start()
+        gate.set()
+        time.sleep(0.05)
+        assert not made
+        w.hint(0, p.depth - 1, (7, 11))
+    wait_for(lambda: w.status()["done"])
+    # neighbors of the hinted tile first
+    assert made[0][1] == p.depth - 1
+    assert all([abs(loc[0] - 7) <= 1 and abs(loc[1] - 11) <= 1 for n, l, loc in made[:3]])
+    st = w.status()
+    assert st["planned"] == 10
+    assert st["sources"]["0"]["warmed"] == len(made) == 10 + 3
+    w.stop()
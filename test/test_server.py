@@ -0,0 +1,268 @@
+#!/usr/bin/env pytest
+
+import io
+import os
+import sys
+import subprocess
+from PIL import Image as PILImage
+import dziv.server
+import dziv.shared
+
+def make_app(tmp_path, **kwds):
+    src = tmp_path / "src.png"
+    PILImage.new("RGB", (600, 400), (10, 20, 30)).save(src)
+    return dziv.server.create([str(src)], **kwds).test_client()
+
+def test_tile_etag(tmp_path):
+    c = make_app(tmp_path, tile_cache=10**6)
+    url = '/0/image_files/9/1_0.png'
+    r = c.get(url)
+    assert r.status_code == 200
+    assert r.mimetype == "image/png"
+    etag = r.headers["ETag"]
+    assert etag.startswith('"') and not etag.startswith('W/')
+    assert "immutable" in r.headers["Cache-Control"]
+    data = r.data
+
+    r = c.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert not r.data
+
+    r = c.get(url)
+    assert r.data == data
+    assert r.headers["ETag"] == etag
+    tiles = c.get('/stats').json["tiles"]
+    assert tiles["hits"] == 1
+    assert tiles["misses"] == 1
+
+def test_without_matplotlib(tmp_path, monkeypatch):
+    'Images are served without matplotlib, only colormaps need it'
+    monkeypatch.setitem(sys.modules, "matplotlib", None)
+    c = make_app(tmp_path)
+    for url in ['/', '/0/index.html', '/0/image.dzi', '/0/image_files/9/1_0.png']:
+        assert c.get(url).status_code == 200, url
+
+def test_lazy_sources(tmp_path):
+    for n in range(3):
+        PILImage.new("RGB", (300 + n, 200), (n, n, n)).save(tmp_path / f'{n}.jpg')
+    (tmp_path / "notes.txt").write_text("not an image")
+    sources = dziv.server.Sources(dziv.server.find_sources(tmp_path))
+    assert len(sources) == 3
+    assert sources[2].pyramid.shape == (200, 302)
+    assert not any(s.is_open for s in sources)
+
+    t = sources.tiler(0)
+    t.crop(9, (0,0))
+    assert sources[0].is_open
+    # the decoded image counts even with no level made
+    assert t.cache_stats["levels"]["used"] == 0
+    assert sources[0].nbytes >= 300 * 200 * 3
+
+    # room for both
+    sources.budget = 3 * sources[0].nbytes
+    sources.tiler(1).crop(9, (0,0))
+    assert sources[0].is_open
+    assert sources[1].is_open
+
+    # room for one, least recently used is closed
+    sources.budget = sources[1].nbytes * 3 // 2
+    sources.tiler(1).crop(9, (0,1))
+    assert not sources[0].is_open
+    assert sources[1].is_open
+
+    # idle
+    sources.budget = None
+    sources.idle = 1e-6
+    sources.tiler(2)
+    assert not sources[1].is_open
+    assert sources[2].is_open
+    sources.evict()
+    assert not sources[2].is_open
+
+def test_concurrent(tmp_path):
+    import threading
+    c = make_app(tmp_path, workers=4, regional=False)
+    urls = [f'/0/image_files/{level}/{col}_0.png'
+            for level in (9, 10) for col in (0, 1)] * 4
+    got = list()
+    def fetch(url):
+        got.append(c.get(url).status_code)
+    threads = [threading.Thread(target=fetch, args=(url,)) for url in urls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert got == [200] * len(urls)
+    stats = c.get('/stats').json
+    assert stats["tiles"]["misses"] == 4
+    assert stats["tiles"]["hits"] + stats["tiles"]["waits"] == len(urls) - 4
+    assert stats["0"]["levels"]["misses"] == 2
+
+def test_serve_dzi(tmp_path):
+    from dziv.dzi import Pyramid
+    from dziv.tile import Tiler
+    from dziv.image import Data
+    src = tmp_path / "img.png"
+    PILImage.radial_gradient("L").resize((600, 400)).save(src)
+    d = Data(src)
+    p = Pyramid(d.shape, 128, 1, "png")
+    p.save(tmp_path / "img.dzi")
+    Tiler(p, d).save(tmp_path / "img_files")
+    missing = tmp_path / "img_files/10/1_1.png"
+    want = missing.read_bytes()
+    missing.unlink()
+
+    c = dziv.server.create([str(tmp_path / "img.dzi")]).test_client()
+    r = c.get('/0/image_files/10/0_1.png')
+    assert r.status_code == 200
+    assert r.mimetype == "image/png"
+    assert r.data == (tmp_path / "img_files/10/0_1.png").read_bytes()
+    assert "immutable" in r.headers["Cache-Control"]
+    r2 = c.get('/0/image_files/10/0_1.png', headers={"If-None-Match": r.headers["ETag"]})
+    assert r2.status_code == 304
+    assert c.get('/0/image_files/10/1_1.png').status_code == 404
+
+    c = dziv.server.create([str(tmp_path / "img.dzi")], dzi_fallback=True).test_client()
+    r = c.get('/0/image_files/10/1_1.png')
+    assert r.status_code == 200
+    assert r.data == want
+
+def test_array_style(tmp_path):
+    import numpy
+    src = tmp_path / "values.npy"
+    arr = numpy.outer(numpy.arange(300), numpy.arange(500)).astype(numpy.float32)
+    numpy.save(src, arr)
+    c = dziv.server.create([str(src)], tile_cache=10**7).test_client()
+    assert c.get('/0/image.dzi').status_code == 200
+
+    url = '/0/image_files/8/0_0.png'
+    plain = c.get(url)
+    assert plain.status_code == 200
+    levels = c.get('/stats').json["0"]["levels"]["misses"]
+    gray = c.get(url + '?cmap=gray&scale=linear&vmax=1000')
+    assert gray.status_code == 200
+    assert gray.data != plain.data
+    assert gray.headers["ETag"] != plain.headers["ETag"]
+    rgba = numpy.asarray(PILImage.open(io.BytesIO(gray.data)))
+    assert (rgba[..., 0] == rgba[..., 1]).all()
+
+    # path form is the same style, encoded once
+    path = c.get('/0/scale=linear,cmap=gray,vmax=1000/image_files/8/0_0.png')
+    assert path.data == gray.data
+    stats = c.get('/stats').json
+    assert stats["tiles"]["misses"] == 2
+    # restyling reuses the levels of values
+    assert stats["0"]["levels"]["misses"] == levels
+
+    assert c.get(url + '?cmap=nosuchmap').status_code == 400
+    assert c.get('/0/bogus/image_files/8/0_0.png').status_code == 400
+
+def test_uniform_shared(tmp_path):
+    src = tmp_path / "blank.png"
+    PILImage.new("RGB", (2000, 1000), (0, 0, 0)).save(src)
+    c = dziv.server.create([str(src)], tile_cache=10**6).test_client()
+    a = c.get('/0/image_files/11/1_1.png')
+    b = c.get('/0/image_files/11/2_1.png')
+    assert a.status_code == b.status_code == 200
+    stats = c.get('/stats').json
+    assert stats["tiles"]["misses"] == 2
+    assert stats["0"]["uniform"]["hits"] == 1
+
+def test_metrics(tmp_path):
+    c = make_app(tmp_path, tile_cache=10**6)
+    c.get('/0/image_files/9/1_0.png')
+    c.get('/0/image_files/9/1_0.png')
+    r = c.get('/metrics')
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    lines = r.data.decode().splitlines()
+    assert 'dziv_tile_cache_hits_total 1' in lines
+    assert 'dziv_open_sources 1' in lines
+    assert any(l.startswith('dziv_stage_seconds_count{stage="encode"}') for l in lines)
+
+def test_disk_cache(tmp_path):
+    'A restarted server reads tiles made before from disk'
+    cache = tmp_path / "cache"
+    url = '/0/image_files/9/1_0.png'
+    c = make_app(tmp_path, disk_cache=cache)
+    data = c.get(url).data
+    assert c.get('/stats').json["disk"]["misses"] == 1
+
+    c = make_app(tmp_path, disk_cache=cache)
+    assert c.get(url).data == data
+    st = c.get('/stats').json
+    assert st["disk"]["hits"] == 1
+    # nothing was decoded
+    assert "0" not in st
+    assert "dziv_disk_cache_hits_total 1" in c.get('/metrics').text
+
+def test_disk_cache_dzi_fallback(tmp_path):
+    'DZI fallback tiles are cached by their image, not the DZI file'
+    from dziv.dzi import Pyramid
+    for value in (10, 200):
+        src = tmp_path / f'img{value}.png'
+        PILImage.new("L", (600, 400), value).save(src)
+        Pyramid((400, 600), 128, 1, "png").save(tmp_path / f'img{value}.dzi')
+        (tmp_path / f'img{value}_files').mkdir()
+    c = dziv.server.create([str(tmp_path / "img10.dzi"), str(tmp_path / "img200.dzi")],
+                           dzi_fallback=True, disk_cache=tmp_path / "cache").test_client()
+    for num, value in enumerate((10, 200)):
+        r = c.get(f'/{num}/image_files/9/1_0.png')
+        assert r.status_code == 200
+        assert PILImage.open(io.BytesIO(r.data)).getpixel((0, 0)) == value
+
+def test_prewarm(tmp_path):
+    'Tiles made ahead of the viewer are served from cache'
+    import time
+    c = make_app(tmp_path, prewarm=-1)
+    t0 = time.time()
+    while not c.get('/prewarm').json["done"]:
+        assert time.time() - t0 < 20
+        time.sleep(0.05)
+    st = c.get('/prewarm').json
+    assert st["warmed"] == st["planned"] == st["sources"]["0"]["total"]
+    assert c.get('/0/image_files/9/1_0.png').status_code == 200
+    assert c.get('/stats').json["tiles"]["hits"] == 1
+    assert not make_app(tmp_path).get('/prewarm').json["enabled"]
+
+def test_pixel_store(tmp_path):
+    'Servers sharing a pixel store map levels made by the first'
+    import numpy
+    src = tmp_path / "src.jpg"
+    arr = numpy.random.default_rng(0).integers(0, 255, (400, 600, 3), dtype=numpy.uint8)
+    PILImage.fromarray(arr).save(src)
+    urls = ['/0/image_files/9/1_0.jpg', '/0/image_files/7/0_0.jpg']
+    plain = dziv.server.create([str(src)], regional=False).test_client()
+    want = [plain.get(url).data for url in urls]
+
+    store = tmp_path / "pixels"
+    for n in range(2):
+        sources = dziv.server.Sources([src], pixel_store=dziv.shared.PixelStore(store))
+        c = dziv.server.create([str(src)], pixel_store=store).test_client()
+        assert [c.get(url).data for url in urls] == want
+        t = sources.tiler(0)
+        level = t.zoom(7)
+        assert isinstance(level.asarray(), numpy.memmap)
+        crop = t.crop(7, (0, 0))
+        assert numpy.shares_memory(crop.asarray(), level.asarray())
+        # levels were made by the first, never decoded again
+        assert not t._data._decoded
+    assert len(list(store.glob("*.npy"))) == 2
+
+    # levels of a since changed image are pruned on start, open maps
+    # stay valid, locks and partial entries of live processes are kept
+    stale = sorted(store.glob("*.npy")) + sorted(store.glob("*.meta"))
+    locks = sorted(store.glob("*.lock"))
+    dead = subprocess.Popen([sys.executable, "-c", ""])
+    dead.wait()
+    crashed = store / f'.{stale[0].stem}.{dead.pid}.tmp'
+    writing = store / f'.{stale[0].stem}.{os.getpid()}.tmp'
+    for path in (crashed, writing):
+        path.write_bytes(b"partial")
+    os.utime(src, ns=(0, 0))
+    c = dziv.server.create([str(src)], pixel_store=store).test_client()
+    assert not any([path.exists() for path in stale + [crashed]])
+    assert all([path.exists() for path in locks + [writing]])
+    assert numpy.asarray(level.asarray()).sum() > 0
+    assert [c.get(url).data for url in urls] == want
+    assert len(list(store.glob("*.npy"))) == 2
@@ -0,0 +1,60 @@
+#!/usr/bin/env pytest
+
+import numpy
+import pytest
+from PIL import Image as PILImage
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.image import Data
+from dziv.array import Data as Array
+from dziv.stream import open_source, StreamTiler, WholeSource
+
+def same_tiles(a, b):
+    files = sorted(f.relative_to(a) for f in a.glob("*/*"))
+    assert files
+    assert files == sorted(f.relative_to(b) for f in b.glob("*/*"))
+    for f in files:
+        assert (a / f).read_bytes() == (b / f).read_bytes(), f
+
+@pytest.mark.parametrize("mode,suffix,rows", [
+    ("RGB", "png", 50), ("L", "png", 37), ("RGBA", "png", 64),
+    ("RGB", "ppm", 50), ("RGB", "bmp", 33), ("RGB", "tif", 64)])
+def test_stream(tmp_path, mode, suffix, rows):
+    rng = numpy.random.default_rng(1)
+    arr = rng.integers(0, 255, (301, 453, 4), dtype=numpy.uint8)
+    # smooth structure so PNG uses more than one filter type
+    arr[::2] = arr[1::2].mean(axis=0).astype(numpy.uint8)
+    src = tmp_path / f'src.{suffix}'
+    PILImage.fromarray(arr).convert(mode).save(src)
+
+    s = open_source(src)
+    assert not isinstance(s, WholeSource)
+    p = Pyramid(s.shape, 64, 1, "png")
+    StreamTiler(p, s).save(tmp_path / "stream", rows=rows)
+
+    p = Pyramid(s.shape, 64, 1, "png")
+    Tiler(p, Data(src), cascade=True).save(tmp_path / "tiler")
+
+    same_tiles(tmp_path / "tiler", tmp_path / "stream")
+
+@pytest.mark.parametrize("dtype", ["float64", "uint8"])
+def test_stream_npy(tmp_path, dtype):
+    rng = numpy.random.default_rng(1)
+    src = tmp_path / "src.npy"
+    numpy.save(src, rng.exponential(100, (123, 321)).astype(dtype))
+    s = open_source(src)
+    p = Pyramid(s.shape, 32, 2, "png")
+    StreamTiler(p, s).save(tmp_path / "stream", rows=40)
+    p = Pyramid(s.shape, 32, 2, "png")
+    Tiler(p, Data(src), cascade=True).save(tmp_path / "tiler")
+    same_tiles(tmp_path / "tiler", tmp_path / "stream")
+
+    # values are colored whatever the dtype, as without streaming
+    p = Pyramid(s.shape, 32, 2, "png")
+    Tiler(p, Array(src)).save(tmp_path / "array")
+    top = str(p.depth - 1)
+    files = sorted(f.name for f in (tmp_path / "array" / top).iterdir())
+    assert files == sorted(f.name for f in (tmp_path / "stream" / top).iterdir())
+    for name in files:
+        assert (tmp_path / "array" / top / name).read_bytes() == \
+            (tmp_path / "stream" / top / name).read_bytes(), name
@@ -21,7 +21,7 @@ class Dummy(object):
         #     path.parent.mkdir(parents=True)
         # path.open("w").write("%d %d\n" % self.shape)
 
-def test_tiler():
+def test_tiler(tmp_path):
     
     p = Pyramid((1,1))
     shape = (1230,4560)
@@ -37,7 +37,141 @@ def test_tiler():
     assert d2.shape == d.shape
     d3 = t.zoom(last)
     assert d3.shape == d.shape
-    t.save(prefix="test-tile/")
+    t.save(tmp_path / "test-tile")
     print ("saved:",len(saved))
     assert len(saved) == 141
     
+
+def test_cascade():
+    from PIL import Image as PILImage
+    from dziv.image import Data
+    d = Data(PILImage.new("RGB", (1001, 333), (10, 20, 30)))
+    p = Pyramid(d.shape)
+    for smooth_first in (False, True):
+        t = Tiler(p, d, cascade=True, smooth_first=smooth_first)
+        assert t.zoom(p.depth - 1) is d
+        for level in range(p.depth):
+            assert t.zoom(level).shape == p.level_shape(level)
+            assert t.crop(level, (0,0)).shape
+
+def test_parallel(tmp_path):
+    import numpy
+    from PIL import Image as PILImage
+    from dziv.image import Data
+    rng = numpy.random.default_rng(42)
+    for mode, fmt in (("RGB", "jpg"), ("L", "png"), ("P", "png")):
+        arr = rng.integers(0, 255, (700, 1100, 3), dtype=numpy.uint8)
+        img = PILImage.fromarray(arr).convert(mode)
+        d = Data(img)
+        p = Pyramid(d.shape, tile_format=fmt)
+        serial = tmp_path / mode / "serial"
+        parallel = tmp_path / mode / "parallel"
+        Tiler(p, d).save(serial)
+        Tiler(p, d).save(parallel, jobs=3)
+        files = sorted(f.relative_to(serial) for f in serial.glob("*/*"))
+        assert len(files) == len(list(p.visit))
+        for f in files:
+            assert (serial / f).read_bytes() == (parallel / f).read_bytes()
+
+def test_regional():
+    import numpy
+    from PIL import Image as PILImage
+    from dziv.image import Data
+    y, x = numpy.mgrid[0:900, 0:1300]
+    arr = (numpy.sin(x / 9.0) * numpy.cos(y / 13.0) * 120 + 128).astype(numpy.uint8)
+    d = Data(PILImage.fromarray(numpy.dstack([arr, arr[::-1], arr[:, ::-1]])))
+    p = Pyramid(d.shape)
+    full = Tiler(p, d)
+    regional = Tiler(p, d, regional=True)
+    for level, loc in p.visit:
+        a = numpy.asarray(full.crop(level, loc)._image, dtype=int)
+        b = numpy.asarray(regional.crop(level, loc)._image, dtype=int)
+        assert a.shape == b.shape
+        assert numpy.abs(a - b).max() <= 1
+    # regional crops never zoom a whole level
+    assert regional.cache_stats["levels"]["misses"] == 0
+
+def test_regional_cascade():
+    import numpy
+    from PIL import Image as PILImage
+    from dziv.image import Data
+    rng = numpy.random.default_rng(3)
+    d = Data(PILImage.fromarray(rng.integers(0, 255, (777, 1111, 3), dtype=numpy.uint8)))
+    p = Pyramid(d.shape, 100, 2)
+    for smooth_first in (False, True):
+        full = Tiler(p, d, cascade=True, smooth_first=smooth_first)
+        regional = Tiler(p, d, cascade=True, smooth_first=smooth_first, regional=True)
+        for level, loc in p.visit:
+            a = numpy.asarray(full.crop(level, loc)._image, dtype=int)
+            b = numpy.asarray(regional.render(level, loc)._image, dtype=int)
+            assert a.shape == b.shape
+            # block reduction is exact, box resize may round differently
+            assert numpy.abs(a - b).max() <= (1 if smooth_first else 0)
+
+def test_dedup(tmp_path):
+    import numpy
+    from PIL import Image as PILImage
+    from dziv.image import Data
+    from dziv.pack import Pack, PackWriter
+    from dziv.tile import write
+    img = PILImage.new("L", (1500, 1000), 0)
+    img.paste(255, (700, 400, 720, 420))
+    d = Data(img)
+    p = Pyramid(d.shape, 128, 1, "png")
+
+    plain = tmp_path / "plain"
+    Tiler(p, d).save(plain, dedup=False)
+    for jobs in (1, 3):
+        out = tmp_path / f'dedup{jobs}'
+        t = Tiler(p, d)
+        t.save(out, jobs=jobs)
+        assert t.dedup_stats["tiles"] > len(list(p.visit)) / 3
+        assert t.dedup_stats["bytes"] > 0
+        for level, loc in p.visit:
+            name = p.filename(level, loc)
+            assert (out / name).read_bytes() == (plain / name).read_bytes()
+
+    # rewriting a shared tile leaves the others alone
+    name = p.filename(p.depth - 1, (1, 1))
+    other = p.filename(p.depth - 1, (1, 2))
+    assert (out / name).stat().st_nlink > 1
+    write(Data(PILImage.new("L", (130, 130), 7)), out / name)
+    assert (out / other).read_bytes() == (plain / other).read_bytes()
+
+    pack = tmp_path / "img.dzp"
+    with PackWriter(pack, p) as writer:
+        Tiler(p, d).save(writer=writer)
+    with PackWriter(tmp_path / "full.dzp", p) as writer:
+        Tiler(p, d).save(writer=writer, dedup=False)
+    assert pack.stat().st_size < (tmp_path / "full.dzp").stat().st_size / 2
+    pk = Pack(pack)
+    for level, loc in p.visit:
+        assert pk.tile(level, loc) == (plain / p.filename(level, loc)).read_bytes()
+    pk.close()
+
+def test_draft(tmp_path):
+    'Coarse zooms of a JPEG decode it at reduced scale'
+    import numpy
+    from PIL import Image
+    from dziv.image import Data
+    x = numpy.linspace(0, 255, 1600)
+    arr = numpy.uint8(numpy.stack([x[None, :] * numpy.ones((1200, 1))] * 3, axis=2))
+    path = tmp_path / "src.jpg"
+    Image.fromarray(arr).save(path)
+
+    d = Data(path)
+    full = Data(path, draft=False)
+    for shape in [(600, 800), (150, 200), (75, 100)]:
+        got = d.zoom(shape).asarray().astype(int)
+        want = full.zoom(shape).asarray().astype(int)
+        assert got.shape == want.shape
+        assert numpy.abs(got - want).mean() < 1
+    box = (400, 300, 1200, 900)
+    got = d.zoom_box((150, 200), box).asarray().astype(int)
+    want = full.zoom_box((150, 200), box).asarray().astype(int)
+    assert numpy.abs(got - want).mean() < 1
+    assert not d._decoded
+
+    # a zoom by less than half needs full resolution
+    d.zoom((1000, 1300))
+    assert d._decoded
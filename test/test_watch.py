@@ -0,0 +1,53 @@
+#!/usr/bin/env pytest
+
+import os
+import numpy
+from PIL import Image as PILImage
+from dziv.dzi import Pyramid
+from dziv.tile import Tiler
+from dziv.image import Data
+from dziv.watch import Watcher, dirty_rects
+
+def pixels(path):
+    return numpy.asarray(PILImage.open(path), dtype=int)
+
+def test_dirty_rects():
+    old = numpy.zeros((100, 70), dtype=numpy.uint8)
+    new = old.copy()
+    assert dirty_rects(old, new) == []
+    new[20:40, 5:9] = 1
+    new[90, 60] = 1
+    got = dirty_rects(old, new, cell=16)
+    assert got == [(slice(16, 48), slice(0, 16)), (slice(80, 96), slice(48, 64))]
+
+def test_watch(tmp_path):
+    src = tmp_path / "src.png"
+    img = PILImage.radial_gradient("L").resize((700, 500))
+    img.save(src)
+
+    for cascade, smooth_first in [(False, False), (True, False), (True, True)]:
+        out = tmp_path / f'tiles-{cascade}-{smooth_first}'
+        p = Pyramid((1,1), 64, 1, "png")
+        w = Watcher(src, p, out, cascade=cascade, smooth_first=smooth_first)
+        total = w.update()
+        assert total > 0
+        assert w.update() == 0
+
+        arr = numpy.asarray(img).copy()
+        arr[300:330, 410:450] = 255 - arr[300:330, 410:450]
+        PILImage.fromarray(arr).save(src)
+        st = os.stat(src)
+        os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+        count = w.update()
+        assert 0 < count < total / 4
+
+        ref = tmp_path / f'ref-{cascade}-{smooth_first}'
+        Tiler(Pyramid((1,1), 64, 1, "png"), Data(src), cascade, smooth_first).save(ref)
+        for level, loc in p.visit:
+            name = p.filename(level, loc)
+            a = pixels(out / name)
+            b = pixels(ref / name)
+            assert a.shape == b.shape
+            # box resize may round differently than a full resize
+            assert numpy.abs(a - b).max() <= (0 if cascade and not smooth_first else 1)
+        img.save(src)